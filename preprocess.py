@@ -3,15 +3,18 @@ import os
 
 import psutil
 
+from src.preprocess.grid import preprocess as preprocess_grid
 from src.preprocess.head_pose.dlib_pose import HeadPose
-from src.preprocess.lrs2 import extract_angles as lrs2_extract_angles
 from src.preprocess.lrs2 import \
     mouth_bounding_boxes as lrs2_mouth_bounding_boxes
 from src.preprocess.lrs2 import \
     prepare_language_model as lrs2_prepare_language_model
 from src.preprocess.lrs2 import preprocess as preprocess_lrs2
+from src.preprocess.lrs2 import preprocess_shards as lrs2_preprocess_shards
 from src.preprocess.lrw import extract_angles as lrw_extract_angles
 from src.preprocess.lrw import preprocess as process_lrw
+from src.preprocess.lrw import preprocess_frames as lrw_preprocess_frames
+from src.preprocess.lrw import preprocess_shards as lrw_preprocess_shards
 from src.preprocess.ouluvs2 import head_poses
 from src.preprocess.ouluvs2 import preprocess as process_ouluvs2
 
@@ -22,21 +25,50 @@ if __name__ == "__main__":
     parser.add_argument('--output', default='data/preprocess')
     parser.add_argument('--seed', type=int, default=42)
     parser.add_argument('--workers', type=int)
+    parser.add_argument('--words', type=int, default=500)
     parser.add_argument('--augmentation', help='Augment data', action='store_true')
+    parser.add_argument('--resume', action='store_true', help='Skip all items recorded in the journal of a previous run')
+    parser.add_argument('--only-missing', action='store_true', help='Only process new and failed items and those whose output is gone')
+    parser.add_argument('--keyframe_interval', type=int, default=10, help='Frames between face detections, the face is tracked in between')
+    parser.add_argument('--detection_batch', type=int, default=64, help='Frames per face detector batch, collected across videos')
+    parser.add_argument('--detection_wait', type=float, default=0.05, help='Seconds to wait for a detector batch to fill up')
+    parser.add_argument('--head_pose_model', help='HopeNet exported with src/preprocess/head_pose/hopenet.py --export')
+    parser.add_argument('--pretrain_yaws', action='store_true', help='Also estimate the yaws of the LRS2 pretrain videos')
     args = parser.parse_args()
 
     output_path = os.path.join(args.output, args.set)
     args.workers = psutil.cpu_count(logical=False) if args.workers == None else args.workers
+    resume = 'only_missing' if args.only_missing else 'resume' if args.resume else None
 
     if args.set == "lrw":
-        lrw_extract_angles(args.data, output_path=output_path, num_workers=args.workers, seed=args.seed)
+        lrw_extract_angles(
+            args.data, output_path=output_path, num_workers=args.workers, seed=args.seed, resume=resume,
+            head_pose_model=args.head_pose_model
+        )
         # process_lrw(args.data, args.output, num_words=args.words, workers=args.workers, augmentation=args.augmentation)
+    elif args.set == "lrw_frames":
+        lrw_preprocess_frames(args.data, output_path, workers=args.workers, seed=args.seed, resume=resume)
+    elif args.set == "lrw_shards":
+        lrw_preprocess_shards(args.data, output_path, workers=args.workers, seed=args.seed, resume=resume)
+    elif args.set == "lrw_hdf5":
+        process_lrw(
+            args.data, output_path, num_words=args.words, workers=args.workers, augmentation=args.augmentation, resume=resume,
+            seed=args.seed
+        )
     elif args.set == "ouluvs2":
-        # process_ouluvs2(args.data, output_path, workers=args.workers)
-        head_poses(args.data)
+        head_poses(args.data, output_path, resume=resume, workers=args.workers)
+    elif args.set == "ouluvs2_hdf5":
+        process_ouluvs2(args.data, output_path, workers=args.workers, resume=resume, seed=args.seed)
     elif args.set == "lrs2":
-        lrs2_extract_angles(args.data, output_path=output_path, num_workers=args.workers)
         # lrs2_prepare_language_model(args.data, output_path)
-        preprocess_lrs2(args.data, output_path, args.workers)
+        preprocess_lrs2(
+            args.data, output_path, args.workers, resume=resume, keyframe_interval=args.keyframe_interval,
+            detection_batch_size=args.detection_batch, max_wait=args.detection_wait, head_pose_model=args.head_pose_model,
+            pretrain_yaws=args.pretrain_yaws
+        )
+    elif args.set == "lrs2_shards":
+        lrs2_preprocess_shards(args.data, output_path, workers=args.workers, resume=resume)
+    elif args.set == "grid":
+        preprocess_grid(os.path.join(args.data, "videos"), num_cpus=args.workers, resume=resume, keyframe_interval=args.keyframe_interval)
     else:
         raise Exception("Not a valid set name")
@@ -0,0 +1,88 @@
+import math
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+
+class BucketBatchSampler(Sampler):
+    '''
+    Groups samples of similar length into buckets of bucket_width frames and forms batches
+    whose padded size (batch size x longest sample in the bucket) stays within max_frames.
+    '''
+
+    def __init__(self, lengths, max_frames, bucket_width=8, shuffle=True, drop_last=False):
+        self.lengths = np.asarray(lengths)
+        self.max_frames = max_frames
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+        self.buckets = {}
+        for index, length in enumerate(self.lengths):
+            self.buckets.setdefault(int(length) // bucket_width, []).append(index)
+
+        self.batch_sizes = {}
+        for bucket, indices in self.buckets.items():
+            max_length = max(int(self.lengths[indices].max()), 1)
+            self.batch_sizes[bucket] = max(self.max_frames // max_length, 1)
+
+    def __iter__(self):
+        batches = []
+        for bucket, indices in sorted(self.buckets.items()):
+            indices = list(indices)
+            if self.shuffle:
+                random.shuffle(indices)
+            batch_size = self.batch_sizes[bucket]
+            for start in range(0, len(indices), batch_size):
+                batch = indices[start:start + batch_size]
+                if self.drop_last and len(batch) < batch_size:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        num_batches = 0
+        for bucket, indices in self.buckets.items():
+            if self.drop_last:
+                num_batches += len(indices) // self.batch_sizes[bucket]
+            else:
+                num_batches += math.ceil(len(indices) / self.batch_sizes[bucket])
+        return num_batches
+
+
+class ContiguousBatchSampler(Sampler):
+    '''
+    Yields batches of consecutive indices in shuffled batch order, so a dataset that reads row ranges
+    (HDF5Dataset) serves every batch with a single read. Use together with DataLoader(batch_size=None).
+    '''
+
+    def __init__(self, num_samples, batch_size, shuffle=True, drop_last=False):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        starts = list(range(0, len(self) * self.batch_size, self.batch_size))
+        if self.shuffle:
+            random.shuffle(starts)
+        for start in starts:
+            yield list(range(start, min(start + self.batch_size, self.num_samples)))
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return math.ceil(self.num_samples / self.batch_size)
+
+
+def trim_collate(batch):
+    # batch of (frames (C, T, H, W), length, target), frames are trimmed to the longest sample in the batch
+    frames, lengths, targets = default_collate(batch)
+    max_len = int(lengths.max())
+    frames = frames.narrow(2, 0, max_len).contiguous()
+    return frames, lengths, targets
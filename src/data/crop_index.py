@@ -0,0 +1,76 @@
+import argparse
+import os
+
+import numpy as np
+
+
+def parse_crop_file(path):
+    files, boxes = [], []
+    content = open(path, "r").read()
+    for line in content.splitlines():
+        file, crop_str = line.split(":")
+        crops = [[float(pos) for pos in crop.split(";")] for crop in crop_str.split("|")]
+        files.append(file)
+        boxes.append(np.array(crops, dtype=np.float32))
+    return files, boxes
+
+
+def write_crop_index(prefix, files, boxes):
+    lengths = np.array([len(crops) for crops in boxes], dtype=np.int32)
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)[:-1]
+    all_boxes = np.concatenate(boxes) if len(boxes) > 0 else np.zeros((0, 4))
+    np.save(f"{prefix}_boxes.npy", all_boxes.astype(np.float32))
+    np.savez(f"{prefix}_index.npz", files=np.array(files), offsets=offsets, lengths=lengths)
+
+
+def convert_crop_file(path):
+    assert path.endswith(".txt")
+    prefix = path[:-len(".txt")]
+    files, boxes = parse_crop_file(path)
+    write_crop_index(prefix, files, boxes)
+    print(f"Converted {len(files)} videos: {prefix}_boxes.npy")
+
+
+class CropIndex():
+    '''
+    Per frame mouth crop boxes of all videos in one split, e.g. data/preprocess/lrs2/train_crop.
+    Boxes are stored as a memory mapped (frames, 4) float32 array with per video offsets and lengths.
+    A legacy {prefix}.txt file is converted on first use.
+    '''
+
+    def __init__(self, prefix):
+        boxes_path = f"{prefix}_boxes.npy"
+        index_path = f"{prefix}_index.npz"
+        text_path = f"{prefix}.txt"
+        if os.path.exists(text_path):
+            if not os.path.exists(boxes_path) or os.path.getmtime(boxes_path) < os.path.getmtime(text_path):
+                convert_crop_file(text_path)
+
+        self.boxes = np.load(boxes_path, mmap_mode='r')
+        index = np.load(index_path)
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.ids = {file: i for i, file in enumerate(index['files'].tolist())}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, file):
+        return file in self.ids
+
+    def __getitem__(self, file):
+        i = self.ids[file]
+        offset = self.offsets[i]
+        return self.boxes[offset:offset + self.lengths[i]]
+
+    def num_frames(self, file):
+        return int(self.lengths[self.ids[file]])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+', help='*_crop.txt files to convert')
+    args = parser.parse_args()
+    for path in args.files:
+        convert_crop_file(path)
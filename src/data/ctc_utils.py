@@ -2,12 +2,13 @@ import torch
 from torch.utils.data.dataloader import default_collate
 
 
-def ctc_collate(batch):
+def ctc_collate(batch, trim=False):
     xs, ys, lens, indices = zip(*batch)
     x = default_collate(xs)
-    # slows training down
-    # max_len = max(lens)
-    # x = x.narrow(2, 0, max_len)
+    if trim:
+        # only worth it with length bucketed batches, see BucketBatchSampler
+        max_len = max(lens)
+        x = x.narrow(2, 0, max_len).contiguous()
     y = []
     for sub in ys:
         y += sub
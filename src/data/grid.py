@@ -3,12 +3,13 @@ import math
 import os
 import random
 
+import numpy as np
 import torch
 from PIL import Image
 from torch.utils.data import Dataset
-from torchvision import transforms
 
-from src.data.transforms import StatefulRandomHorizontalFlip
+from src.data.manifest import list_directories, load_manifest
+from src.data.transforms import ClipTransform
 
 
 def round(x):
@@ -26,7 +27,15 @@ class GRIDDataset(Dataset):
             'val': (24, 29),
             'test': (29, 34),
         }[mode]
-        self.file_list = self.build_file_list()
+        self.manifest_path = os.path.join(path, 'mouths', 'manifest.txt')
+        self.packed = os.path.exists(self.manifest_path)
+        self.transform = ClipTransform(
+            None,
+            mean=[0.7136, 0.4906, 0.3283],
+            std=[0.113855171, 0.107828568, 0.0917060521],
+            crop=None,
+            flip_probability=0.5 if augmentation else 0.0,
+        )
         self.dataset = []
 
         self.preprocess()
@@ -34,22 +43,9 @@ class GRIDDataset(Dataset):
         print(f'vocab = {"|".join(self.vocab)}')
 
     def preprocess(self):
-        vocab_unordered = {}
-        self.num_videos = 0
-        for video, align in self.file_list:
-            speaker = int(video.split("/")[-2][1:])
-            video = video.split("/")[-1][:-4]
-
-            self.num_videos += 1
-            sample = {'speaker': speaker, 'video': video, 'words': [], 'time_start': [], 'time_end': []}
-            for line in open(align, 'r').read().splitlines():
-                token = line.split(' ')
-                if token[2] != 'sil' and token[2] != 'sp':
-                    sample['words'].append(token[2])
-                    sample['time_start'].append(int(token[0]))
-                    sample['time_end'].append(int(token[1]))
-                    for char in token[2]:
-                        vocab_unordered[char] = True
+        videos, self.vocab = self.load_manifest()
+        self.num_videos = len(videos)
+        for sample in videos:
             for start in range(1, 7):
                 sample_i = sample.copy()
                 sample_i['mode'], sample_i['word_start'] = 1, start
@@ -63,10 +59,6 @@ class GRIDDataset(Dataset):
             sample_i['mode'] = 7
             self.dataset.append(sample_i)
 
-        self.vocab = [' ']
-        for char in vocab_unordered:
-            self.vocab.append(char)
-        self.vocab.sort()
         self.vocab_mapping = {' ': 0}
         for i, char in enumerate(self.vocab):
             self.vocab_mapping[char] = i + 1
@@ -74,6 +66,13 @@ class GRIDDataset(Dataset):
     def __len__(self):
         return len(self.dataset)
 
+    def sample_paths(self, idx):
+        data = self.dataset[idx]
+        video_path = os.path.join(self.path, 'mouths', 's' + str(data['speaker']), data['video'])
+        if self.packed:
+            return [f"{video_path}.npy"]
+        return ['{}/mouth_{:03d}.png'.format(video_path, frame) for frame in range(self.max_timesteps)]
+
     def __getitem__(self, idx):
         x = torch.zeros(3, self.max_timesteps, 40, 60)
         data = self.dataset[idx]
@@ -113,31 +112,57 @@ class GRIDDataset(Dataset):
             y.append(self.vocab_mapping[char])
 
         video_path = os.path.join(self.path, 'mouths', 's' + str(data['speaker']), data['video'])
-        x = torch.FloatTensor(3, frame_end - frame_start + 1, 40, 60)
-        if(self.augmentation):
-            augmentations = transforms.Compose([
-                StatefulRandomHorizontalFlip(0.5),
-            ])
+        if self.packed:
+            frames = np.load(f"{video_path}.npy", mmap_mode='r')[frame_start - 1:frame_end]
+            frames = torch.from_numpy(np.array(frames)).unsqueeze(-1).expand(-1, -1, -1, 3)  # (T, H, W, C)
         else:
-            augmentations = transforms.Compose([])
-
-        transform = transforms.Compose([
-            augmentations,
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.7136, 0.4906, 0.3283],
-                                 std=[0.113855171, 0.107828568, 0.0917060521])
-        ])
-        frame_count = 0
-        for frame_num in range(frame_start, frame_end + 1):
-            file = '{}/mouth_{:03d}.png'.format(video_path, frame_num - 1)
-            img = Image.open(file).convert('RGB')
-            img = transform(img)
-            x[:, frame_count, :, :] = img
-            frame_count += 1
+            frames = []
+            for frame_num in range(frame_start, frame_end + 1):
+                file = '{}/mouth_{:03d}.png'.format(video_path, frame_num - 1)
+                frames.append(np.asarray(Image.open(file).convert('RGB')))
+            frames = torch.from_numpy(np.stack(frames))
+        x = self.transform(frames).transpose(1, 0)  # (C, T, H, W)
 
         return x, y
 
+    def load_manifest(self):
+        if self.packed:
+            paths = [self.manifest_path, os.path.join(self.path, 'aligns')]
+        else:
+            paths = []
+            for directory in ['videos', 'mouths', 'aligns']:
+                paths += list_directories(os.path.join(self.path, directory))
+        params = {'path': os.path.abspath(self.path), 'speakers': self.speakers, 'packed': self.packed}
+        return load_manifest('grid', params, paths, self.build_manifest)
+
+    def build_manifest(self):
+        videos = []
+        vocab_unordered = {}
+        for video, align in self.build_file_list():
+            speaker = int(video.split("/")[-2][1:])
+            video = video.split("/")[-1][:-4]
+
+            sample = {'speaker': speaker, 'video': video, 'words': [], 'time_start': [], 'time_end': []}
+            for line in open(align, 'r').read().splitlines():
+                token = line.split(' ')
+                if token[2] != 'sil' and token[2] != 'sp':
+                    sample['words'].append(token[2])
+                    sample['time_start'].append(int(token[0]))
+                    sample['time_end'].append(int(token[1]))
+                    for char in token[2]:
+                        vocab_unordered[char] = True
+            videos.append(sample)
+
+        vocab = [' ']
+        for char in vocab_unordered:
+            vocab.append(char)
+        vocab.sort()
+        return videos, vocab
+
     def build_file_list(self):
+        if self.packed:
+            return self.build_packed_file_list()
+
         pattern = self.path + "/videos/**/*.mpg"
         all_files = glob.glob(pattern)
         files = []
@@ -156,3 +181,19 @@ class GRIDDataset(Dataset):
                 files.append(sample)
 
         return files
+
+    def build_packed_file_list(self):
+        files = []
+        content = open(self.manifest_path, 'r').read()
+        for line in content.splitlines():
+            video, num_frames = line.split(",")
+            speaker_dir, video_name = video.split("/")
+            speaker = int(speaker_dir[1:])
+            if speaker < self.speakers[0] or speaker >= self.speakers[1] or int(num_frames) != 75:
+                continue
+
+            file = os.path.join(self.path, 'videos', speaker_dir, video_name + '.mpg')
+            align = os.path.join(self.path, 'aligns', speaker_dir, video_name + '.align')
+            files.append((file, align))
+
+        return files
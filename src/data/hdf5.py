@@ -1,33 +1,124 @@
+import os
+
 import numpy as np
-import tables
 import torch
-from tables import open_file
+from tables import Filters, open_file
 from torch.utils.data import Dataset
 
+from src.data.transforms import DeviceClipTransform
+
+
+def create_table(file, name, description, expectedrows, sample_chunks=False):
+    '''
+    Table compressed with blosc:lz4, which decompresses faster than the disk reads.
+    With sample_chunks every row is its own chunk, a row with a whole uint8 clip is already large enough and
+    a sample is read without decompressing its neighbours.
+    '''
+    filters = Filters(complevel=5, complib='blosc:lz4', shuffle=True)
+    chunkshape = (1,) if sample_chunks else None
+    return file.create_table("/", name, description, expectedrows=expectedrows, filters=filters, chunkshape=chunkshape)
+
+
+def append_batch(table, batch):
+    # appends a DataLoader batch as one structured array instead of a row per sample and column, returns its size
+    rows = np.empty(len(batch[table.colnames[0]]), dtype=table.dtype)
+    for column in table.colnames:
+        values = batch[column]
+        if isinstance(values, torch.Tensor):
+            values = values.numpy()
+        rows[column] = np.asarray(values).reshape(rows[column].shape)
+    table.append(rows)
+    return len(rows)
+
 
 class HDF5Dataset(Dataset):
-    def __init__(self, path, table='train', columns=['frames', 'label'], query=None):
+    '''
+    Reads rows of a PyTables table. The file is opened lazily in every (worker) process.
+    Indexing with a list of indices (see ContiguousBatchSampler) returns a whole batch read with a single HDF5 read:
+
+        DataLoader(dataset, sampler=ContiguousBatchSampler(len(dataset), batch_size), batch_size=None)
+
+    A query like '(yaw >= -20) & (yaw < 20)' is resolved to row indices up front without loading any frames.
+
+    uint8 frames are normalized with the mean and std stored in the table attributes when they are read,
+    with uint8=True they are returned as they are and normalized by device_transform on the GPU.
+    '''
+
+    def __init__(self, path, table='train', columns=['frames', 'label'], query=None, uint8=False):
         self.path = path
+        self.table_name = table
         self.columns = columns
-        h5file = open_file(path, mode="r")
-        if query == None:
-            self.table = h5file.root[table]
-        else:
-            self.table = h5file.root[table].read_where(query)
+        self.file = None
+        self.pid = None
+
+        with open_file(path, mode="r") as h5file:
+            frames = h5file.root[table].coldtypes.get('frames')
+            self.normalize = None
+            self.device_transform = None
+            if frames is not None and frames.base == np.uint8:
+                attrs = h5file.root[table].attrs
+                self.normalize = DeviceClipTransform(list(attrs.mean), list(attrs.std))
+                if uint8:
+                    self.device_transform, self.normalize = self.normalize, None
+            else:
+                assert uint8 == False, f"{path} stores normalized frames, export it again for uint8"
+
+            if query == None:
+                self.rows = None
+                self.num_rows = h5file.root[table].nrows
+            else:
+                self.rows = h5file.root[table].get_where_list(query)
+                self.num_rows = len(self.rows)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['file'] = None
+        return state
+
+    @property
+    def table(self):
+        if self.file is None or self.pid != os.getpid():
+            self.file = open_file(self.path, mode="r")
+            self.pid = os.getpid()
+        return self.file.root[self.table_name]
 
     def __len__(self):
-        return len(self.table)
+        return self.num_rows
+
+    def read(self, indices):
+        rows = indices if self.rows is None else self.rows[indices]
+        if len(rows) > 0 and np.all(np.diff(rows) == 1):
+            return self.table.read(start=int(rows[0]), stop=int(rows[-1]) + 1)
+        return self.table.read_coordinates(rows)
 
     def __getitem__(self, idx):
-        row = self.table[idx]
-        sample = {}
-        for column in self.columns:
-            value = row[column]
-            if isinstance(value, np.ndarray):
-                value = torch.from_numpy(value).unsqueeze(0)
-            elif isinstance(value, np.int32):
-                value = torch.LongTensor([value])
-            else:
-                value = str(value)
-            sample[column] = value
+        if isinstance(idx, (list, np.ndarray)):
+            rows = self.read(np.asarray(idx, dtype=np.int64))
+            batch = {column: self.to_batch(rows[column]) for column in self.columns}
+            if self.normalize is not None and 'frames' in batch:
+                batch['frames'] = self.normalize(batch['frames'])
+            return batch
+
+        row = self.read(np.array([idx], dtype=np.int64))
+        sample = {column: self.to_sample(row[column][0]) for column in self.columns}
+        if self.normalize is not None and 'frames' in sample:
+            sample['frames'] = self.normalize(sample['frames'].unsqueeze(0))[0]
         return sample
+
+    def to_sample(self, value):
+        if isinstance(value, np.ndarray):
+            return torch.from_numpy(value).unsqueeze(0)
+        elif isinstance(value, np.integer):
+            return torch.LongTensor([value])
+        elif isinstance(value, np.floating):
+            return torch.FloatTensor([value])
+        elif isinstance(value, bytes):
+            return value.decode()
+        return str(value)
+
+    def to_batch(self, values):
+        if values.dtype.kind == 'S':
+            return [value.decode() for value in values]
+        elif values.dtype.kind in 'iu':
+            return torch.from_numpy(values.astype(np.int64)).unsqueeze(1)
+        return torch.from_numpy(values).unsqueeze(1)
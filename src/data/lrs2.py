@@ -1,180 +1,220 @@
+import io
 import math
 import os
 import random
 from string import ascii_lowercase
 
+import numpy as np
 import psutil
 import torch
-import torchvision
-import torchvision.transforms.functional as F
-from PIL import Image
 from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms
+from tqdm import tqdm
 
-from src.data.transforms import Crop, StatefulRandomHorizontalFlip
+from src.data.crop_index import CropIndex
+from src.data.manifest import load_manifest
+from src.data.transforms import ClipTransform
+from src.data.video import keyframe_index, read_video
+
+
+def load_pretrain_index(directory, crop_prefix, files):
+    '''
+    Word alignments (words and (N, 2) start/stop times) and keyframe times of the given pretrain videos.
+    Every video is demuxed once, the index is cached as manifest.
+    '''
+    def build():
+        index = {}
+        for file in tqdm(files, desc="Indexing pretrain videos"):
+            path = f"{directory}/mvlrs_v1/pretrain/{file}"
+            alignment = parse_alignment(open(path + ".txt", "r").read())
+            alignment['keyframes'], alignment['fps'] = keyframe_index(path + ".mp4")
+            index[file] = alignment
+        return index
+
+    params = {'path': os.path.abspath(directory), 'crops': os.path.abspath(crop_prefix)}
+    return load_manifest('lrs2_pretrain', params, [f"{directory}/pretrain.txt", f"{crop_prefix}_index.npz"], build)
+
+
+def parse_alignment(content):
+    words, times = [], []
+    for line in content.splitlines()[4:]:
+        word, start, stop, _ = line.split(" ")
+        words.append(word)
+        times.append([float(start), float(stop)])
+    return {'words': words, 'times': np.array(times, dtype=np.float64).reshape(-1, 2)}
+
+
+def sample_pretrain_words(alignment, num_words):
+    # random span of num_words consecutive words, returns the transcript and its start and stop time
+    words, times = alignment['words'], alignment['times']
+    num_words = min(num_words, len(words))
+    if num_words == 0:
+        return "", 0, 0
+
+    word_start = random.randint(0, len(words) - num_words)
+    word_end = word_start + num_words
+    sample_start = float(times[word_start, 0])
+    sample_end = float(times[word_start:word_end, 1].max())
+    return " ".join(words[word_start:word_end]), sample_start, sample_end
+
+
+def pretrain_span_frames(alignment, num_words):
+    # duration in frames of the longest span sample_pretrain_words can draw with up to num_words words
+    times = alignment['times']
+    num_words = min(num_words, len(times))
+    if num_words == 0:
+        return 0
+    num_spans = len(times) - num_words + 1
+    stops = times[:num_spans, 1]
+    for i in range(1, num_words):
+        stops = np.maximum(stops, times[i:i + num_spans, 1])
+    return float((stops - times[:num_spans, 0]).max() * alignment['fps'])
 
 
 class LRS2Dataset(Dataset):
-    def __init__(self, path, mode, in_channels=1, max_timesteps=100, max_text_len=200, pretrain_words=0, pretrain=False, augmentations=False):
+    def __init__(self, path, mode, in_channels=1, max_timesteps=100, max_text_len=200, pretrain_words=0, pretrain=False, augmentations=False, uint8=False, cache=None, index=True, gray8=False):
+        # index=False only decodes shard records with from_record, without the file list, crop boxes and alignments
         assert mode in ['train', 'val', 'test']
         self.max_timesteps = max_timesteps
+        self.uint8 = uint8
+        self.cache = cache
         self.pretrain = pretrain
         self.in_channels = in_channels
+        self.pixel_format = 'gray8' if in_channels == 1 and gray8 else 'rgb24'  # see LRWDataset
         self.max_timesteps = max_timesteps
         self.augmentations = augmentations if mode in ['train', 'pretrain'] else False
         self.skip_long_samples = True
         self.max_text_len = max_text_len
         self.pretrain_words = pretrain_words
-        self.file_paths, self.file_names, self.crops = self.build_file_list(path, mode)
+        self.file_paths, self.file_names, self.transcripts, self.crops = [], [], [], None
+        if index:
+            self.file_paths, self.file_names, self.transcripts, self.crops = self.build_file_list(path, mode)
+        self.pretrain_index = None
+        if self.pretrain and index:
+            self.pretrain_index = load_pretrain_index(path, "data/preprocess/lrs2/pretrain_crop", self.file_names)
         self.dictionary = self.build_dictionary(path)
         self.char_list = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T',
                           'U', 'V', 'W', 'X', 'Y', 'Z', '1', '2', '3', '4', '5', '6', '7', '8',  '9', '0', '<sos>', '<eos>', '<pad>', '\'', ' ']
         self.int2char = dict(enumerate(self.char_list))
         self.char2int = {char: index for index, char in self.int2char.items()}
 
+        flip_probability = 0.5 if self.augmentations else 0.0
+        if self.in_channels == 1:
+            self.transform = ClipTransform((64, 96), [0.4161, ], [0.1688, ], crop='boxes', grayscale=True, flip_probability=flip_probability, normalize=not uint8)
+        elif self.in_channels == 3:
+            self.transform = ClipTransform((64, 96), [0.485, 0.456, 0.406], [0.229, 0.224, 0.225], crop='boxes', flip_probability=flip_probability, normalize=not uint8)
+        self.device_transform = self.transform.device_transform
+
     def build_dictionary(self, directory):
-        dictionary = set()
-        file = open(f"{directory}/train.txt", "r")
-        for file in file.readlines():
-            file = file.split(" ")[0].strip()
-            path = f"{directory}/mvlrs_v1/main/{file}.txt"
-            content = open(path, "r").read()
-            sentence = content.splitlines()[0][7:]
-            words = sentence.split(" ")
-            dictionary.update(words)
-        return list(dictionary)
+        def build():
+            dictionary = set()
+            file = open(f"{directory}/train.txt", "r")
+            for file in file.readlines():
+                file = file.split(" ")[0].strip()
+                path = f"{directory}/mvlrs_v1/main/{file}.txt"
+                content = open(path, "r").read()
+                sentence = content.splitlines()[0][7:]
+                words = sentence.split(" ")
+                dictionary.update(words)
+            return sorted(dictionary)
 
-    def build_file_list(self, directory, mode):
-        file_list, paths = [], []
-        crops = {}
-        skipped_samples = 0
+        params = {'path': os.path.abspath(directory)}
+        return load_manifest('lrs2_dictionary', params, [f"{directory}/train.txt"], build)
 
+    def build_file_list(self, directory, mode):
         if self.pretrain:
-            path = f"data/preprocess/lrs2/pretrain_crop.txt"
+            crop_prefix = f"data/preprocess/lrs2/pretrain_crop"
+            split_path = f"{directory}/pretrain.txt"
         else:
-            path = f"data/preprocess/lrs2/{mode}_crop.txt"
+            crop_prefix = f"data/preprocess/lrs2/{mode}_crop"
+            split_path = f"{directory}/{mode}.txt"
+        crops = CropIndex(crop_prefix)
 
-        file = open(path, "r")
-        content = file.read()
-        for i, line in enumerate(content.splitlines()):
-            split = line.split(":")
-            file = split[0]
-            crop_str = split[1]
-            crops[file] = crop_str
+        def build():
+            file_list, paths, transcripts = [], [], []
+            skipped_samples = 0
 
-        if self.pretrain:
-            file = open(f"{directory}/pretrain.txt", "r")
-            content = file.read()
-            for file in content.splitlines():
-                if file in crops:
-                    file_list.append(file)
-                    paths.append(f"{directory}/mvlrs_v1/pretrain/{file}")
-        else:
-            file = open(f"{directory}/{mode}.txt", "r")
-            content = file.read()
-            for file in content.splitlines():
-                file = file.split(" ")[0]
-                if file not in crops:
-                    continue
-
-                if self.skip_long_samples:
-                    if crops[file].count("|") < self.max_timesteps:
+            if self.pretrain:
+                file = open(split_path, "r")
+                content = file.read()
+                for file in content.splitlines():
+                    if file in crops:
                         file_list.append(file)
-                        paths.append(f"{directory}/mvlrs_v1/main/{file}")
-                    else:
+                        paths.append(f"{directory}/mvlrs_v1/pretrain/{file}")
+                        transcripts.append(None)  # word alignments are sampled per item
+            else:
+                file = open(split_path, "r")
+                content = file.read()
+                for file in content.splitlines():
+                    file = file.split(" ")[0]
+                    if file not in crops:
+                        continue
+
+                    if self.skip_long_samples and crops.num_frames(file) > self.max_timesteps:
                         skipped_samples += 1
-                else:
+                        continue
                     file_list.append(file)
                     paths.append(f"{directory}/mvlrs_v1/main/{file}")
+                    transcripts.append(open(paths[-1] + ".txt", "r").read().splitlines()[0][7:])
+            return paths, file_list, transcripts, skipped_samples
+
+        params = {
+            'path': os.path.abspath(directory),
+            'mode': mode,
+            'pretrain': self.pretrain,
+            'max_timesteps': self.max_timesteps,
+            'skip_long_samples': self.skip_long_samples,
+        }
+        paths, file_list, transcripts, skipped_samples = load_manifest('lrs2', params, [split_path, f"{crop_prefix}_index.npz"], build)
 
         if self.skip_long_samples:
             print(f"Skipped {skipped_samples} too long samples")
-        return paths, file_list, crops
+        return paths, file_list, transcripts, crops
 
     def build_tensor(self, frames, crops):
-        crops = [crop.split(";") for crop in crops]
-        for i, crop_frame in enumerate(crops):
-            crop = [float(crop) for crop in crop_frame]
-            crops[i] = crop
-
-        if(self.augmentations):
-            augmentations = transforms.Compose([
-                StatefulRandomHorizontalFlip(0.5),
-            ])
-        else:
-            augmentations = transforms.Compose([])
-
-        temporalVolume = torch.zeros(self.max_timesteps, self.in_channels, 64, 96)
-        for i, frame in enumerate(frames):
-            if self.in_channels == 1:
-                transform = transforms.Compose([
-                    transforms.ToPILImage(),
-                    Crop(crops[i]),
-                    augmentations,
-                    transforms.Grayscale(num_output_channels=1),
-                    transforms.ToTensor(),
-                    transforms.Normalize([0.4161, ], [0.1688, ]),
-                ])
-            elif self.in_channels == 3:
-                transform = transforms.Compose([
-                    transforms.ToPILImage(),
-                    Crop(crops[i]),
-                    augmentations,
-                    transforms.ToTensor(),
-                    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-                ])
-
-            temporalVolume[i] = transform(frame)
-
+        dtype = torch.uint8 if self.uint8 else torch.float
+        temporalVolume = torch.zeros(self.max_timesteps, self.in_channels, 64, 96, dtype=dtype)
+        temporalVolume[:len(frames)] = self.transform(frames, crops)
         temporalVolume = temporalVolume.transpose(1, 0)  # (C, D, H, W)
         return temporalVolume
 
     def __len__(self):
         return len(self.file_paths)
 
-    def get_pretrain_words(self, content):
+    def frame_lengths(self):
+        if self.pretrain:
+            # longest word span get_pretrain_words can draw at this curriculum stage, so a batch stays within max_frames
+            spans = [pretrain_span_frames(self.pretrain_index[file], self.pretrain_words) for file in self.file_names]
+            return [min(int(math.floor(frames)) + 1, self.max_timesteps) for frames in spans]
+        return [min(self.crops.num_frames(file), self.max_timesteps) for file in self.file_names]
+
+    def get_pretrain_words(self, alignment):
         assert self.pretrain_words > 0
+        num_words = random.randint(max(self.pretrain_words - 1, 1), self.pretrain_words)
+        return sample_pretrain_words(alignment, num_words)
+
+    def sample_paths(self, idx):
+        return [self.file_paths[idx] + ".mp4"]
 
-        lines = content.splitlines()[4:]
-        words = []
-        for line in lines:
-            word, start, stop, _ = line.split(" ")
-            start, stop = float(start), float(stop)
-            words.append([word, start, stop])
-
-        num_words = min(random.randint(max(self.pretrain_words - 1, 1), self.pretrain_words), len(words))
-        word_start = random.randint(0, len(words) - num_words)
-        word_end = word_start + num_words
-
-        sample_start = 0
-        sample_end = 0
-        content = ""
-        for word in words[word_start:word_end]:
-            word, start, end = word
-            if sample_start == 0:
-                sample_start = start
-            if end > sample_end:
-                sample_end = end
-            content = content + " " + word
-
-        return content, sample_start, sample_end
+    def load_video(self, path, start_sec=0, stop_sec=None, keyframes=None):
+        source = io.BytesIO(self.cache.read(path)) if self.cache is not None else path
+        return read_video(source, format=self.pixel_format, start_sec=start_sec, end_sec=stop_sec, keyframes=keyframes)
 
     def __getitem__(self, idx):
         file = self.file_names[idx]
         file_path = self.file_paths[idx]
-        content = open(file_path + ".txt", "r").read()
 
-        frame_crops = self.crops[file].split("|")
-        start_sec = 0
-        stop_sec = None
         if self.pretrain:
-            content, start_sec, stop_sec = self.get_pretrain_words(content)
+            alignment = self.pretrain_index[file]
+            content, start_sec, stop_sec = self.get_pretrain_words(alignment)
+            video = self.load_video(file_path + ".mp4", start_sec, stop_sec, keyframes=alignment['keyframes'])  # T, H, W, C
+            start_frame = int(start_sec * alignment['fps'])
         else:
-            content = content.splitlines()[0][7:]
-            crop = frame_crops
+            content = self.transcripts[idx]
+            video = self.load_video(file_path + ".mp4")  # T, H, W, C
+            start_frame = None
+        return self.build_sample(file, video, self.crops[file], content, start_frame)
 
-        video, _, info = torchvision.io.read_video(file_path + ".mp4", start_pts=start_sec, end_pts=stop_sec, pts_unit='sec')  # T, H, W, C
-        video = video.permute(0, 3, 1, 2)  # T C H W
+    def build_sample(self, file, video, frame_crops, content, start_frame=None):
         num_frames = video.size(0)
 
         if num_frames > self.max_timesteps:
@@ -182,13 +222,13 @@ class LRS2Dataset(Dataset):
             video = video[:self.max_timesteps]
             num_frames = video.size(0)
 
-        if self.pretrain:
-            fps = info['video_fps']
-            start_frame = int(start_sec * fps)
+        if start_frame is None:
+            crop = frame_crops
+        else:
             crop = frame_crops[start_frame:start_frame + num_frames]
 
         crop = crop[:self.max_timesteps]
-        assert num_frames <= self.max_timesteps, f"Video too large with {num_frames} frames: {file_path}"
+        assert num_frames <= self.max_timesteps, f"Video too large with {num_frames} frames: {file}"
         content = content.strip().upper()
 
         assert len(crop) == num_frames
@@ -198,6 +238,40 @@ class LRS2Dataset(Dataset):
         encoded = self.encode(content)
         return frames, num_frames, encoded
 
+    def record_meta(self, idx):
+        return {'frames': self.crops.num_frames(self.file_names[idx])}
+
+    def select_record(self, record):
+        # whether from_record keeps a shard record, long samples are only dropped outside of pretraining
+        return self.pretrain or not self.skip_long_samples or int(record['frames']) <= self.max_timesteps
+
+    def to_record(self, idx):
+        file = self.file_names[idx]
+        record = {
+            'file': file,
+            'mp4': open(self.file_paths[idx] + ".mp4", "rb").read(),
+            'txt': open(self.file_paths[idx] + ".txt", "r").read(),
+            'boxes.npy': np.array(self.crops[file]),
+        }
+        if self.pretrain:
+            record['fps'] = self.pretrain_index[file]['fps']
+        return record
+
+    def from_record(self, record):
+        # sample from a shard written by src.preprocess.lrs2.preprocess_shards
+        frame_crops = record['boxes.npy']
+        if self.pretrain:
+            content, start_sec, stop_sec = self.get_pretrain_words(parse_alignment(record['txt']))
+            video = read_video(io.BytesIO(record['mp4']), format=self.pixel_format, start_sec=start_sec, end_sec=stop_sec)
+            start_frame = int(start_sec * float(record['fps']))
+        else:
+            if not self.select_record({'frames': len(frame_crops)}):
+                return None
+            content = record['txt'].splitlines()[0][7:]
+            video = read_video(io.BytesIO(record['mp4']), format=self.pixel_format)
+            start_frame = None
+        return self.build_sample(record['file'], video, frame_crops, content, start_frame)
+
     def encode(self, content):
         encoded = [self.char2int[c] for c in content] + [self.char2int['<eos>']]
         if len(encoded) > self.max_text_len:
@@ -1,3 +1,4 @@
+import io
 import math
 import os
 import random
@@ -5,145 +6,124 @@ from string import ascii_lowercase
 
 import psutil
 import torch
-import torchvision
-import torchvision.transforms.functional as F
-from PIL import Image
 from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms
 from tqdm import tqdm
 
-from src.data.transforms import Crop
+from src.data.crop_index import CropIndex
+from src.data.lrs2 import (load_pretrain_index, parse_alignment,
+                           pretrain_span_frames, sample_pretrain_words)
+from src.data.manifest import load_manifest
+from src.data.transforms import ClipTransform
+from src.data.video import read_video
 
 
 class LRS2CTCDataset(Dataset):
-    def __init__(self, path, in_channels=1, mode="train", augmentations=False, estimate_pose=False, max_timesteps=155, pretrain_words=0):
+    # blank_char = "-"
+    characters = " '" + ascii_lowercase + "".join([str(i) for i in range(10)])
+    # characters = blank_char + special_characters + ascii_lowercase + numbers
+
+    def __init__(self, path, in_channels=1, mode="train", augmentations=False, estimate_pose=False, max_timesteps=155, pretrain_words=0, uint8=False, cache=None, index=True, gray8=False):
+        # index=False only decodes shard records with from_record, without the file list, crop boxes and alignments
         self.max_timesteps = max_timesteps
+        self.uint8 = uint8
+        self.cache = cache
         self.pretrain = mode == "pretrain"
         self.in_channels = in_channels
+        self.pixel_format = 'gray8' if in_channels == 1 and gray8 else 'rgb24'  # see LRWDataset
         self.estimate_pose = estimate_pose
         self.max_timesteps = max_timesteps
         self.pretrain_words = pretrain_words
         self.augmentation = augmentations if mode == 'train' or mode == "pretrain" else False
-        self.file_paths, self.file_names, self.crops = self.build_file_list(path, mode)
+        self.file_paths, self.file_names, self.transcripts, self.crops = [], [], [], None
+        if index:
+            self.file_paths, self.file_names, self.transcripts, self.crops = self.build_file_list(path, mode)
+        self.pretrain_index = None
+        if self.pretrain and index:
+            self.pretrain_index = load_pretrain_index(path, f"data/preprocess/lrs2/{mode}_crop", self.file_names)
 
-        # blank_char = "-"
-        numbers = "".join([str(i) for i in range(10)])
-        special_characters = " '"
-        self.characters = special_characters + ascii_lowercase + numbers
-        # self.characters = blank_char + special_characters + ascii_lowercase + numbers
         int2char = dict(enumerate(self.characters))
         self.char2int = {char: index for index, char in int2char.items()}
 
-    def build_file_list(self, directory, mode):
-        file_list, paths = [], []
-        crops = {}
-
-        file = open(f"data/preprocess/lrs2/{mode}_crop.txt", "r")
-        content = file.read()
-        for i, line in enumerate(content.splitlines()):
-            split = line.split(":")
-            file = split[0]
-            crop_str = split[1]
-            crops[file] = crop_str
-
-        if self.pretrain:
-            file = open(f"{directory}/pretrain.txt", "r")
-            content = file.read()
-            for file in content.splitlines():
-                if file in crops:
-                    file_list.append(file)
-                    paths.append(f"{directory}/mvlrs_v1/pretrain/{file}")
-        else:
-            file = open(f"{directory}/{mode}.txt", "r")
-            content = file.read()
-            for file in content.splitlines():
-                file = file.split(" ")[0]
-                if file in crops:
-                    file_list.append(file)
-                    paths.append(f"{directory}/mvlrs_v1/main/{file}")
+        flip_probability = 0.5 if self.augmentation else 0.0
+        if self.in_channels == 1:
+            self.transform = ClipTransform((64, 96), [0.4161, ], [0.1688, ], crop='boxes', grayscale=True, flip_probability=flip_probability, normalize=not uint8)
+        elif self.in_channels == 3:
+            self.transform = ClipTransform((64, 96), [0.485, 0.456, 0.406], [0.229, 0.224, 0.225], crop='boxes', flip_probability=flip_probability, normalize=not uint8)
+        self.device_transform = self.transform.device_transform
 
-        return paths, file_list, crops
+    def build_file_list(self, directory, mode):
+        crop_prefix = f"data/preprocess/lrs2/{mode}_crop"
+        split_path = f"{directory}/pretrain.txt" if self.pretrain else f"{directory}/{mode}.txt"
+        crops = CropIndex(crop_prefix)
+
+        def build():
+            file_list, paths, transcripts = [], [], []
+            if self.pretrain:
+                file = open(split_path, "r")
+                content = file.read()
+                for file in content.splitlines():
+                    if file in crops:
+                        file_list.append(file)
+                        paths.append(f"{directory}/mvlrs_v1/pretrain/{file}")
+                        transcripts.append(None)  # word alignments are sampled per item
+            else:
+                file = open(split_path, "r")
+                content = file.read()
+                for file in content.splitlines():
+                    file = file.split(" ")[0]
+                    if file in crops:
+                        file_list.append(file)
+                        paths.append(f"{directory}/mvlrs_v1/main/{file}")
+                        transcripts.append(open(paths[-1] + ".txt", "r").read().splitlines()[0][7:])
+            return paths, file_list, transcripts
+
+        params = {'path': os.path.abspath(directory), 'mode': mode, 'pretrain': self.pretrain}
+        paths, file_list, transcripts = load_manifest('lrs2_ctc', params, [split_path, f"{crop_prefix}_index.npz"], build)
+        return paths, file_list, transcripts, crops
 
     def build_tensor(self, frames, crops):
-        crops = [crop.split(";") for crop in crops]
-        for i, crop_frame in enumerate(crops):
-            crop = [float(crop) for crop in crop_frame]
-            crops[i] = crop
-
-        temporalVolume = torch.zeros(self.max_timesteps, self.in_channels, 64, 96)
-        if(self.augmentation):
-            augmentations = transforms.Compose([])  # TODO
-        else:
-            augmentations = transforms.Compose([])
-
-        for i, frame in enumerate(frames):
-            if self.in_channels == 1:
-                transform = transforms.Compose([
-                    transforms.ToPILImage(),
-                    Crop(crops[i]),
-                    augmentations,
-                    transforms.Grayscale(num_output_channels=1),
-                    transforms.ToTensor(),
-                    transforms.Normalize([0.4161, ], [0.1688, ]),
-                ])
-            elif self.in_channels == 3:
-                transform = transforms.Compose([
-                    transforms.ToPILImage(),
-                    Crop(crops[i]),
-                    augmentations,
-                    transforms.ToTensor(),
-                    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-                ])
-
-            temporalVolume[i] = transform(frame)
-
+        dtype = torch.uint8 if self.uint8 else torch.float
+        temporalVolume = torch.zeros(self.max_timesteps, self.in_channels, 64, 96, dtype=dtype)
+        temporalVolume[:len(frames)] = self.transform(frames, crops)
         temporalVolume = temporalVolume.transpose(1, 0)  # (C, D, H, W)
         return temporalVolume
 
     def __len__(self):
         return len(self.file_paths)
 
-    def get_pretrain_words(self, content):
-        lines = content.splitlines()[4:]
-        words = []
-        for line in lines:
-            word, start, stop, _ = line.split(" ")
-            start, stop = float(start), float(stop)
-            words.append([word, start, stop])
-
-        num_words = min(random.randint(1, self.pretrain_words), len(words))
-        word_start = random.randint(0, len(words) - num_words)
-        word_end = word_start + num_words
-
-        sample_start = 0
-        sample_end = 0
-        content = ""
-        for word in words[word_start:word_end]:
-            word, start, end = word
-            if sample_start == 0:
-                sample_start = start
-            if end > sample_end:
-                sample_end = end
-            content = content + " " + word
-
-        return content.strip(), sample_start, sample_end
+    def frame_lengths(self):
+        if self.pretrain:
+            # longest word span get_pretrain_words can draw at this curriculum stage, so a batch stays within max_frames
+            spans = [pretrain_span_frames(self.pretrain_index[file], self.pretrain_words) for file in self.file_names]
+            return [min(int(math.floor(frames)) + 1, self.max_timesteps) for frames in spans]
+        return [min(self.crops.num_frames(file), self.max_timesteps) for file in self.file_names]
+
+    def get_pretrain_words(self, alignment):
+        return sample_pretrain_words(alignment, random.randint(1, self.pretrain_words))
+
+    def sample_paths(self, idx):
+        return [self.file_paths[idx] + ".mp4"]
+
+    def load_video(self, path, start_sec=0, stop_sec=None, keyframes=None):
+        source = io.BytesIO(self.cache.read(path)) if self.cache is not None else path
+        return read_video(source, format=self.pixel_format, start_sec=start_sec, end_sec=stop_sec, keyframes=keyframes)
 
     def __getitem__(self, idx):
         file = self.file_names[idx]
         file_path = self.file_paths[idx]
-        content = open(file_path + ".txt", "r").read()
 
-        frame_crops = self.crops[file].split("|")
-        start_sec = 0
-        stop_sec = None
         if self.pretrain:
-            content, start_sec, stop_sec = self.get_pretrain_words(content)
+            alignment = self.pretrain_index[file]
+            content, start_sec, stop_sec = self.get_pretrain_words(alignment)
+            video = self.load_video(file_path + ".mp4", start_sec, stop_sec, keyframes=alignment['keyframes'])  # T, H, W, C
+            start_frame = int(start_sec * alignment['fps'])
         else:
-            content = content.splitlines()[0][7:]
-            crop = frame_crops
+            content = self.transcripts[idx]
+            video = self.load_video(file_path + ".mp4")  # T, H, W, C
+            start_frame = None
+        return self.build_sample(file, video, self.crops[file], content, start_frame, idx)
 
-        video, _, info = torchvision.io.read_video(file_path + ".mp4", start_pts=start_sec, end_pts=stop_sec, pts_unit='sec')  # T, H, W, C
-        video = video.permute(0, 3, 1, 2)  # T C H W
+    def build_sample(self, file, video, frame_crops, content, start_frame=None, idx=-1):
         num_frames = video.size(0)
 
         if num_frames > self.max_timesteps:
@@ -151,15 +131,28 @@ class LRS2CTCDataset(Dataset):
             video = video[:self.max_timesteps]
             num_frames = video.size(0)
 
-        if self.pretrain:
-            fps = info['video_fps']
-            start_frame = int(start_sec * fps)
+        if start_frame is None:
+            crop = frame_crops
+        else:
             crop = frame_crops[start_frame:start_frame + num_frames]
 
-        assert num_frames <= self.max_timesteps, f"Video too large with {num_frames} frames: {file_path}"
+        assert num_frames <= self.max_timesteps, f"Video too large with {num_frames} frames: {file}"
         content = content.lower()
 
         assert len(crop) == num_frames
         frames = self.build_tensor(video, crop)
         encoded = [self.char2int[char] for char in content]
         return frames, encoded, num_frames, idx
+
+    def from_record(self, record):
+        # sample from a shard written by src.preprocess.lrs2.preprocess_shards, streamed samples have no index
+        frame_crops = record['boxes.npy']
+        if self.pretrain:
+            content, start_sec, stop_sec = self.get_pretrain_words(parse_alignment(record['txt']))
+            video = read_video(io.BytesIO(record['mp4']), format=self.pixel_format, start_sec=start_sec, end_sec=stop_sec)
+            start_frame = int(start_sec * float(record['fps']))
+        else:
+            content = record['txt'].splitlines()[0][7:]
+            video = read_video(io.BytesIO(record['mp4']), format=self.pixel_format)
+            start_frame = None
+        return self.build_sample(record['file'], video, frame_crops, content, start_frame)
@@ -2,71 +2,85 @@ import os
 from glob import glob
 
 import torch
-import torchvision
 from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms
 
 from src.data.charset import get_charSet, init_charSet
+from src.data.crop_index import CropIndex
+from src.data.manifest import load_manifest
+from src.data.transforms import ClipTransform
+from src.data.video import read_video
 
 
 class LRS2Dataset(Dataset):
-    def __init__(self, path, mode, max_timesteps=100, max_text_len=100):
-        self.file_paths = self.build_file_list(path, mode)
+    def __init__(self, path, mode, max_timesteps=100, max_text_len=100, gray8=False):
+        self.mode = mode
+        self.pixel_format = 'gray8' if gray8 else 'rgb24'  # see LRWDataset
+        self.file_paths, self.transcripts = self.build_file_list(path, mode)
         self.max_timesteps = max_timesteps
         self.max_text_len = max_text_len
+        self.transform = ClipTransform((120, 120), [0.4161, ], [0.1688, ], grayscale=True)
 
     def __len__(self):
         return len(self.file_paths)
 
+    def frame_lengths(self):
+        prefix = f"data/preprocess/lrs2/{self.mode}_crop"
+        if not os.path.exists(f"{prefix}.txt") and not os.path.exists(f"{prefix}_boxes.npy"):
+            return [self.max_timesteps for _ in self.file_paths]
+
+        crops = CropIndex(prefix)
+        lengths = []
+        for path in self.file_paths:
+            file = path.split("mvlrs_v1/main/")[-1]
+            num_frames = crops.num_frames(file) if file in crops else self.max_timesteps
+            lengths.append(min(num_frames, self.max_timesteps))
+        return lengths
+
     def __getitem__(self, idx):
         video, length = self.videoProcess(self.file_paths[idx])
-        return video, length, txtProcess(self.file_paths[idx] + ".txt", self.max_text_len)
+        return video, length, txtEncode(self.transcripts[idx], self.max_text_len)
 
     def build_file_list(self, directory, mode):
-        paths = []
-
-        file = open(f"{directory}/{mode}.txt", "r")
-        content = file.read()
-        for file in content.splitlines():
-            file = file.split(" ")[0]
-            paths.append(f"{directory}/mvlrs_v1/main/{file}")
-
-        return paths
+        split_path = f"{directory}/{mode}.txt"
+
+        def build():
+            paths, transcripts = [], []
+            file = open(split_path, "r")
+            content = file.read()
+            for file in content.splitlines():
+                file = file.split(" ")[0]
+                paths.append(f"{directory}/mvlrs_v1/main/{file}")
+                with open(paths[-1] + ".txt") as f:
+                    transcripts.append(f.readline().split(':')[1].strip())
+            return paths, transcripts
+
+        params = {'path': os.path.abspath(directory), 'mode': mode}
+        return load_manifest('lrs_wls', params, [split_path], build)
 
     def build_tensor(self, frames):
         temporalVolume = torch.zeros(self.max_timesteps, 1, 120, 120)
-        for i, frame in enumerate(frames):
-            transform = transforms.Compose([
-                transforms.ToPILImage(),
-                transforms.CenterCrop((120, 120)),
-                transforms.Grayscale(num_output_channels=1),
-                transforms.ToTensor(),
-                transforms.Normalize([0.4161, ], [0.1688, ]),
-            ])
-            temporalVolume[i] = transform(frame)
-
+        temporalVolume[:len(frames)] = self.transform(frames)
         temporalVolume = temporalVolume.transpose(1, 0)  # (C, D, H, W)
         return temporalVolume
 
     def videoProcess(self, path):
-        video, _, info = torchvision.io.read_video(path + ".mp4", pts_unit='sec')  # T, H, W, C
-        video = video.permute(0, 3, 1, 2)[:self.max_timesteps]  # T C H W
-
-        if len(video) > self.max_timesteps:
-            print(f"Cutting off frames: {path}")
-            video = video[:self.max_timesteps]
+        # longer videos are cut off at max_timesteps while decoding
+        video = read_video(path + ".mp4", format=self.pixel_format, num_frames=self.max_timesteps)  # T, H, W, C
         frames = self.build_tensor(video)
 
-        return frames, frames.size(0)
+        return frames, video.size(0)
 
 
 def txtProcess(dir, max_text_len):
-    encoded = []
     with open(dir) as f:
-        encoded = [get_charSet().get_index_of(i) for i in f.readline().split(':')[1].strip()] + [get_charSet().get_index_of('<eos>')]
-        if len(encoded) > max_text_len:
-            print(f'too short txt max length. Required: {len(encoded)}')
-            encoded = encoded[:max_text_len]
-        else:
-            encoded += [get_charSet().get_index_of('<pad>') for _ in range(max_text_len - len(encoded))]
+        return txtEncode(f.readline().split(':')[1].strip(), max_text_len)
+
+
+def txtEncode(text, max_text_len):
+    encoded = [get_charSet().get_index_of(i) for i in text] + [get_charSet().get_index_of('<eos>')]
+    if len(encoded) > max_text_len:
+        print(f'too short txt max length. Required: {len(encoded)}')
+        encoded = encoded[:max_text_len]
+    else:
+        encoded += [get_charSet().get_index_of('<pad>') for _ in range(max_text_len - len(encoded))]
     return torch.Tensor(encoded)
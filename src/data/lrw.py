@@ -1,126 +1,143 @@
+import io
 import os
 import random
 
 import torch
-import torchvision
-import torchvision.transforms.functional as F
-from PIL import Image
 from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms
 
-from src.data.transforms import StatefulRandomHorizontalFlip
+from src.data.manifest import load_manifest
+from src.data.pose_index import PoseIndex
+from src.data.transforms import ClipTransform
+from src.data.video import read_video
 
 
 def build_word_list(directory, num_words, seed):
-    random.seed(seed)
     words = os.listdir(directory)
-    words.sort()
+    return select_words(words, num_words, seed)
+
+
+def select_words(words, num_words, seed):
+    random.seed(seed)
+    words = sorted(words)
     random.shuffle(words)
     words = words[:num_words]
     return words
 
 
 class LRWDataset(Dataset):
-    def __init__(self, path, num_words=500, in_channels=1, mode="train", augmentations=False, estimate_pose=False, seed=42, query=None):
+    def __init__(self, path, num_words=500, in_channels=1, mode="train", augmentations=False, estimate_pose=False, seed=42, query=None, uint8=False, cache=None, gray8=False):
         self.seed = seed
+        self.cache = cache
         self.num_words = num_words
         self.in_channels = in_channels
         self.query = query
         self.augmentation = augmentations if mode == 'train' else False
-        self.poses = None
+        self.pose_index = None
         if estimate_pose == False:
-            self.poses = self.head_poses(mode, query)
+            self.pose_index = PoseIndex(f"data/preprocess/lrw/{mode}")
         self.video_paths, self.files, self.labels, self.words = self.build_file_list(path, mode)
+        self.word_labels = {word: i for i, word in enumerate(self.words)}
         self.estimate_pose = estimate_pose
-
-    def head_poses(self, mode, query):
-        poses = {}
-        yaw_file = open(f"data/preprocess/lrw/{mode}.txt", "r")
-        content = yaw_file.read()
-        for line in content.splitlines():
-            file, yaw = line.split(",")
-            yaw = float(yaw)
-            if query == None or (query[0] <= yaw and query[1] > yaw):
-                poses[file] = yaw
-        return poses
+        # gray8 decodes the luma plane, faster but not the same pixels as the rgb24 grayscale of existing checkpoints
+        self.pixel_format = 'gray8' if in_channels == 1 and gray8 and not estimate_pose else 'rgb24'
+        flip_probability = 0.5 if self.augmentation else 0.0
+        if self.in_channels == 1:
+            self.transform = ClipTransform((112, 112), [0.4161, ], [0.1688, ], grayscale=True, flip_probability=flip_probability, normalize=not uint8)
+        elif self.in_channels == 3:
+            self.transform = ClipTransform((112, 112), [0.485, 0.456, 0.406], [0.229, 0.224, 0.225], flip_probability=flip_probability, normalize=not uint8)
+        self.device_transform = self.transform.device_transform
 
     def build_file_list(self, directory, mode):
         words = build_word_list(directory, self.num_words, seed=self.seed)
         print(words)
-        paths = []
-        file_list = []
-        labels = []
-        for i, word in enumerate(words):
-            dirpath = directory + "/{}/{}".format(word, mode)
-            files = os.listdir(dirpath)
-            for file in files:
-                if file.endswith("mp4"):
-                    if self.poses != None and file not in self.poses:
-                        continue
-                    path = dirpath + "/{}".format(file)
-                    file_list.append(file)
-                    paths.append(path)
-                    labels.append(i)
-
+        if self.pose_index != None:
+            rows, labels = self.pose_index.select(words, self.query)
+            file_list = self.pose_index.files[rows].tolist()
+            paths = [f"{directory}/{words[label]}/{mode}/{file}" for file, label in zip(file_list, labels)]
+            self.yaws = self.pose_index.yaws[rows]
+            return paths, file_list, labels.tolist(), words
+
+        def build():
+            paths = []
+            file_list = []
+            labels = []
+            for i, word in enumerate(words):
+                dirpath = directory + "/{}/{}".format(word, mode)
+                files = os.listdir(dirpath)
+                for file in files:
+                    if file.endswith("mp4"):
+                        path = dirpath + "/{}".format(file)
+                        file_list.append(file)
+                        paths.append(path)
+                        labels.append(i)
+            return paths, file_list, labels
+
+        params = {'path': os.path.abspath(directory), 'mode': mode, 'words': words}
+        word_dirs = [directory + "/{}/{}".format(word, mode) for word in words]
+        paths, file_list, labels = load_manifest('lrw', params, word_dirs, build)
         return paths, file_list, labels, words
 
     def build_tensor(self, frames):
-        temporalVolume = torch.FloatTensor(29, self.in_channels, 112, 112)
-        if(self.augmentation):
-            augmentations = transforms.Compose([
-                StatefulRandomHorizontalFlip(0.5),
-            ])
-        else:
-            augmentations = transforms.Compose([])
-
-        if self.in_channels == 1:
-            transform = transforms.Compose([
-                transforms.ToPILImage(),
-                transforms.CenterCrop((112, 112)),
-                augmentations,
-                transforms.Grayscale(num_output_channels=1),
-                transforms.ToTensor(),
-                transforms.Normalize([0.4161, ], [0.1688, ]),
-            ])
-        elif self.in_channels == 3:
-            transform = transforms.Compose([
-                transforms.ToPILImage(),
-                transforms.CenterCrop((112, 112)),
-                augmentations,
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-            ])
-
-        for i in range(0, 29):
-            frame = frames[i].permute(2, 0, 1)  # (C, H, W)
-            temporalVolume[i] = transform(frame)
-
+        temporalVolume = self.transform(frames[:29])  # (D, C, H, W)
         temporalVolume = temporalVolume.transpose(1, 0)  # (C, D, H, W)
         return temporalVolume
 
     def __len__(self):
         return len(self.video_paths)
 
+    def sample_paths(self, idx):
+        return [self.video_paths[idx]]
+
+    def load_video(self, path):
+        source = io.BytesIO(self.cache.read(path)) if self.cache is not None else path
+        return read_video(source, format=self.pixel_format)  # (Tensor[T, H, W, C])
+
     def __getitem__(self, idx):
-        label = self.labels[idx]
-        file = self.files[idx]
-        video, _, _ = torchvision.io.read_video(self.video_paths[idx], pts_unit='sec')  # (Tensor[T, H, W, C])
+        video = self.load_video(self.video_paths[idx])
+        yaw = 0 if self.estimate_pose else self.yaws[idx]
+        return self.build_sample(video, self.labels[idx], self.files[idx], yaw)
+
+    def build_sample(self, video, label, file, yaw):
         if self.estimate_pose:
             angle_frame = video[14].permute(2, 0, 1)
         else:
             angle_frame = 0
         frames = self.build_tensor(video)
-        if self.estimate_pose:
-            yaw = 0
-        else:
-            yaw = self.poses[file]
 
         sample = {
             'frames': frames,
             'label': torch.LongTensor([label]),
             'word': self.words[label],
-            'file': self.files[idx],
+            'file': file,
             'yaw': torch.FloatTensor([yaw]),
             'angle_frame': angle_frame,
         }
         return sample
+
+    def record_meta(self, idx):
+        return {
+            'word': self.words[self.labels[idx]],
+            'yaw': float('nan') if self.estimate_pose else float(self.yaws[idx]),
+        }
+
+    def to_record(self, idx):
+        return {
+            'mp4': open(self.video_paths[idx], 'rb').read(),
+            'file': self.files[idx],
+            **self.record_meta(idx),
+        }
+
+    def select_record(self, record):
+        # whether a record of a shard written with all 500 words belongs to the words and query of this dataset
+        if record['word'] not in self.word_labels:
+            return False
+        yaw = float(record['yaw'])
+        return self.query == None or (self.query[0] <= yaw and self.query[1] > yaw)
+
+    def from_record(self, record):
+        # sample from a shard written with all 500 words, see src.data.shards
+        if not self.select_record(record):
+            return None
+        yaw = float(record['yaw'])
+        video = read_video(io.BytesIO(record['mp4']), format=self.pixel_format)
+        return self.build_sample(video, self.word_labels[record['word']], record['file'], 0 if self.estimate_pose else yaw)
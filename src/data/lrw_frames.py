@@ -0,0 +1,77 @@
+import math
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from src.data.lrw import select_words
+from src.data.transforms import DeviceClipTransform
+
+
+class LRWFramesDataset(Dataset):
+    """
+    Reads pre-decoded LRW clips from the uint8 shards written by src.preprocess.lrw.preprocess_frames.
+    Each shard holds (N, 29, 112, 112) center-cropped grayscale frames; a sample is a single slice.
+    """
+
+    def __init__(self, path, num_words=500, mode="train", augmentations=False, seed=42, query=None, uint8=False):
+        self.path = path
+        self.mode = mode
+        self.augmentation = augmentations if mode == 'train' else False
+        self.uint8 = uint8
+        self.device_transform = None
+        if uint8:
+            self.device_transform = DeviceClipTransform([0.4161, ], [0.1688, ], flip_probability=0.5 if self.augmentation else 0.0)
+
+        index = np.load(f"{path}/{mode}.npz")
+        all_words = list(index['words'])
+        self.words = select_words(all_words, num_words, seed)
+        print(self.words)
+
+        word_labels = {word: i for i, word in enumerate(self.words)}
+        remap = np.array([word_labels.get(word, -1) for word in all_words])
+        labels = remap[index['labels']]
+        yaws = index['yaws']
+        mask = labels >= 0
+        if query != None:
+            mask &= (query[0] <= yaws) & (query[1] > yaws)
+
+        self.indices = np.nonzero(mask)[0]
+        self.labels = labels[self.indices]
+        self.files = index['files'][self.indices]
+        self.yaws = yaws[self.indices]
+        self.shard_size = int(index['shard_size'])
+        self.num_shards = math.ceil(len(index['labels']) / self.shard_size)
+        self.shards = {}
+
+    def shard(self, shard_id):
+        # copy-on-write mapping keeps the slices zero-copy and writable for torch.from_numpy
+        if shard_id not in self.shards:
+            self.shards[shard_id] = np.load(f"{self.path}/{self.mode}_{shard_id:03d}.npy", mmap_mode='c')
+        return self.shards[shard_id]
+
+    def build_tensor(self, frames):
+        if self.uint8:
+            return frames.unsqueeze(0)  # (C, D, H, W) uint8
+        temporalVolume = frames.float().div_(255).sub_(0.4161).div_(0.1688)
+        if self.augmentation and random.random() < 0.5:
+            temporalVolume = temporalVolume.flip(-1)
+        return temporalVolume.unsqueeze(0)  # (C, D, H, W)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        shard_id, offset = divmod(int(self.indices[idx]), self.shard_size)
+        frames = torch.from_numpy(self.shard(shard_id)[offset])  # (D, H, W)
+        label = int(self.labels[idx])
+
+        sample = {
+            'frames': self.build_tensor(frames),
+            'label': torch.LongTensor([label]),
+            'word': self.words[label],
+            'file': str(self.files[idx]),
+            'yaw': torch.FloatTensor([self.yaws[idx]]),
+        }
+        return sample
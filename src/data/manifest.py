@@ -0,0 +1,47 @@
+import hashlib
+import os
+import pickle
+
+MANIFEST_DIR = "data/cache/manifests"
+
+
+def list_directories(path, depth=1):
+    # path and its subdirectories up to depth levels, used to detect added or removed files
+    directories = [path]
+    if depth > 0 and os.path.isdir(path):
+        for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+            if entry.is_dir():
+                directories += list_directories(entry.path, depth - 1)
+    return directories
+
+
+def modification_times(paths):
+    return [(path, os.path.getmtime(path) if os.path.exists(path) else None) for path in paths]
+
+
+def load_manifest(name, params, paths, build):
+    '''
+    Returns the result of build(), cached as a pickle in data/cache/manifests.
+    The manifest is keyed by name and params (dataset root, split, ...) and is rebuilt
+    when the modification time of any of the given files or directories changes.
+    '''
+    key = hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()[:16]
+    manifest_path = os.path.join(MANIFEST_DIR, f"{name}_{key}.pkl")
+    mtimes = modification_times(paths)
+
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, "rb") as file:
+                manifest = pickle.load(file)
+            if manifest['mtimes'] == mtimes:
+                return manifest['data']
+        except (EOFError, pickle.UnpicklingError):
+            pass
+
+    data = build()
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    temp_path = f"{manifest_path}.{os.getpid()}"
+    with open(temp_path, "wb") as file:
+        pickle.dump({'params': params, 'mtimes': mtimes, 'data': data}, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, manifest_path)
+    return data
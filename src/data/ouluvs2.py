@@ -1,19 +1,19 @@
 import glob
+import io
 import os
 
 import torch
-import torchvision
-import torchvision.transforms.functional as F
-from PIL import Image
 from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms
 
-from src.data.transforms import StatefulRandomHorizontalFlip
+from src.data.manifest import list_directories, load_manifest
+from src.data.transforms import ClipTransform
+from src.data.video import read_video
 
 
 class OuluVS2Dataset(Dataset):
-    def __init__(self, path, mode='train', augmentation=False):
+    def __init__(self, path, mode='train', augmentation=False, cache=None):
         self.path = path
+        self.cache = cache
         self.augmentation = augmentation
         self.max_timesteps = 38
         self.speakers = {
@@ -34,6 +34,13 @@ class OuluVS2Dataset(Dataset):
             "Have a good time",
             "You are welcome",
         ]
+        self.transform = ClipTransform(
+            (100, 120),
+            mean=[0.7136, 0.4906, 0.3283],
+            std=[0.113855171, 0.107828568, 0.0917060521],
+            crop='resize',
+            flip_probability=0.5 if augmentation else 0.0,
+        )
         self.preprocess()
         print(f'{mode}: samples = {len(self.file_list)}, vocab_size = {len(self.vocab)}')
         print(f'vocab = {"|".join(self.vocab)}')
@@ -62,17 +69,21 @@ class OuluVS2Dataset(Dataset):
             self.vocab_mapping[char] = i + 1
 
     def build_file_list(self):
-        videos = []
         video_path = self.path + 'cropped_mouth_mp4_phrase'
-        pattern = video_path + "/**/*.mp4"
-        files = glob.glob(pattern, recursive=True)
-        max_frames = 0
-        for file in files:
-            split = file.split("/")[-1][:-4].split("_")
-            speaker = int(split[0][1:])
-            if speaker >= self.speakers[0] and speaker < self.speakers[1]:
-                videos.append(file)
-        return videos
+
+        def build():
+            videos = []
+            pattern = video_path + "/**/*.mp4"
+            files = glob.glob(pattern, recursive=True)
+            for file in files:
+                split = file.split("/")[-1][:-4].split("_")
+                speaker = int(split[0][1:])
+                if speaker >= self.speakers[0] and speaker < self.speakers[1]:
+                    videos.append(file)
+            return videos
+
+        params = {'path': os.path.abspath(video_path), 'speakers': self.speakers}
+        return load_manifest('ouluvs2', params, list_directories(video_path, depth=2), build)
 
     def load_utterance(self, speaker, utterance):
         y = []
@@ -95,27 +106,10 @@ class OuluVS2Dataset(Dataset):
     def __getitem__(self, idx):
         path = self.file_list[idx]
         x = torch.zeros(3, self.max_timesteps, 100, 120)
-        frames, _, _ = torchvision.io.read_video(path)
-
-        if(self.augmentation):
-            augmentations = transforms.Compose([
-                StatefulRandomHorizontalFlip(0.5),
-            ])
-        else:
-            augmentations = transforms.Compose([])
-
-        transform = transforms.Compose([
-            transforms.ToPILImage(),
-            transforms.Resize((100, 120)),
-            augmentations,
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.7136, 0.4906, 0.3283],
-                                 std=[0.113855171, 0.107828568, 0.0917060521])
-        ])
-
-        for i, frame in enumerate(frames):
-            img = transform(frame)
-            x[:, i, :, :] = img
+        source = io.BytesIO(self.cache.read(path)) if self.cache is not None else path
+        frames = read_video(source)
+
+        x[:, :frames.size(0)] = self.transform(frames).transpose(1, 0)
 
         split = path.split("/")[-1][:-4].split("_")
         speaker, view, utterance = [int(x[1:]) for x in split]
@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+
+
+def parse_pose_file(path):
+    files, yaws = [], []
+    content = open(path, "r").read()
+    for line in content.splitlines():
+        file, yaw = line.split(",")
+        files.append(file)
+        yaws.append(float(yaw))
+    return files, yaws
+
+
+def write_pose_index(path, files, yaws):
+    yaws = np.array(yaws, dtype=np.float64)
+    order = np.argsort(yaws, kind='stable')
+    files = np.array(files)[order]
+    sample_words = [file.rsplit("_", 1)[0] for file in files]
+    words = sorted(set(sample_words))
+    word_ids = {word: i for i, word in enumerate(words)}
+    np.savez(
+        path,
+        yaws=yaws[order],
+        files=files,
+        word_ids=np.array([word_ids[word] for word in sample_words], dtype=np.int16),
+        words=np.array(words),
+    )
+
+
+class PoseIndex():
+    '''
+    Head pose yaws of all LRW samples in one split, e.g. data/preprocess/lrw/train.
+    Samples are stored sorted by yaw, so a yaw range is resolved with two binary searches.
+    The {prefix}.txt file written by extract_angles is converted to {prefix}_pose.npz on first use.
+    '''
+
+    def __init__(self, prefix):
+        index_path = f"{prefix}_pose.npz"
+        text_path = f"{prefix}.txt"
+        if os.path.exists(text_path):
+            if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(text_path):
+                files, yaws = parse_pose_file(text_path)
+                write_pose_index(index_path, files, yaws)
+
+        index = np.load(index_path)
+        self.yaws = index['yaws']
+        self.files = index['files']
+        self.word_ids = index['word_ids']
+        self.words = index['words'].tolist()
+
+    def __len__(self):
+        return len(self.yaws)
+
+    def query(self, query=None):
+        # indices of all samples with query[0] <= yaw < query[1]
+        if query == None:
+            return np.arange(len(self.yaws))
+        start, stop = np.searchsorted(self.yaws, query, side='left')
+        return np.arange(start, max(start, stop))
+
+    def select(self, words, query=None):
+        '''
+        Returns the indices of the samples of the given words within the yaw range and their labels,
+        the position of the sample's word in words. Samples are ordered by label and file name.
+        '''
+        rows = self.query(query)
+        word_labels = np.full(len(self.words), -1, dtype=np.int64)
+        for label, word in enumerate(words):
+            if word in self.words:
+                word_labels[self.words.index(word)] = label
+
+        labels = word_labels[self.word_ids[rows]]
+        rows, labels = rows[labels >= 0], labels[labels >= 0]
+        order = np.lexsort((self.files[rows], labels))
+        return rows[order], labels[order]
@@ -0,0 +1,111 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from torch.utils.data import Sampler
+
+
+class ReadaheadSampler(Sampler):
+    '''
+    Wraps a sampler or batch sampler and reads the files of the next depth samples in a small thread pool,
+    so the DataLoader workers find them in the page cache (or the VideoCache) and only wait on decoding.
+    A batch of a batch sampler counts as its number of samples. The dataset maps an index to its files with sample_paths(idx).
+
+    With a cache the files are read into it, otherwise the kernel is asked to read them ahead with
+    posix_fadvise(WILLNEED), or they are read and dropped with read_bytes=True (network file systems).
+    At most max_bytes of files are ahead of the sampler, counted from their size when they are submitted,
+    so reads still in flight are part of the budget. The next item waits until there is room, unless nothing is ahead.
+    An item is a hit when all of its files were prefetched before it was yielded.
+    '''
+
+    def __init__(self, sampler, dataset, depth=64, max_bytes=1024 * 1024 * 1024, threads=4, cache=None, read_bytes=False):
+        self.sampler = sampler
+        self.dataset = dataset
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.threads = threads
+        self.cache = cache
+        self.read_bytes = read_bytes or not hasattr(os, 'posix_fadvise')
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.sampler)
+
+    @staticmethod
+    def indices(item):
+        return item if isinstance(item, (list, tuple)) else [item]
+
+    def paths(self, item):
+        return [path for idx in self.indices(item) for path in self.dataset.sample_paths(int(idx))]
+
+    @staticmethod
+    def file_size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def prefetch(self, path):
+        try:
+            if self.cache is not None:
+                self.cache.read(path, record=False)  # the workers' reads count as hits, not the prefetch
+                return
+            with open(path, 'rb') as file:
+                if self.read_bytes:
+                    while file.read(1024 * 1024):
+                        pass
+                else:
+                    os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass  # the worker reports missing or broken files when it loads the sample
+
+    def __iter__(self):
+        iterator = iter(self.sampler)
+        pending = deque()  # (item, samples, bytes, futures)
+        upcoming = None  # (item, paths, sizes) of the next item, waits for room in depth and max_bytes
+        ahead_samples = 0
+        ahead_bytes = 0
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            try:
+                while True:
+                    while True:
+                        if upcoming is None:
+                            item = next(iterator, None)
+                            if item is None:
+                                break
+                            paths = self.paths(item)
+                            upcoming = (item, paths, [self.file_size(path) for path in paths])
+                        item, paths, sizes = upcoming
+                        num_samples, num_bytes = len(self.indices(item)), sum(sizes)
+                        if pending and (ahead_samples + num_samples > self.depth or ahead_bytes + num_bytes > self.max_bytes):
+                            break
+                        pending.append((item, num_samples, num_bytes, [pool.submit(self.prefetch, path) for path in paths]))
+                        ahead_samples += num_samples
+                        ahead_bytes += num_bytes
+                        upcoming = None
+                    if not pending:
+                        break
+
+                    item, num_samples, num_bytes, futures = pending.popleft()
+                    ahead_samples -= num_samples
+                    ahead_bytes -= num_bytes
+                    hit = all(future.done() for future in futures)
+                    with self.lock:
+                        if hit:
+                            self.hits += 1
+                        else:
+                            self.misses += 1
+                    yield item
+            finally:
+                # an interrupted epoch must not wait for the files read ahead of it
+                for _, _, _, futures in pending:
+                    for future in futures:
+                        future.cancel()
+
+    def stats(self):
+        with self.lock:
+            return {'readahead_hits': self.hits, 'readahead_misses': self.misses}
@@ -0,0 +1,239 @@
+import io
+import json
+import os
+import random
+import tarfile
+import time
+
+import numpy as np
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
+from tqdm import tqdm
+
+
+def encode_field(value):
+    if isinstance(value, bytes):
+        return value
+    elif isinstance(value, np.ndarray):
+        buffer = io.BytesIO()
+        np.save(buffer, value)
+        return buffer.getvalue()
+    return str(value).encode()
+
+
+def decode_field(field, data):
+    # npy fields are arrays, video fields stay bytes and everything else is text
+    if field.endswith("npy"):
+        return np.load(io.BytesIO(data))
+    elif field.endswith("mp4") or field.endswith("mpg"):
+        return data
+    return data.decode()
+
+
+class ShardWriter():
+    '''
+    Packs records (dicts of field name to bytes, str, number or np.ndarray) into tar files of about max_bytes,
+    {prefix}_00000.tar, {prefix}_00001.tar, ... and lists them with their sample counts in {prefix}.json.
+    The meta fields passed to write are kept per shard in {prefix}.json as well, see ShardDataset's select.
+    on_close(shard, count, meta) is called whenever a shard is complete.
+    '''
+
+    def __init__(self, prefix, max_bytes=256 * 1024 * 1024, on_close=None):
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.on_close = on_close
+        self.shards = []
+        self.counts = []
+        self.meta = []  # per shard {field: [value per record]}
+        self.tar = None
+        self.size = 0
+        os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+
+    def next_shard(self):
+        self.close_shard()
+        path = f"{self.prefix}_{len(self.shards):05d}.tar"
+        self.tar = tarfile.open(path, "w")
+        self.shards.append(os.path.basename(path))
+        self.counts.append(0)
+        self.meta.append({})
+        self.size = 0
+
+    def close_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+            if self.on_close is not None:
+                self.on_close(self.shards[-1], self.counts[-1], self.meta[-1])
+
+    def write(self, key, record, meta=None):
+        if self.tar is None or self.size >= self.max_bytes:
+            self.next_shard()
+        mtime = time.time()
+        for field, value in record.items():
+            data = encode_field(value)
+            info = tarfile.TarInfo(f"{key}.{field}")
+            info.size = len(data)
+            info.mtime = mtime
+            self.tar.addfile(info, io.BytesIO(data))
+            self.size += len(data)
+        self.counts[-1] += 1
+        for field, value in (meta or {}).items():
+            self.meta[-1].setdefault(field, []).append(value)
+
+    def close(self):
+        self.close_shard()
+        with open(f"{self.prefix}.json", "w") as file:
+            json.dump({'shards': self.shards, 'counts': self.counts, 'meta': self.meta}, file)
+
+
+class RecordDataset(Dataset):
+    def __init__(self, dataset, order):
+        self.dataset = dataset
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, idx):
+        return self.dataset.to_record(int(self.order[idx]))
+
+
+def list_collate(batch):
+    return batch
+
+
+def completed_shards(journal, num_samples):
+    # the consecutive shards of the journal that were written for a dataset of the same size
+    shards = []
+    for record in journal.entries():
+        if record['key'] != f"{record['prefix']}_{len(shards):05d}.tar" or record['num_samples'] != num_samples:
+            break
+        shards.append(record)
+    return shards
+
+
+def write_shards(dataset, prefix, workers=0, seed=42, max_bytes=256 * 1024 * 1024, journal=None):
+    '''
+    Writes all samples of a dataset implementing to_record(idx) into tar shards, see ShardDataset.
+    Samples are written in random order, so every shard holds a mix of all classes.
+    The dataset's record_meta(idx), if it has one, is stored in the shard index for ShardDataset's select.
+    With a journal (src.preprocess.journal) every complete shard is recorded and a resumed run continues after the last one.
+    '''
+    def record_shard(shard, count, meta):
+        journal.record(
+            shard,
+            output=os.path.join(os.path.dirname(prefix), shard),
+            count=count,
+            meta=meta,
+            end=index,
+            num_samples=len(dataset),
+            prefix=os.path.basename(prefix),
+        )
+
+    writer = ShardWriter(prefix, max_bytes=max_bytes, on_close=record_shard if journal is not None else None)
+    order = np.random.RandomState(seed).permutation(len(dataset))
+    index = 0
+    if journal is not None:
+        shards = completed_shards(journal, len(dataset))
+        writer.shards = [record['key'] for record in shards]
+        writer.counts = [record['count'] for record in shards]
+        writer.meta = [record.get('meta', {}) for record in shards]
+        index = shards[-1]['end'] if len(shards) > 0 else 0
+    record_meta = getattr(dataset, 'record_meta', None)
+    data_loader = DataLoader(RecordDataset(dataset, order[index:]), batch_size=16, shuffle=False, num_workers=workers, collate_fn=list_collate)
+    with tqdm(total=len(dataset), initial=index) as progress:
+        for batch in data_loader:
+            for record in batch:
+                meta = record_meta(int(order[index])) if record_meta is not None else None
+                writer.write(f"{index:09d}", record, meta)
+                index += 1
+                progress.update(1)
+    writer.close()
+    print(f"Wrote {index} samples into {len(writer.shards)} shards: {prefix}_*.tar")
+
+
+def selected_count(meta, count, select):
+    # records of a shard that select accepts, all of them for shards written without meta
+    if len(meta) == 0:
+        return count
+    fields = list(meta.keys())
+    return sum(1 for values in zip(*meta.values()) if select(dict(zip(fields, values))))
+
+
+class ShardDataset(IterableDataset):
+    '''
+    Streams the records of the tar shards written by ShardWriter sequentially and decodes them with decode,
+    usually the from_record method of the dataset that wrote them. decode may return None to skip a record.
+    Every DataLoader worker reads its own subset of the shuffled shards and shuffles samples within a buffer.
+
+    select(meta) tells from the meta fields of a record (see write_shards) whether decode keeps it, e.g. the
+    select_record method of the dataset. The length is then the number of selected records and shards without
+    any of them are not read.
+    '''
+
+    def __init__(self, prefix, decode, shuffle=True, buffer_size=1000, select=None):
+        self.directory = os.path.dirname(prefix)
+        self.decode = decode
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size if shuffle else 0
+
+        with open(f"{prefix}.json", "r") as file:
+            index = json.load(file)
+        counts = index['counts']
+        if select is not None and 'meta' in index:
+            counts = [selected_count(meta, count, select) for meta, count in zip(index['meta'], counts)]
+        self.shards = [os.path.join(self.directory, shard) for shard, count in zip(index['shards'], counts) if count > 0]
+        self.num_samples = sum(counts)
+
+    def __len__(self):
+        # exact with select, otherwise an upper bound as decode may skip records
+        return self.num_samples
+
+    def worker_shards(self):
+        shards = list(self.shards)
+        worker_info = get_worker_info()
+        if worker_info is None:
+            if self.shuffle:
+                random.shuffle(shards)
+            return shards, random.Random()
+
+        # all workers share the shard order of an epoch: worker seeds are base_seed + worker id
+        epoch_seed = worker_info.seed - worker_info.id
+        if self.shuffle:
+            random.Random(epoch_seed).shuffle(shards)
+        return shards[worker_info.id::worker_info.num_workers], random.Random(worker_info.seed)
+
+    def records(self, shards):
+        for shard in shards:
+            record, record_key = {}, None
+            with tarfile.open(shard, mode="r|") as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    key, field = member.name.split(".", 1)
+                    if key != record_key and record_key is not None:
+                        yield record
+                        record = {}
+                    record_key = key
+                    record[field] = decode_field(field, tar.extractfile(member).read())
+            if record_key is not None:
+                yield record
+
+    def __iter__(self):
+        shards, rng = self.worker_shards()
+        buffer = []
+        for record in self.records(shards):
+            if len(buffer) < self.buffer_size:
+                buffer.append(record)
+                continue
+            if self.buffer_size > 0:
+                i = rng.randrange(len(buffer))
+                record, buffer[i] = buffer[i], record
+            sample = self.decode(record)
+            if sample is not None:
+                yield sample
+
+        rng.shuffle(buffer)
+        for record in buffer:
+            sample = self.decode(record)
+            if sample is not None:
+                yield sample
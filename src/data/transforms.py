@@ -1,5 +1,8 @@
 import random
 
+import numpy as np
+import torch
+import torch.nn.functional as nn_functional
 import torchvision.transforms.functional as F
 
 
@@ -23,3 +26,115 @@ class Crop(object):
 
     def __call__(self, img):
         return img.crop(self.crop)
+
+
+def center_crop_clip(clip, size):
+    # clip: (T, H, W, C)
+    height, width = clip.shape[1:3]
+    top = int(round((height - size[0]) / 2.))
+    left = int(round((width - size[1]) / 2.))
+    return clip[:, top:top + size[0], left:left + size[1]]
+
+
+def crop_clip(clip, boxes, size):
+    # Same semantics as PIL's crop: box corners are rounded half to even and areas outside of the frame are black
+    num_frames, height, width = clip.shape[:3]
+    boxes = torch.from_numpy(np.array(boxes, dtype=np.float64))[:num_frames]
+    left = boxes[:, 0].round().long()
+    upper = boxes[:, 1].round().long()
+
+    rows = upper.unsqueeze(1) + torch.arange(size[0])  # (T, h)
+    cols = left.unsqueeze(1) + torch.arange(size[1])  # (T, w)
+    frames = torch.arange(num_frames).view(-1, 1, 1)
+    cropped = clip[frames, rows.clamp(0, height - 1).unsqueeze(2), cols.clamp(0, width - 1).unsqueeze(1)]
+
+    valid = ((rows >= 0) & (rows < height)).unsqueeze(2) & ((cols >= 0) & (cols < width)).unsqueeze(1)
+    if not valid.all():
+        cropped[~valid] = 0
+    return cropped
+
+
+def grayscale_clip(clip):
+    # ITU-R 601-2 luma transform with the same fixed point arithmetic as PIL's convert('L')
+    if clip.size(-1) == 1:
+        return clip  # decoded as gray8
+    clip = clip.int()
+    gray = (clip[..., 0] * 19595 + clip[..., 1] * 38470 + clip[..., 2] * 7471 + 0x8000) >> 16
+    return gray.to(torch.uint8).unsqueeze(-1)
+
+
+def resize_clip(clip, size):
+    # clip: (T, C, H, W), bilinear without PIL's antialiasing
+    resized = nn_functional.interpolate(clip.float(), size=size, mode='bilinear', align_corners=False)
+    return resized.round_().clamp_(0, 255).to(torch.uint8)
+
+
+def normalize_clip(clip, mean, std):
+    # clip: (T, C, H, W) uint8
+    mean = torch.tensor(mean).view(1, -1, 1, 1)
+    std = torch.tensor(std).view(1, -1, 1, 1)
+    return clip.float().div_(255).sub_(mean).div_(std)
+
+
+class ClipTransform():
+    '''
+    Vectorized replacement for the per frame ToPILImage -> Crop -> Grayscale -> ToTensor -> Normalize pipelines.
+    Takes a uint8 clip (T, H, W, C) and returns a normalized float clip (T, C, H, W).
+
+    crop: 'center' for a center crop of size, 'boxes' for per frame crop boxes, 'resize' or None
+    normalize: with False the cropped uint8 clip is returned, flip and normalization are left to device_transform
+    '''
+
+    def __init__(self, size, mean, std, crop='center', grayscale=False, flip_probability=0.0, normalize=True):
+        assert crop in [None, 'center', 'boxes', 'resize']
+        self.size = size
+        self.mean = mean
+        self.std = std
+        self.crop = crop
+        self.grayscale = grayscale
+        self.flip_probability = flip_probability
+        self.normalize = normalize
+        self.device_transform = None if normalize else DeviceClipTransform(mean, std, flip_probability)
+
+    def __call__(self, clip, boxes=None):
+        if self.crop == 'center':
+            clip = center_crop_clip(clip, self.size)
+        elif self.crop == 'boxes':
+            clip = crop_clip(clip, boxes, self.size)
+        if self.grayscale:
+            clip = grayscale_clip(clip)
+        clip = clip.permute(0, 3, 1, 2)
+        if self.crop == 'resize':
+            clip = resize_clip(clip, self.size)
+        if not self.normalize:
+            return clip
+        if self.flip_probability > 0 and random.random() < self.flip_probability:
+            clip = clip.flip(-1)
+        return normalize_clip(clip, self.mean, self.std)
+
+
+class DeviceClipTransform():
+    '''
+    Flip and normalization of a batch of uint8 clips (B, C, T, H, W) after it was moved to the GPU.
+    Every clip is flipped as a whole with flip_probability. Frames past lengths are zero like the padding of the float path.
+    '''
+
+    def __init__(self, mean, std, flip_probability=0.0):
+        self.mean = mean
+        self.std = std
+        self.flip_probability = flip_probability
+
+    def __call__(self, clips, lengths=None):
+        mean = torch.tensor(self.mean, device=clips.device).view(1, -1, 1, 1, 1)
+        std = torch.tensor(self.std, device=clips.device).view(1, -1, 1, 1, 1)
+        clips = clips.float().div_(255).sub_(mean).div_(std)
+
+        if self.flip_probability > 0:
+            flip = torch.rand(clips.size(0), device=clips.device) < self.flip_probability
+            clips = torch.where(flip.view(-1, 1, 1, 1, 1), clips.flip(-1), clips)
+
+        if lengths is not None:
+            timesteps = torch.arange(clips.size(2), device=clips.device)
+            padding = timesteps.view(1, -1) >= lengths.to(clips.device).view(-1, 1)  # (B, T)
+            clips = clips.masked_fill(padding.view(clips.size(0), 1, -1, 1, 1), 0)
+        return clips
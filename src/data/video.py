@@ -0,0 +1,191 @@
+import argparse
+import time
+
+import av
+import numpy as np
+import torch
+
+BACKENDS = ['pyav', 'opencv', 'torchvision']
+FORMATS = ['gray8', 'rgb24']
+
+# limited range luma (16-235) of yuv420p to the full range of PIL's convert('L')
+LIMITED_TO_FULL_RANGE = np.clip(np.round((np.arange(256) - 16) * 255 / 219), 0, 255).astype(np.uint8)
+
+
+def keyframe_index(path):
+    '''
+    Returns the presentation times in seconds of all keyframes of a video and its frame rate.
+    Only packets are demuxed, no frame is decoded.
+    '''
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        fps = float(stream.average_rate)
+        keyframes = []
+        for packet in container.demux(stream):
+            if packet.is_keyframe and packet.pts is not None:
+                keyframes.append(float(packet.pts * stream.time_base))
+    return np.array(sorted(keyframes), dtype=np.float64), fps
+
+
+def luma_plane(frame):
+    # the Y plane of a planar yuv frame is the grayscale image, no color conversion needed
+    name = frame.format.name
+    if not (name.startswith('yuv') or name.startswith('nv')):
+        return frame.to_ndarray(format='gray8')
+    plane = frame.planes[0]
+    luma = np.frombuffer(plane, np.uint8).reshape(-1, plane.line_size)[:frame.height, :frame.width]
+    if name.startswith('yuvj'):
+        return luma.copy()
+    return LIMITED_TO_FULL_RANGE[luma]
+
+
+def frame_array(frame, format):
+    return luma_plane(frame) if format == 'gray8' else frame.to_ndarray(format='rgb24')
+
+
+def stack_frames(frames, height, width, format):
+    channels = 1 if format == 'gray8' else 3
+    if len(frames) == 0:
+        return torch.zeros(0, height, width, channels, dtype=torch.uint8)
+    return torch.from_numpy(np.stack(frames).reshape(len(frames), height, width, channels))
+
+
+def open_stream(container, threads):
+    stream = container.streams.video[0]
+    stream.codec_context.thread_type = 'AUTO'
+    stream.codec_context.thread_count = threads
+    return stream
+
+
+def read_pyav(path, format, start_sec, end_sec, num_frames, keyframes, threads):
+    with av.open(path) as container:
+        stream = open_stream(container, threads)
+        time_base = stream.time_base
+
+        if keyframes is not None and start_sec > 0:
+            keyframe = np.searchsorted(keyframes, start_sec, side='right') - 1
+            if keyframe > 0:
+                container.seek(int(round(keyframes[keyframe] / time_base)), backward=True, any_frame=False, stream=stream)
+
+        frames = []
+        for frame in container.decode(stream):
+            if frame.pts is None:
+                continue
+            time = float(frame.pts * time_base)
+            if time < start_sec:
+                continue
+            if end_sec is not None and time > end_sec:
+                break
+            frames.append(frame_array(frame, format))
+            if num_frames is not None and len(frames) >= num_frames:
+                break
+        return stack_frames(frames, stream.height, stream.width, format)
+
+
+def read_opencv(path, format, start_sec, end_sec, num_frames, threads):
+    import cv2
+
+    if not isinstance(path, str):
+        raise ValueError("The opencv backend only reads video files, not file objects")
+    capture = cv2.VideoCapture(path)
+    if threads > 0 and hasattr(cv2, 'CAP_PROP_N_THREADS'):
+        capture.set(cv2.CAP_PROP_N_THREADS, threads)
+    if start_sec > 0:
+        capture.set(cv2.CAP_PROP_POS_MSEC, start_sec * 1000)
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+
+    frames = []
+    while num_frames is None or len(frames) < num_frames:
+        if end_sec is not None and capture.get(cv2.CAP_PROP_POS_MSEC) > end_sec * 1000:
+            break
+        ret, frame = capture.read()
+        if not ret:
+            break
+        code = cv2.COLOR_BGR2GRAY if format == 'gray8' else cv2.COLOR_BGR2RGB
+        frames.append(cv2.cvtColor(frame, code))
+    capture.release()
+    return stack_frames(frames, height, width, format)
+
+
+def read_torchvision(path, format, start_sec, end_sec, num_frames):
+    import torchvision
+
+    from src.data.transforms import grayscale_clip
+
+    if not isinstance(path, str):
+        raise ValueError("The torchvision backend only reads video files, not file objects")
+    video, _, _ = torchvision.io.read_video(path, start_pts=start_sec, end_pts=end_sec, pts_unit='sec')
+    if num_frames is not None:
+        video = video[:num_frames]
+    if format == 'gray8':
+        video = grayscale_clip(video)
+    return video
+
+
+def read_video(path, format='rgb24', start_sec=0, end_sec=None, num_frames=None, keyframes=None, backend='pyav', threads=0):
+    '''
+    Decodes the frames with start_sec <= pts <= end_sec, at most num_frames of them, as (T, H, W, C) uint8 tensor.
+    path is a file name or, for the pyav backend, a file object like io.BytesIO with an encoded video.
+
+    format: 'gray8' (C = 1) or 'rgb24' (C = 3). pyav takes gray8 straight from the luma plane of the decoded
+            frames without an rgb copy, the other backends convert.
+    keyframes: keyframe_index() of the video, pyav then seeks to the last keyframe before start_sec
+    threads: codec threads, 0 lets the codec choose
+    '''
+    assert format in FORMATS
+    if backend == 'pyav':
+        return read_pyav(path, format, start_sec, end_sec, num_frames, keyframes, threads)
+    elif backend == 'opencv':
+        return read_opencv(path, format, start_sec, end_sec, num_frames, threads)
+    elif backend == 'torchvision':
+        return read_torchvision(path, format, start_sec, end_sec, num_frames)
+    raise ValueError(f"Unknown video backend {backend}, choose one of {BACKENDS}")
+
+
+def read_frame(path, index=0, format='rgb24', backend='pyav', threads=1):
+    '''
+    Decodes the single frame at index as (H, W, C) uint8 tensor. Decoding stops right after it and
+    with pyav the frames in front of it are never converted. A single codec thread avoids the delay of frame threading.
+    '''
+    if backend != 'pyav':
+        video = read_video(path, format=format, num_frames=index + 1, backend=backend, threads=threads)
+        if len(video) <= index:
+            raise IndexError(f"{path} has only {len(video)} frames")
+        return video[index]
+
+    with av.open(path) as container:
+        stream = open_stream(container, threads)
+        position = 0
+        for frame in container.decode(stream):
+            if frame.pts is None:
+                continue
+            if position == index:
+                return stack_frames([frame_array(frame, format)], frame.height, frame.width, format)[0]
+            position += 1
+    raise IndexError(f"{path} has only {position} frames")
+
+
+def benchmark(paths, repeat, threads):
+    for backend in BACKENDS:
+        for format in FORMATS:
+            num_frames = 0
+            start = time.time()
+            try:
+                for _ in range(repeat):
+                    for path in paths:
+                        num_frames += len(read_video(path, format=format, backend=backend, threads=threads))
+            except ImportError as e:
+                print(f"{backend:12} {format:6} not available: {e}")
+                continue
+            duration = time.time() - start
+            print(f"{backend:12} {format:6} {num_frames / duration:8.1f} frames/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode speed of the video backends in frames per second")
+    parser.add_argument('videos', nargs='+', help='Clips to decode, e.g. a few LRW or LRS2 mp4 files')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=0)
+    args = parser.parse_args()
+    benchmark(args.videos, args.repeat, args.threads)
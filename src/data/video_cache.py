@@ -0,0 +1,100 @@
+import atexit
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+
+def remove_directory(directory, pid):
+    # only the process that created the cache removes it, not forked workers
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class VideoCache():
+    '''
+    LRU cache of encoded video files shared by all DataLoader workers of a process tree.
+    The files are kept in a tmpfs directory (/dev/shm), which is plain shared memory, and the total size is
+    tracked in a shared counter. Once max_bytes would be exceeded, least recently read files are evicted until the
+    cache is below low_water * max_bytes, so the directory is only scanned every few misses.
+    Create the cache before the DataLoader starts its workers and pass it to the dataset.
+    '''
+
+    def __init__(self, max_bytes, directory=None, low_water=0.9):
+        self.max_bytes = int(max_bytes)
+        self.low_water_bytes = int(max_bytes * low_water)
+        if directory is None:
+            parent = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            directory = tempfile.mkdtemp(prefix="video_cache_", dir=parent)
+            atexit.register(remove_directory, directory, os.getpid())
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.size = multiprocessing.Value('q', 0)
+        self.hits = multiprocessing.Value('q', 0)
+        self.misses = multiprocessing.Value('q', 0)
+
+    def cache_path(self, path):
+        key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def read(self, path, record=True):
+        # record=False leaves the hit and miss counts alone, e.g. for the reads of the ReadaheadSampler
+        cache_path = self.cache_path(path)
+        try:
+            with open(cache_path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            data = None
+
+        if data is not None:
+            try:
+                os.utime(cache_path)  # the modification time orders the eviction
+            except FileNotFoundError:
+                pass
+            if record:
+                with self.hits.get_lock():
+                    self.hits.value += 1
+            return data
+
+        with open(path, "rb") as file:
+            data = file.read()
+        if record:
+            with self.misses.get_lock():
+                self.misses.value += 1
+        if len(data) <= self.max_bytes:
+            self.insert(cache_path, data)
+        return data
+
+    def insert(self, cache_path, data):
+        with self.size.get_lock():
+            if os.path.exists(cache_path):
+                return
+            if self.size.value + len(data) > self.max_bytes:
+                self.evict(len(data))
+            temp_path = f"{cache_path}.{os.getpid()}"
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, cache_path)
+            self.size.value += len(data)
+
+    def evict(self, num_bytes):
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        for _, size, path in sorted(entries):
+            if self.size.value + num_bytes <= self.low_water_bytes:
+                break
+            try:
+                os.remove(path)
+                self.size.value -= size
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return {'cache_bytes': self.size.value, 'cache_hits': self.hits.value, 'cache_misses': self.misses.value}
@@ -0,0 +1,92 @@
+import argparse
+import time
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+
+class AdditiveAttention(nn.Module):
+    '''
+    Additive attention v^T tanh(W [h; a] + b) of a decoder state h over the encoder annotations a.
+    The annotation half of W is the same at every decoder step, so precompute() projects the annotations once per
+    utterance and each step only adds the projected query. The parameters are the ones of the concatenating
+    implementation (dense), existing checkpoints load unchanged.
+    '''
+
+    def __init__(self, hidden_size, annotation_size):
+        super().__init__()
+        self.hidden_size = hidden_size
+        self.dense = nn.Sequential(
+            nn.Linear(hidden_size+annotation_size, hidden_size),
+            nn.Tanh(),
+            nn.Linear(hidden_size, 1)
+        )
+
+    def precompute(self, annotations):
+        # (B, T, A) -> (B, T, H) keys including the bias, pass them to every step of the utterance
+        linear = self.dense[0]
+        return F.linear(annotations, linear.weight[:, self.hidden_size:], linear.bias)
+
+    def forward(self, prev_hidden_state, annotations, keys=None, mask=None):
+        '''
+        prev_hidden_state: (B, H), annotations: (B, T, A), mask: (B, T) with False for padded encoder frames
+        returns the context (B, 1, A) and the attention weights (B, 1, T)
+        '''
+        if keys is None:
+            keys = self.precompute(annotations)
+        query = F.linear(prev_hidden_state, self.dense[0].weight[:, :self.hidden_size])
+        attn_energies = self.dense[2](torch.tanh(keys + query.unsqueeze(dim=1))).squeeze(dim=2)
+        if mask is not None:
+            attn_energies = attn_energies.masked_fill(~mask, float('-inf'))
+        attn_weights = F.softmax(attn_energies, dim=1).unsqueeze(dim=1)
+        context = attn_weights.bmm(annotations)
+
+        return context, attn_weights
+
+
+def concat_attention(attention, prev_hidden_state, annotations):
+    # previous implementation, repeats the state over all annotations and projects the concatenation at every step
+    sequence_length = annotations.size(1)
+    prev_hidden_state = prev_hidden_state.repeat(sequence_length, 1, 1).transpose(0, 1)
+    concatenated = torch.cat([prev_hidden_state, annotations], dim=2)
+    attn_energies = attention.dense(concatenated).squeeze(dim=2)
+    attn_weights = F.softmax(attn_energies, dim=1).unsqueeze(dim=1)
+    return attn_weights.bmm(annotations), attn_weights
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--timesteps', type=int, default=150)
+    parser.add_argument('--steps', type=int, default=100, help='Decoder steps per utterance')
+    parser.add_argument('--hidden_size', type=int, default=512)
+    args = parser.parse_args()
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    attention = AdditiveAttention(args.hidden_size, args.hidden_size).to(device)
+    annotations = torch.randn(args.batch_size, args.timesteps, args.hidden_size, device=device)
+    states = torch.randn(args.steps, args.batch_size, args.hidden_size, device=device)
+
+    def concat_utterance():
+        return [concat_attention(attention, state, annotations)[0] for state in states]
+
+    def cached_utterance():
+        keys = attention.precompute(annotations)  # once per utterance, part of the measured time
+        return [attention(state, annotations, keys=keys)[0] for state in states]
+
+    def run(utterance):
+        with torch.no_grad():
+            utterance()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start_time = time.time()
+            contexts = utterance()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            return (time.time() - start_time) / args.steps, torch.stack(contexts)
+
+    concat_time, concat_context = run(concat_utterance)
+    cached_time, cached_context = run(cached_utterance)
+    print(f"concat: {concat_time * 1000:.3f}ms per step, precomputed keys: {cached_time * 1000:.3f}ms per step")
+    print(f"max difference: {(concat_context - cached_context).abs().max().item():.2e}")
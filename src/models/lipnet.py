@@ -11,10 +11,11 @@ from torch import nn as nn
 from torch import optim
 from torch.nn import functional as F
 from torch.nn import init
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, RandomSampler
 
 from src.data.ctc_utils import ctc_collate
 from src.data.grid import GRIDDataset
+from src.data.readahead import ReadaheadSampler
 from src.decoder.greedy import GreedyDecoder
 
 
@@ -119,9 +120,12 @@ class LipNet(Module):
 
     def train_dataloader(self):
         train_data = GRIDDataset(path=self.hparams.data, augmentation=True)
+        sampler = RandomSampler(train_data)
+        if self.hparams.readahead > 0:
+            sampler = ReadaheadSampler(sampler, train_data, depth=self.hparams.readahead, max_bytes=self.hparams.readahead_mb * 1024 ** 2)
         train_loader = DataLoader(
             train_data,
-            shuffle=True,
+            sampler=sampler,
             batch_size=self.hparams.batch_size,
             collate_fn=ctc_collate,
             num_workers=self.hparams.workers,
@@ -15,9 +15,14 @@ from torch import nn, optim
 from torch.nn import functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from torch.utils.checkpoint import checkpoint_sequential
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, RandomSampler
 
+from src.data.batching import BucketBatchSampler, trim_collate
 from src.data.lrs2 import LRS2Dataset
+from src.data.readahead import ReadaheadSampler
+from src.data.shards import ShardDataset
+from src.data.video_cache import VideoCache
+from src.models.additive_attention import AdditiveAttention
 from src.models.resnet import ResNetModel
 
 
@@ -65,8 +70,11 @@ class LRS2ResnetAttn(Module):
 
         self.teacher_forcing_ratio = 1.0
         self.min_teacher_forcing_ratio = 0.75
+        self.train_transform = None
+        self.val_transform = None
+        self.cache = None
 
-        dataset = self.train_dataloader().dataset
+        dataset = self.train_dataset(index=False)  # the vocabulary, the train loader may read shards that do not have it
         self.int2char = dataset.int2char
         self.char2int = dataset.char2int
         self.dictionary = dataset.dictionary
@@ -134,10 +142,11 @@ class LRS2ResnetAttn(Module):
         results = []
         max_length = target_tensor.size(1)
         decoder_attentions = []
+        keys = self.spell.attention.precompute(watch_outputs)
         for i in range(max_length):
             use_teacher_forcing = True if enable_teacher and random.random() < self.teacher_forcing_ratio else False
             decoder_output, spell_hidden, cell_state, context, attn_weights = self.spell(
-                decoder_input, spell_hidden, cell_state, watch_outputs, context)
+                decoder_input, spell_hidden, cell_state, watch_outputs, context, keys)
             _, topi = decoder_output.topk(1, dim=2)
             decoder_attentions.append(attn_weights.squeeze(dim=1))
             if use_teacher_forcing:
@@ -211,6 +220,8 @@ class LRS2ResnetAttn(Module):
 
     def training_step(self, batch, batch_num):
         frames, input_lengths, target = batch
+        if self.train_transform != None:
+            frames = self.train_transform(frames, input_lengths)
         loss, results, _ = self.forward(frames, input_lengths, target)
         cer, wer, sentences = self.greedy_decode(results, target)
 
@@ -219,6 +230,8 @@ class LRS2ResnetAttn(Module):
 
     def validation_step(self, batch, batch_num):
         frames, input_lengths, target = batch
+        if self.val_transform != None:
+            frames = self.val_transform(frames, input_lengths)
         loss, results, attn_weights = self.forward(frames, input_lengths, target, enable_teacher=False)
         # self.save_attention(results, target, input_lengths, attn_weights)
         cer, wer, sentences_greedy = self.greedy_decode(results, target)
@@ -314,8 +327,27 @@ class LRS2ResnetAttn(Module):
 
         return optimizer, scheduler
 
-    def train_dataloader(self):
-        train_data = LRS2Dataset(
+    def video_cache(self):
+        # one cache for all datasets of the model, created before any DataLoader worker is started
+        if self.hparams.video_cache == None:
+            return None
+        if self.cache == None:
+            self.cache = VideoCache(max_bytes=self.hparams.video_cache * 1024 ** 3)
+        return self.cache
+
+    def readahead(self, sampler, data):
+        if self.hparams.readahead == 0:
+            return sampler
+        return ReadaheadSampler(
+            sampler,
+            data,
+            depth=self.hparams.readahead,
+            max_bytes=self.hparams.readahead_mb * 1024 ** 2,
+            cache=self.video_cache(),
+        )
+
+    def train_dataset(self, index=True):
+        return LRS2Dataset(
             path=self.hparams.data,
             max_text_len=self.max_text_len,
             mode='train',
@@ -323,10 +355,30 @@ class LRS2ResnetAttn(Module):
             pretrain_words=self.pretrain_words,
             pretrain=self.pretrain,
             augmentations=True,
+            uint8=self.hparams.uint8,
+            gray8=self.hparams.gray8,
+            cache=self.video_cache(),
+            index=index,
         )
+
+    def train_dataloader(self):
+        train_data = self.train_dataset(index=self.hparams.shards == None)
+        self.train_transform = train_data.device_transform
+        if self.hparams.shards != None:
+            split = "pretrain" if self.pretrain else "train"
+            shards = ShardDataset(f"{self.hparams.shards}/{split}", decode=train_data.from_record, select=train_data.select_record)
+            return DataLoader(shards, batch_size=self.hparams.batch_size, num_workers=self.hparams.workers, pin_memory=True)
+        if self.hparams.frame_budget != None:
+            return DataLoader(
+                train_data,
+                batch_sampler=self.readahead(BucketBatchSampler(train_data.frame_lengths(), max_frames=self.hparams.frame_budget), train_data),
+                num_workers=self.hparams.workers,
+                pin_memory=True,
+                collate_fn=trim_collate,
+            )
         train_loader = DataLoader(
             train_data,
-            shuffle=True,
+            sampler=self.readahead(RandomSampler(train_data), train_data),
             batch_size=self.hparams.batch_size,
             num_workers=self.hparams.workers,
             pin_memory=True,
@@ -341,7 +393,11 @@ class LRS2ResnetAttn(Module):
             max_text_len=100,
             pretrain_words=0,
             pretrain=False,
+            uint8=self.hparams.uint8,
+            gray8=self.hparams.gray8,
+            cache=self.video_cache(),
         )
+        self.val_transform = val_data.device_transform
         val_loader = DataLoader(
             val_data,
             shuffle=False,
@@ -360,7 +416,7 @@ class AttentionDecoder(nn.Module):
 
         self.embedded = nn.Embedding(self.output_size, self.hidden_size)
         self.lstm = nn.LSTM(self.hidden_size*2, self.hidden_size, self.num_layers, batch_first=True, bidirectional=False)
-        self.attention = Attention(hidden_size, hidden_size)
+        self.attention = AdditiveAttention(hidden_size, hidden_size)
         self.mlp = nn.Sequential(
             nn.Linear(hidden_size*2, hidden_size),
             nn.BatchNorm1d(hidden_size),
@@ -371,32 +427,13 @@ class AttentionDecoder(nn.Module):
             nn.Linear(256, output_size)
         )
 
-    def forward(self, input, hidden_state, cell_state, watch_outputs, context):
+    def forward(self, input, hidden_state, cell_state, watch_outputs, context, keys=None):
+        # keys: self.attention.precompute(watch_outputs), computed once per utterance
         input = self.embedded(input)
         concatenated = torch.cat([input, context], dim=2)
         output, (hidden_state, cell_state) = self.lstm(concatenated, (hidden_state, cell_state))
-        context, attn_weights = self.attention(hidden_state[-1], watch_outputs)
+        context, attn_weights = self.attention(hidden_state[-1], watch_outputs, keys=keys)
         output = self.mlp(torch.cat([output, context], dim=2).squeeze(dim=1)).unsqueeze(dim=1)
         output = F.log_softmax(output, dim=2)
         return output, hidden_state, cell_state, context, attn_weights
 
-
-class Attention(nn.Module):
-    def __init__(self, hidden_size, annotation_size):
-        super().__init__()
-        self.dense = nn.Sequential(
-            nn.Linear(hidden_size+annotation_size, hidden_size),
-            nn.Tanh(),
-            nn.Linear(hidden_size, 1)
-        )
-
-    def forward(self, prev_hidden_state, annotations):
-        batch_size, sequence_length, _ = annotations.size()
-        prev_hidden_state = prev_hidden_state.repeat(sequence_length, 1, 1).transpose(0, 1)
-
-        concatenated = torch.cat([prev_hidden_state, annotations], dim=2)
-        attn_energies = self.dense(concatenated).squeeze(dim=2)
-        attn_weights = F.softmax(attn_energies, dim=1).unsqueeze(dim=1)
-        context = attn_weights.bmm(annotations)
-
-        return context, attn_weights
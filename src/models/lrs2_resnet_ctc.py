@@ -1,4 +1,5 @@
 import os
+from functools import partial
 
 import numpy as np
 import torch
@@ -7,11 +8,15 @@ from pytorch_trainer import Module
 from torch import nn, optim
 from torch.nn import functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, RandomSampler
 
 import wandb
+from src.data.batching import BucketBatchSampler
 from src.data.ctc_utils import ctc_collate
 from src.data.lrs2_ctc import LRS2CTCDataset as LRS2Dataset
+from src.data.readahead import ReadaheadSampler
+from src.data.shards import ShardDataset
+from src.data.video_cache import VideoCache
 from src.decoder.greedy import GreedyDecoder
 from src.models.resnet import ResNetModel
 
@@ -25,8 +30,11 @@ class LRS2ResnetCTC(Module):
         self.pretrain = pretrain
         self.max_timesteps = 155
         self.pretrain_words = 0
+        self.train_transform = None
+        self.val_transform = None
+        self.cache = None
 
-        characters = self.train_dataloader().dataset.characters
+        characters = LRS2Dataset.characters
         self.decoder = GreedyDecoder(characters)
         self.frontend = nn.Sequential(
             nn.Conv3d(self.in_channels, 64, kernel_size=(5, 7, 7), stride=(1, 2, 2), padding=(2, 3, 3), bias=False),
@@ -67,6 +75,8 @@ class LRS2ResnetCTC(Module):
 
     def training_step(self, batch, batch_num):
         frames, y, lengths, y_lengths, idx = batch
+        if self.train_transform != None:
+            frames = self.train_transform(frames, lengths)
         output = self.forward(frames, lengths)
         output = output.transpose(0, 1)
         loss_all = self.loss(output, y, lengths, y_lengths)
@@ -87,6 +97,8 @@ class LRS2ResnetCTC(Module):
             return {}
 
         frames, y, lengths, y_lengths, idx = batch
+        if self.val_transform != None:
+            frames = self.val_transform(frames, lengths)
 
         output = self.forward(frames, lengths)
         output = output.transpose(0, 1)
@@ -137,6 +149,25 @@ class LRS2ResnetCTC(Module):
     def configure_optimizers(self):
         return optim.Adam(self.parameters(), lr=self.hparams.lr, weight_decay=self.hparams.weight_decay)
 
+    def video_cache(self):
+        # one cache for all datasets of the model, created before any DataLoader worker is started
+        if self.hparams.video_cache == None:
+            return None
+        if self.cache == None:
+            self.cache = VideoCache(max_bytes=self.hparams.video_cache * 1024 ** 3)
+        return self.cache
+
+    def readahead(self, sampler, data):
+        if self.hparams.readahead == 0:
+            return sampler
+        return ReadaheadSampler(
+            sampler,
+            data,
+            depth=self.hparams.readahead,
+            max_bytes=self.hparams.readahead_mb * 1024 ** 2,
+            cache=self.video_cache(),
+        )
+
     def train_dataloader(self):
         if self.pretrain:
             mode = "pretrain"
@@ -149,10 +180,32 @@ class LRS2ResnetCTC(Module):
             mode=mode,
             max_timesteps=self.max_timesteps,
             pretrain_words=self.pretrain_words,
+            uint8=self.hparams.uint8,
+            gray8=self.hparams.gray8,
+            cache=self.video_cache(),
+            index=self.hparams.shards == None,
         )
+        self.train_transform = train_data.device_transform
+        if self.hparams.shards != None:
+            shards = ShardDataset(f"{self.hparams.shards}/{mode}", decode=train_data.from_record)
+            return DataLoader(
+                shards,
+                batch_size=self.hparams.batch_size,
+                num_workers=self.hparams.workers,
+                pin_memory=True,
+                collate_fn=ctc_collate,
+            )
+        if self.hparams.frame_budget != None:
+            return DataLoader(
+                train_data,
+                batch_sampler=self.readahead(BucketBatchSampler(train_data.frame_lengths(), max_frames=self.hparams.frame_budget), train_data),
+                num_workers=self.hparams.workers,
+                pin_memory=True,
+                collate_fn=partial(ctc_collate, trim=True),
+            )
         train_loader = DataLoader(
             train_data,
-            shuffle=True,
+            sampler=self.readahead(RandomSampler(train_data), train_data),
             batch_size=self.hparams.batch_size, num_workers=self.hparams.workers,
             pin_memory=True,
             collate_fn=ctc_collate,
@@ -164,7 +217,11 @@ class LRS2ResnetCTC(Module):
             path=self.hparams.data,
             in_channels=self.in_channels,
             mode='val',
+            uint8=self.hparams.uint8,
+            gray8=self.hparams.gray8,
+            cache=self.video_cache(),
         )
+        self.val_transform = val_data.device_transform
         val_loader = DataLoader(
             val_data, shuffle=False,
             batch_size=self.hparams.batch_size * 2, num_workers=self.hparams.workers,
@@ -177,7 +234,11 @@ class LRS2ResnetCTC(Module):
             path=self.hparams.data,
             in_channels=self.in_channels,
             mode='test',
+            uint8=self.hparams.uint8,
+            gray8=self.hparams.gray8,
+            cache=self.video_cache(),
         )
+        self.val_transform = test_data.device_transform
         test_loader = DataLoader(
             test_data, shuffle=False,
             batch_size=self.hparams.batch_size * 2, num_workers=self.hparams.workers,
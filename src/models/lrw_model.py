@@ -9,9 +9,15 @@ from sklearn.metrics import confusion_matrix
 from sklearn.utils.multiclass import unique_labels
 from torch import nn, optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 
+from src.data.batching import ContiguousBatchSampler
+from src.data.hdf5 import HDF5Dataset
 from src.data.lrw import LRWDataset
+from src.data.lrw_frames import LRWFramesDataset
+from src.data.readahead import ReadaheadSampler
+from src.data.shards import ShardDataset
+from src.data.video_cache import VideoCache
 from src.models.nll_sequence_loss import NLLSequenceLoss
 from src.models.resnet import ResNetModel
 
@@ -25,6 +31,9 @@ class LRWModel(Module):
         self.query = query
 
         self.best_val_acc = 0
+        self.train_transform = None
+        self.val_transform = None
+        self.cache = None
 
         self.frontend = nn.Sequential(
             nn.Conv3d(self.in_channels, 64, kernel_size=(5, 7, 7), stride=(1, 2, 2), padding=(2, 3, 3), bias=False),
@@ -59,6 +68,8 @@ class LRWModel(Module):
 
     def training_step(self, batch, batch_num):
         frames = batch['frames']
+        if self.train_transform != None:
+            frames = self.train_transform(frames)
         labels = batch['label']
         output = self.forward(frames)
         loss = self.loss(output, labels.squeeze(1))
@@ -68,6 +79,8 @@ class LRWModel(Module):
 
     def validation_step(self, batch, batch_num):
         frames = batch['frames']
+        if self.val_transform != None:
+            frames = self.val_transform(frames)
         labels = batch['label']
         words = batch['word']
         output = self.forward(frames)
@@ -157,40 +170,84 @@ class LRWModel(Module):
     def configure_optimizers(self):
         return optim.Adam(self.parameters(), lr=self.hparams.lr, weight_decay=self.hparams.weight_decay)
 
-    def train_dataloader(self):
-        train_data = LRWDataset(
+    def dataset(self, mode, augmentations=False):
+        if self.hparams.hdf5 != None:
+            assert augmentations == False, "HDF5 files store preprocessed frames without augmentations"
+            query = None if self.query == None else f"(yaw >= {self.query[0]}) & (yaw < {self.query[1]})"
+            return HDF5Dataset(
+                path=self.hparams.hdf5,
+                table=mode,
+                columns=['frames', 'label', 'word'],
+                query=query,
+                uint8=self.hparams.uint8,
+            )
+        if self.hparams.frames != None:
+            assert self.in_channels == 1, "Frame shards only store grayscale frames"
+            return LRWFramesDataset(
+                path=self.hparams.frames,
+                num_words=self.hparams.words,
+                mode=mode,
+                augmentations=augmentations,
+                query=self.query,
+                seed=self.hparams.seed,
+                uint8=self.hparams.uint8,
+            )
+        return LRWDataset(
             path=self.hparams.data,
             num_words=self.hparams.words,
             in_channels=self.in_channels,
-            augmentations=self.augmentations,
+            mode=mode,
+            augmentations=augmentations,
             query=self.query,
-            seed=self.hparams.seed
+            seed=self.hparams.seed,
+            uint8=self.hparams.uint8,
+            gray8=self.hparams.gray8,
+            cache=self.video_cache(),
         )
-        train_loader = DataLoader(train_data, shuffle=True, batch_size=self.hparams.batch_size, num_workers=self.hparams.workers, pin_memory=True)
+
+    def video_cache(self):
+        # one cache for all datasets of the model, created before any DataLoader worker is started
+        if self.hparams.video_cache == None:
+            return None
+        if self.cache == None:
+            self.cache = VideoCache(max_bytes=self.hparams.video_cache * 1024 ** 3)
+        return self.cache
+
+    def dataloader(self, data, batch_size, shuffle):
+        if isinstance(data, HDF5Dataset):
+            sampler = ContiguousBatchSampler(len(data), batch_size, shuffle=shuffle)
+            return DataLoader(data, sampler=sampler, batch_size=None, num_workers=self.hparams.workers, pin_memory=True)
+        sampler = RandomSampler(data) if shuffle else SequentialSampler(data)
+        if self.hparams.readahead > 0 and hasattr(data, 'sample_paths'):
+            sampler = ReadaheadSampler(
+                sampler,
+                data,
+                depth=self.hparams.readahead,
+                max_bytes=self.hparams.readahead_mb * 1024 ** 2,
+                cache=self.video_cache(),
+            )
+        return DataLoader(data, sampler=sampler, batch_size=batch_size, num_workers=self.hparams.workers, pin_memory=True)
+
+    def train_dataloader(self):
+        train_data = self.dataset(mode='train', augmentations=self.augmentations)
+        self.train_transform = getattr(train_data, 'device_transform', None)
+        if self.hparams.shards != None:
+            assert isinstance(train_data, LRWDataset), "Shards store mp4 videos, use them without --frames and --hdf5"
+            shards = ShardDataset(f"{self.hparams.shards}/train", decode=train_data.from_record, select=train_data.select_record)
+            return DataLoader(shards, batch_size=self.hparams.batch_size, num_workers=self.hparams.workers, pin_memory=True)
+        train_loader = self.dataloader(train_data, self.hparams.batch_size, shuffle=True)
         return train_loader
 
     def val_dataloader(self):
-        val_data = LRWDataset(
-            path=self.hparams.data,
-            num_words=self.hparams.words,
-            in_channels=self.in_channels,
-            mode='val',
-            query=self.query,
-            seed=self.hparams.seed
-        )
-        val_loader = DataLoader(val_data, shuffle=False, batch_size=self.hparams.batch_size * 2, num_workers=self.hparams.workers)
+        val_data = self.dataset(mode='val')
+        self.val_transform = getattr(val_data, 'device_transform', None)
+        val_loader = self.dataloader(val_data, self.hparams.batch_size * 2, shuffle=False)
         return val_loader
 
     def test_dataloader(self):
-        test_data = LRWDataset(
-            path=self.hparams.data,
-            num_words=self.hparams.words,
-            in_channels=self.in_channels,
-            mode='test',
-            query=self.query,
-            seed=self.hparams.seed
-        )
-        test_loader = DataLoader(test_data, shuffle=False, batch_size=self.hparams.batch_size * 2, num_workers=self.hparams.workers)
+        test_data = self.dataset(mode='test')
+        self.val_transform = getattr(test_data, 'device_transform', None)
+        test_loader = self.dataloader(test_data, self.hparams.batch_size * 2, shuffle=False)
         return test_loader
 
 
@@ -14,8 +14,10 @@ from torch.utils.checkpoint import checkpoint_sequential
 from torch.utils.data import DataLoader
 
 import wandb
+from src.data.batching import BucketBatchSampler, trim_collate
 from src.data.charset import get_charSet, init_charSet
 from src.data.lrs_wls import LRS2Dataset
+from src.models.additive_attention import AdditiveAttention
 
 
 class WLSNet(Module):
@@ -46,9 +48,10 @@ class WLSNet(Module):
         loss = 0
         results = []
         target_length = target_tensor.size(1)
+        keys = self.spell.attentionVideo.precompute(watch_outputs)
         for di in range(target_length):
             use_teacher_forcing = True if random.random() < self.teacher_forcing_ratio else False
-            decoder_output, spell_hidden, cell_state, context = self.spell(decoder_input, spell_hidden, cell_state, watch_outputs, context)
+            decoder_output, spell_hidden, cell_state, context = self.spell(decoder_input, spell_hidden, cell_state, watch_outputs, context, keys)
             _, topi = decoder_output.topk(1, dim=2)
             if enable_teacher and use_teacher_forcing:
                 decoder_input = target_tensor[:, di].long().unsqueeze(dim=1)
@@ -133,7 +136,16 @@ class WLSNet(Module):
             max_timesteps=self.max_timesteps,
             max_text_len=self.max_text_len,
             mode='train',
+            gray8=self.hparams.gray8,
         )
+        if self.hparams.frame_budget != None:
+            return DataLoader(
+                train_data,
+                batch_sampler=BucketBatchSampler(train_data.frame_lengths(), max_frames=self.hparams.frame_budget),
+                num_workers=self.hparams.workers,
+                pin_memory=True,
+                collate_fn=trim_collate,
+            )
         train_loader = DataLoader(
             train_data,
             shuffle=True,
@@ -148,6 +160,7 @@ class WLSNet(Module):
             max_timesteps=self.max_timesteps,
             max_text_len=self.max_text_len,
             mode='val',
+            gray8=self.hparams.gray8,
         )
         val_loader = DataLoader(
             val_data, shuffle=False,
@@ -165,13 +178,16 @@ class Watch(nn.Module):
 
     def forward(self, x, length):
         x = x.squeeze(dim=1)
+        if x.size(1) < 5:
+            x = F.pad(x, (0, 0, 0, 0, 0, 5 - x.size(1)))  # trimmed batches of short clips need at least one window
         size = x.size()
 
         outputs = []
         for i in range(size[1] - 4):
             outputs.append(self.encoder(x[:, i:i+5, :, :]).unsqueeze(1))
         x = torch.cat(outputs, dim=1)
-        x = nn.utils.rnn.pack_padded_sequence(x, lengths=length.view(-1).int(), batch_first=True, enforce_sorted=False)
+        length = (length.view(-1) - 4).clamp(min=1)  # every output covers a window of 5 frames
+        x = nn.utils.rnn.pack_padded_sequence(x, lengths=length.int(), batch_first=True, enforce_sorted=False)
         outputs, states = self.lstm(x)
         outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True, padding_value=0)
         return outputs, states[0]
@@ -199,7 +215,7 @@ class Spell(nn.Module):
 
         self.embedded = nn.Embedding(self.output_size, self.hidden_size)
         self.lstm = nn.LSTM(self.hidden_size*2, self.hidden_size, self.num_layers, batch_first=True)
-        self.attentionVideo = Attention(hidden_size, hidden_size)
+        self.attentionVideo = AdditiveAttention(hidden_size, hidden_size)
         self.mlp = nn.Sequential(
             nn.Linear(hidden_size*2, hidden_size),
             nn.BatchNorm1d(hidden_size),
@@ -210,38 +226,17 @@ class Spell(nn.Module):
             nn.Linear(256, output_size)
         )
 
-    def forward(self, input, hidden_state, cell_state, watch_outputs, context):
+    def forward(self, input, hidden_state, cell_state, watch_outputs, context, keys=None):
+        # keys: self.attentionVideo.precompute(watch_outputs), computed once per utterance
         input = self.embedded(input)
         concatenated = torch.cat([input, context], dim=2)
         output, (hidden_state, cell_state) = self.lstm(concatenated, (hidden_state, cell_state))
-        context = self.attentionVideo(hidden_state[-1], watch_outputs)
+        context, _ = self.attentionVideo(hidden_state[-1], watch_outputs, keys=keys)
         output = self.mlp(torch.cat([output, context], dim=2).squeeze(1)).unsqueeze(1)
 
         return output, hidden_state, cell_state, context
 
 
-class Attention(nn.Module):
-    def __init__(self, hidden_size, annotation_size):
-        super(Attention, self).__init__()
-        self.dense = nn.Sequential(
-            nn.Linear(hidden_size+annotation_size, hidden_size),
-            nn.Tanh(),
-            nn.Linear(hidden_size, 1)
-        )
-
-    def forward(self, prev_hidden_state, annotations):
-        batch_size, sequence_length, _ = annotations.size()
-
-        prev_hidden_state = prev_hidden_state.repeat(sequence_length, 1, 1).transpose(0, 1)
-
-        concatenated = torch.cat([prev_hidden_state, annotations], dim=2)
-        attn_energies = self.dense(concatenated).squeeze(2)
-        alpha = F.softmax(attn_energies, dim=1).unsqueeze(1)
-        context = alpha.bmm(annotations)
-
-        return context
-
-
 class Encoder(nn.Module):
     '''modified VGG-M
     '''
@@ -3,7 +3,6 @@ import argparse
 import torch
 from facenet_pytorch import MTCNN
 from PIL import Image
-from torchvision import transforms
 
 
 class FaceNet():
@@ -12,15 +11,14 @@ class FaceNet():
         self.mtcnn = MTCNN(select_largest=True, device=device)
 
     def detect(self, image):
-        if isinstance(image, torch.Tensor) and len(image.shape) == 4 or isinstance(image, list):
-            data = []
-            for frame in image:
-                frame = transforms.functional.to_pil_image(frame)
-                data.append(frame)
-        else:
-            data = transforms.functional.to_pil_image(image)
-
-        boxes, _, landmarks = self.mtcnn.detect(data)
+        '''
+        image: PIL image, (H, W, C) or (N, H, W, C) uint8 tensor, or list of (C, H, W) tensors of the same size
+        MTCNN takes the uint8 tensors directly, a batch is detected in one pass without converting each frame to PIL.
+        '''
+        if isinstance(image, list):
+            image = torch.stack(image).permute(0, 2, 3, 1)
+
+        boxes, _, landmarks = self.mtcnn.detect(image)
         return boxes, landmarks
 
 
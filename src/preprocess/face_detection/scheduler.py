@@ -0,0 +1,93 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+
+class DetectionScheduler():
+    '''
+    Collects frames of many videos into batches of batch_size and runs the detector once per batch.
+    Frames are grouped by their shape, as a batch has to be stacked. A batch is run when it is full or when its
+    oldest frame has waited max_wait seconds, so a single video is not held back when nothing else is coming.
+
+    detect(frames) takes a (N, H, W, C) uint8 tensor and returns one result per frame,
+    e.g. lambda frames: facenet.detect(frames)[1] for the MTCNN landmarks.
+    Thread safe, every video is expected to submit its frames from its own thread, see LRS2Preprocess.process_batch.
+    '''
+
+    def __init__(self, detect, batch_size=64, max_wait=0.05):
+        self.detect = detect
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()  # (frame, future), None stops the scheduler
+        self.num_batches = 0
+        self.num_frames = 0
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, frames):
+        # frames: (H, W, C) uint8 tensors, returns one Future per frame
+        futures = []
+        for frame in frames:
+            future = Future()
+            self.queue.put((frame, future))
+            futures.append(future)
+        return futures
+
+    def __call__(self, frames):
+        # blocks until the frames have been detected, possibly together with frames of other videos
+        return [future.result() for future in self.submit(frames)]
+
+    def loop(self):
+        pending = {}  # shape -> [(frame, future)]
+        deadlines = {}  # shape -> time when the batch is run even if it is not full
+        stopped = False
+        while not stopped or len(pending) > 0:
+            timeout = None if len(deadlines) == 0 else max(min(deadlines.values()) - time.time(), 0)
+            try:
+                entry = self.queue.get(timeout=timeout) if not stopped else None
+            except queue.Empty:
+                entry = None
+            else:
+                if entry is None:
+                    stopped = True
+            if entry is not None:
+                frame, future = entry
+                shape = tuple(frame.shape)
+                pending.setdefault(shape, []).append(entry)
+                deadlines.setdefault(shape, time.time() + self.max_wait)
+
+            now = time.time()
+            for shape in list(pending.keys()):
+                entries = pending[shape]
+                if len(entries) >= self.batch_size or deadlines[shape] <= now or stopped:
+                    self.run_batch(entries[:self.batch_size])
+                    pending[shape] = entries[self.batch_size:]
+                    deadlines[shape] = now + self.max_wait
+                if len(pending[shape]) == 0:
+                    del pending[shape]
+                    del deadlines[shape]
+
+    def run_batch(self, entries):
+        try:
+            results = self.detect(torch.stack([frame for frame, _ in entries]))
+            if len(results) != len(entries):
+                raise ValueError(f"Expected {len(entries)} detections, got {len(results)}")
+        except Exception as e:
+            for _, future in entries:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(entries, results):
+            future.set_result(result)
+        self.num_batches += 1
+        self.num_frames += len(entries)
+
+    def mean_batch_size(self):
+        return self.num_frames / max(self.num_batches, 1)
+
+    def close(self):
+        # detects the frames that are still pending and stops the thread
+        self.queue.put(None)
+        self.thread.join()
@@ -2,49 +2,87 @@ import argparse
 import glob
 import os
 
-import cv2
 import numpy as np
 import psutil
 import ray
-from tqdm import tqdm
 
-from face import FacePredictor, load_image
-from video import load_mouth_images, load_video
+from src.preprocess.face_detection.dlib_face import FacePredictor
+from src.preprocess.journal import Journal
+from src.preprocess.video import load_mouth_images
+from src.preprocess.work_queue import WorkQueue
 
 
 @ray.remote
-def preprocess_videos(videos, save_dir):
-    face_predictor = FacePredictor()
-    for video in videos:
-        try:
-            mouth_images = load_mouth_images(face_predictor, video, skip_frames=3)
-        except Exception as e:
-            print(e)
-            continue
+class GRIDPreprocess(object):
+    '''
+    Loads the dlib models once and extracts the mouths of the videos it is given by the WorkQueue.
+    '''
+
+    def __init__(self, save_dir, keyframe_interval=10):
+        self.save_dir = save_dir
+        self.keyframe_interval = keyframe_interval
+        self.face_predictor = FacePredictor()
+
+    def process(self, video):
+        # returns the output path and the number of frames, exceptions are reported by the WorkQueue
+        mouth_images = load_mouth_images(self.face_predictor, video, keyframe_interval=self.keyframe_interval)
         video_name = video.split("/")[-1].rsplit(".mpg", 1)[0]
         speaker = video.split("/")[-2][1:]
-        # save_path = save_dir + "/mouths/s" + speaker + "/" + video_name
-        save_path = os.path.join(save_dir, "mouths", "s" + speaker, video_name)
+        save_path = os.path.join(self.save_dir, "mouths", "s" + speaker)
         os.makedirs(save_path, exist_ok=True)
-        for i, frame in enumerate(mouth_images):
-            file = f'{save_path}/mouth_{i:03}.png'
-            cv2.imwrite(file, frame)
+        # one packed (T, H, W) uint8 array per utterance instead of a png per frame
+        np.save(f"{save_path}/{video_name}.npy", np.stack(mouth_images))
+        return f"{save_path}/{video_name}.npy", len(mouth_images)
+
 
+def manifest_line(output, num_frames):
+    # s{speaker}/{video},{frames} relative to the mouths directory
+    speaker_dir, file = output.split("/")[-2:]
+    return f"{speaker_dir}/{file[:-len('.npy')]},{num_frames}"
 
-def preprocess(directory):
-    num_cpus = psutil.cpu_count()
+
+def preprocess(directory, num_cpus=None, resume=None, keyframe_interval=10, max_in_flight=2):
+    '''
+    Every video is recorded in the journal as soon as it is done, failed videos are also appended to
+    mouths/failures.txt with their error.
+    '''
+    num_cpus = psutil.cpu_count() if num_cpus == None else num_cpus
     ray.init(num_cpus=num_cpus)
 
     save_dir = directory.rsplit("videos", 1)[0]
+    os.makedirs(os.path.join(save_dir, "mouths"), exist_ok=True)
+    journal = Journal(os.path.join(save_dir, "mouths", "journal.jsonl"), resume)
     pattern = directory + "/**/*.mpg"
-    videos = glob.glob(pattern)
-    splits = 200
-    initial_split = np.array_split(videos, splits)
-    with tqdm(total=len(videos)) as pbar:
-        for split in range(splits):
-            chunk = np.array_split(initial_split[split], num_cpus)
-            ray.get([preprocess_videos.remote(chunk[i], save_dir) for i in range(num_cpus)])
-            pbar.update(len(initial_split[split]))
+    videos = sorted(glob.glob(pattern))
+    pending = [videos[i] for i in journal.pending(videos)]
+    print(f"{len(videos) - len(pending)} videos done, {len(pending)} to process")
+
+    if len(pending) > 0:
+        failures = open(os.path.join(save_dir, "mouths", "failures.txt"), "w" if resume is None else "a")
+        actors = [GRIDPreprocess.remote(save_dir, keyframe_interval) for _ in range(num_cpus)]
+        queue = WorkQueue(actors, max_in_flight=max_in_flight)
+
+        def write(video, result):
+            output, num_frames = result
+            journal.record(video, output=output, frames=num_frames)
+
+        def failure(video, error):
+            journal.record(video, failed=True, error=str(error))
+            message = str(error).strip().splitlines()[-1] if str(error).strip() else repr(error)  # last traceback line
+            failures.write(f"{video}\t{message}\n")
+            failures.flush()
+
+        queue.run(pending, lambda actor, video: actor.process.remote(video), write, description="grid", failure=failure)
+        failures.close()
+        for actor in actors:
+            ray.kill(actor)
+    journal.close()
+
+    # the manifest marks the packed layout as complete for GRIDDataset, so it is only written at the end
+    lines = [manifest_line(record['output'], record['frames']) for record in journal.entries(videos)]
+    manifest = open(os.path.join(save_dir, "mouths", "manifest.txt"), "w")
+    manifest.write("".join(line + "\n" for line in lines))
+    manifest.close()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import argparse
+import multiprocessing
 import time
 
 import cv2
@@ -28,12 +29,70 @@ mean_face = np.float32([[6.825897, 6.760612, 4.402142],
                         [0.000000, -7.415691, 4.070434]])
 
 
+def rodrigues(rotation_vecs):
+    # (N, 3) rotation vectors to (N, 3, 3) rotation matrices, cv2.Rodrigues for a whole chunk
+    theta = np.linalg.norm(rotation_vecs, axis=1)[:, None, None]
+    axis = rotation_vecs / np.maximum(theta[:, 0], 1e-12)
+    cross = np.zeros((len(axis), 3, 3))
+    cross[:, 0, 1], cross[:, 0, 2], cross[:, 1, 2] = -axis[:, 2], axis[:, 1], -axis[:, 0]
+    cross = cross - cross.transpose(0, 2, 1)
+    outer = axis[:, :, None] * axis[:, None, :]
+    return np.cos(theta) * np.eye(3) + (1 - np.cos(theta)) * outer + np.sin(theta) * cross
+
+
+def givens(s, c):
+    z = 1 / np.sqrt(c * c + s * s + np.finfo(np.float64).eps)
+    return s * z, c * z
+
+
+def euler_angles(rotation_mats):
+    '''
+    (N, 3, 3) rotation matrices to (N, 3) Euler angles in degrees around x, y and z.
+    Vectorized port of the RQ decomposition of cv2.decomposeProjectionMatrix, including its 180 degree ambiguity fix.
+    '''
+    num = len(rotation_mats)
+    M = rotation_mats.astype(np.float64)
+
+    s, c = givens(M[:, 2, 1], M[:, 2, 2])
+    Qx = np.zeros((num, 3, 3))
+    Qx[:, 0, 0] = 1
+    Qx[:, 1, 1], Qx[:, 1, 2], Qx[:, 2, 1], Qx[:, 2, 2] = c, s, -s, c
+    R = M @ Qx
+
+    s, c = givens(-R[:, 2, 0], R[:, 2, 2])
+    Qy = np.zeros((num, 3, 3))
+    Qy[:, 1, 1] = 1
+    Qy[:, 0, 0], Qy[:, 0, 2], Qy[:, 2, 0], Qy[:, 2, 2] = c, -s, s, c
+    R = R @ Qy
+
+    s, c = givens(R[:, 1, 0], R[:, 1, 1])
+    Qz = np.zeros((num, 3, 3))
+    Qz[:, 2, 2] = 1
+    Qz[:, 0, 0], Qz[:, 0, 1], Qz[:, 1, 0], Qz[:, 1, 1] = c, s, -s, c
+    R = R @ Qz
+
+    # the diagonal of R except the last entry has to be positive, otherwise rotate by 180 degrees
+    flip_z = (R[:, 0, 0] < 0) & (R[:, 1, 1] < 0)
+    flip_y = (R[:, 0, 0] < 0) & (R[:, 1, 1] >= 0)
+    flip_x = (R[:, 0, 0] >= 0) & (R[:, 1, 1] < 0)
+    Qz[flip_z, :2, :2] *= -1
+    Qz[flip_y | flip_x] = Qz[flip_y | flip_x].transpose(0, 2, 1)
+    Qy[flip_y] *= np.array([[-1, 1, -1], [1, 1, 1], [-1, 1, -1]])
+    Qy[flip_x] = Qy[flip_x].transpose(0, 2, 1)
+    Qx[flip_x, 1:, 1:] *= -1
+
+    def angle(cos, sin):
+        return np.degrees(np.arccos(np.clip(cos, -1, 1))) * np.where(sin >= 0, 1, -1)
+
+    return np.stack([angle(Qx[:, 1, 1], Qx[:, 1, 2]), angle(Qy[:, 0, 0], Qy[:, 2, 0]), angle(Qz[:, 0, 0], Qz[:, 0, 1])], axis=1)
+
+
 class HeadPose():
     def __init__(self, model_path='data/dlib/shape_predictor_68_face_landmarks.dat'):
         self.face_detector = dlib.get_frontal_face_detector()
         self.landmark_predictor = dlib.shape_predictor(model_path)
 
-    def predict(self, image):
+    def image_points(self, image):
         # face_position = self.face_detector(image, 1)
         # if len(face_position) == 0:
         #     return None
@@ -42,15 +101,22 @@ class HeadPose():
         face_position = dlib.rectangle(0, 0, image.shape[0], image.shape[1])
         landmarks = self.landmark_predictor(image, face_position)
         landmarks = face_utils.shape_to_np(landmarks)
-        image_pts = np.float32([landmarks[17], landmarks[21], landmarks[22], landmarks[26], landmarks[36],
-                                landmarks[39], landmarks[42], landmarks[45], landmarks[31], landmarks[35],
-                                landmarks[48], landmarks[54], landmarks[57], landmarks[8]])
-        _, rotation_vec, translation_vec = cv2.solvePnP(mean_face, image_pts, cam_matrix, dist_coeffs)
-        rotation_mat, _ = cv2.Rodrigues(rotation_vec)
-        pose_mat = cv2.hconcat((rotation_mat, translation_vec))
-        _, _, _, _, _, _, euler_angle = cv2.decomposeProjectionMatrix(pose_mat)
+        return np.float32([landmarks[17], landmarks[21], landmarks[22], landmarks[26], landmarks[36],
+                           landmarks[39], landmarks[42], landmarks[45], landmarks[31], landmarks[35],
+                           landmarks[48], landmarks[54], landmarks[57], landmarks[8]])
+
+    def predict_batch(self, images):
+        # landmarks and solvePnP per image, the conversion to Euler angles for all images at once
+        rotation_vecs = []
+        for image in images:
+            _, rotation_vec, _ = cv2.solvePnP(mean_face, self.image_points(image), cam_matrix, dist_coeffs)
+            rotation_vecs.append(rotation_vec[:, 0])
+        euler_angle = euler_angles(rodrigues(np.array(rotation_vecs, dtype=np.float64).reshape(-1, 3)))
+        return {'pitch': euler_angle[:, 0], 'yaw': -euler_angle[:, 1], 'roll': euler_angle[:, 2]}
 
-        return {'pitch': euler_angle[0, 0], 'yaw': -euler_angle[1, 0], 'roll': euler_angle[2, 0]}
+    def predict(self, image):
+        euler_angle = self.predict_batch([image])
+        return {key: value[0] for key, value in euler_angle.items()}
 
     def predict_from_path(self, image_path):
         image = cv2.imread(image_path)
@@ -58,6 +124,53 @@ class HeadPose():
         return self.predict(image)
 
 
+worker_head_pose = None  # HeadPose of a PoseEngine worker process
+
+
+def init_worker(model_path):
+    global worker_head_pose
+    worker_head_pose = HeadPose(model_path)
+
+
+def predict_chunk(chunk):
+    load, items = chunk
+    images = items if load is None else [load(item) for item in items]
+    return worker_head_pose.predict_batch(images)
+
+
+class PoseEngine():
+    '''
+    Pool of processes that each load the dlib landmark model once and estimate the head pose of chunks of images.
+
+        with PoseEngine(processes=8) as engine:
+            for angles in engine.map(files, load=load_frame):
+                ...
+
+    load runs in the workers too, so reading the images is parallel as well. It has to be a module level function.
+    '''
+
+    def __init__(self, model_path='data/dlib/shape_predictor_68_face_landmarks.dat', processes=None, chunk_size=32):
+        self.chunk_size = chunk_size
+        self.pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(model_path,))
+
+    def map(self, items, load=None):
+        # yields the angles of every item in the order of items while later chunks are still being processed
+        chunks = [(load, items[i:i + self.chunk_size]) for i in range(0, len(items), self.chunk_size)]
+        for euler_angle in self.pool.imap(predict_chunk, chunks):
+            for i in range(len(euler_angle['yaw'])):
+                yield {key: value[i] for key, value in euler_angle.items()}
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--path')
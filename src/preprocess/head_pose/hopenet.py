@@ -1,5 +1,6 @@
 import argparse
 import os
+import time
 
 import torch
 import torch.nn as nn
@@ -12,40 +13,136 @@ from torchvision import transforms
 
 from src.models.hopenet.hopenet import Hopenet
 
+HOPENET_CHECKPOINT = 'data/hopenet/hopenet_robust_alpha1.pkl'
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def resize_shorter(frames, size):
+    # (N, C, H, W) float, shorter side to size like transforms.Resize(size)
+    height, width = frames.shape[-2:]
+    if height <= width:
+        output_size = (size, int(size * width / height))
+    else:
+        output_size = (int(size * height / width), size)
+    return F.interpolate(frames, size=output_size, mode='bilinear', align_corners=False)
+
+
+def load_model(checkpoint_path=HOPENET_CHECKPOINT):
+    model = Hopenet()
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model.load_state_dict(checkpoint, strict=False)
+    model.eval()
+    return model
+
+
+def fuse_model(model):
+    # folds every BatchNorm into the convolution before it, the model has to be in eval mode
+    modules = [['conv1', 'bn1', 'relu']]
+    for layer in ['layer1', 'layer2', 'layer3', 'layer4']:
+        for i, block in enumerate(getattr(model, layer)):
+            modules += [[f"{layer}.{i}.conv{j}", f"{layer}.{i}.bn{j}"] for j in range(1, 4)]
+            if block.downsample is not None:
+                modules.append([f"{layer}.{i}.downsample.0", f"{layer}.{i}.downsample.1"])
+    return torch.quantization.fuse_modules(model, modules)
+
+
+def export_model(output_path, checkpoint_path=HOPENET_CHECKPOINT, quantize=False):
+    '''
+    Exports HopeNet for CPU inference with the BatchNorms folded into the convolutions,
+    as TorchScript for a .pt output_path or as ONNX for .onnx, which needs onnxruntime to be loaded again.
+    quantize converts the Linear layers to int8 with dynamic quantization, the convolutions stay float32.
+    '''
+    if not os.path.exists(checkpoint_path):
+        HeadPose.download_model(checkpoint_path)
+    model = fuse_model(load_model(checkpoint_path))
+    if quantize:
+        assert output_path.endswith(".pt"), "Dynamically quantized models can only be exported with TorchScript"
+        # torch 1.3 takes a qconfig_dict, a set of module types only works from 1.4 on
+        model = torch.quantization.quantize_dynamic(model, {nn.Linear: torch.quantization.default_dynamic_qconfig})
+
+    example = torch.zeros(1, 3, 224, 224)
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    if output_path.endswith(".onnx"):
+        torch.onnx.export(
+            model,
+            example,
+            output_path,
+            input_names=['frames'],
+            output_names=['yaw', 'pitch', 'roll'],
+            dynamic_axes={'frames': {0: 'batch'}, 'yaw': {0: 'batch'}, 'pitch': {0: 'batch'}, 'roll': {0: 'batch'}},
+        )
+    else:
+        torch.jit.trace(model, example).save(output_path)
+
+
+class ONNXModel():
+    # runs a model exported with export_model on the CPU and returns torch tensors like Hopenet
+    def __init__(self, path):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path)
+
+    def __call__(self, data):
+        outputs = self.session.run(None, {'frames': data.cpu().numpy()})
+        return [torch.from_numpy(output) for output in outputs]
+
 
 class HeadPose():
-    def __init__(self, checkpoint_path='data/hopenet/hopenet_robust_alpha1.pkl', transform=None):
-        if not os.path.exists(checkpoint_path):
-            self.download_model(checkpoint_path)
+    '''
+    model_path loads a model exported with export_model instead of the checkpoint, e.g. for machines without a GPU.
+    '''
+
+    def __init__(self, checkpoint_path=HOPENET_CHECKPOINT, transform=None, model_path=None):
         self.transform = transform
+        self.tensor_transform = transform is None
         if self.transform is None:
             self.transform = transforms.Compose([
                 transforms.Resize(224),
                 transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+                transforms.Normalize(mean=MEAN, std=STD)
             ])
 
         num_bins = 66
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        if model_path is None:
+            if not os.path.exists(checkpoint_path):
+                self.download_model(checkpoint_path)
+            self.model = load_model(checkpoint_path)
+            self.model.to(self.device)
+        elif model_path.endswith(".onnx"):
+            self.device = torch.device("cpu")
+            self.model = ONNXModel(model_path)
+        else:
+            self.model = torch.jit.load(model_path, map_location=self.device)
         self.idx_tensor = torch.FloatTensor([idx for idx in range(num_bins)]).to(self.device)
-        self.model = Hopenet()
-        checkpoint = torch.load(checkpoint_path)
-        self.model.load_state_dict(checkpoint, strict=False)
-        self.model.to(self.device)
-        self.model.eval()
+        self.mean = torch.tensor(MEAN, device=self.device).view(1, -1, 1, 1)
+        self.std = torch.tensor(STD, device=self.device).view(1, -1, 1, 1)
 
-    def download_model(self, path):
+    @staticmethod
+    def download_model(path):
         os.makedirs(os.path.dirname(path), exist_ok=True)
         print("Downloading hopenet model")
         url = "https://github.com/theSoenke/headpose/releases/download/0.1.0/hopenet.pkl"
         wget.download(url, path)
 
+    def transform_tensor(self, frames):
+        # (N, C, H, W) uint8 frames are moved to the device as uint8 and resized and normalized there
+        frames = frames.to(self.device).float().div_(255)
+        frames = resize_shorter(frames, 224)
+        return frames.sub_(self.mean).div_(self.std)
+
     @torch.no_grad()
     def predict(self, image):
-        if isinstance(image, torch.Tensor) and len(image.shape) == 4:
+        '''
+        image: (N, C, H, W) or (C, H, W) uint8 tensor, PIL image or path
+        The frames of a batch may come from many videos, see DetectionScheduler.
+        '''
+        if isinstance(image, torch.Tensor) and self.tensor_transform:
+            data = self.transform_tensor(image if len(image.shape) == 4 else image.unsqueeze(0))
+        elif isinstance(image, torch.Tensor) and len(image.shape) == 4:
             data = torch.stack([self.transform(transforms.functional.to_pil_image(img)) for img in image])
         elif isinstance(image, torch.Tensor):
-            data = self.transform(transforms.functional.to_pil_image(image))
+            data = self.transform(transforms.functional.to_pil_image(image)).unsqueeze(dim=0)
         elif isinstance(image, str):
             image = Image.open(image)
             data = self.transform(image).unsqueeze(dim=0)
@@ -62,3 +159,25 @@ class HeadPose():
         pitch = torch.sum(pitch * self.idx_tensor, dim=1) * 3 - 99
         roll = torch.sum(roll * self.idx_tensor, dim=1) * 3 - 99
         return {'yaw': yaw, 'pitch': pitch, 'roll': roll}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--export', help='Path of the exported model, .pt for TorchScript or .onnx')
+    parser.add_argument('--quantize', action='store_true', help='Quantize the Linear layers to int8')
+    parser.add_argument('--model', help='Exported model to benchmark instead of the checkpoint')
+    parser.add_argument('--batch_size', type=int, default=64)
+    args = parser.parse_args()
+
+    if args.export != None:
+        export_model(args.export, quantize=args.quantize)
+        print(f"Exported {args.export}")
+    else:
+        head_pose = HeadPose(model_path=args.model)
+        frames = torch.randint(0, 256, (args.batch_size, 3, 160, 160), dtype=torch.uint8)
+        head_pose.predict(frames)
+        start_time = time.time()
+        for i in range(10):
+            head_pose.predict(frames)
+        elapsed_time = time.time() - start_time
+        print(f"{args.batch_size * 10 / elapsed_time:.1f} frames/s")
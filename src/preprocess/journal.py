@@ -0,0 +1,87 @@
+import json
+import os
+
+RESUME_MODES = [None, 'resume', 'only_missing']
+
+
+class Journal():
+    '''
+    Append-only record of the finished items of a preprocessing run, one JSON line per item:
+    {"key": ..., "output": path of the written file or null, "failed": false, ...any other result fields}.
+    Every line is flushed when written, so an interrupted run loses at most the items in flight.
+
+    resume: None starts over and deletes the journal,
+            'resume' skips every item in the journal, including failed ones,
+            'only_missing' also processes the failed items and those whose output file no longer exists,
+            e.g. to add new videos to an existing run.
+    The preprocessor writes its final outputs from entries() at the end, the journal is kept for the next run.
+    '''
+
+    def __init__(self, path, resume=None):
+        assert resume in RESUME_MODES
+        self.path = path
+        self.records = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if resume is None:
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            self.records = self.load(path)
+        if resume == 'only_missing':
+            self.records = {key: record for key, record in self.records.items() if not self.missing(record)}
+            self.compact()
+        self.file = open(path, "a")
+
+    @staticmethod
+    def load(path):
+        records = {}
+        if not os.path.exists(path):
+            return records
+        with open(path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # last line of a run that was killed while writing
+                records[record['key']] = record
+        return records
+
+    @staticmethod
+    def missing(record):
+        return record['failed'] or (record['output'] is not None and not os.path.exists(record['output']))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __getitem__(self, key):
+        return self.records[key]
+
+    def pending(self, keys):
+        # indices of the keys that still have to be processed
+        return [i for i, key in enumerate(keys) if key not in self.records]
+
+    def record(self, key, output=None, failed=False, **result):
+        record = {'key': key, 'output': output, 'failed': failed, **result}
+        self.records[key] = record
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def entries(self, keys=None, failed=False):
+        # records in the order of keys (default: insertion order), without failed items unless failed=True
+        records = self.records.values() if keys is None else [self.records[key] for key in keys if key in self.records]
+        return [record for record in records if failed or not record['failed']]
+
+    def compact(self):
+        # rewrites the journal with one line per item
+        temp_path = f"{self.path}.{os.getpid()}"
+        with open(temp_path, "w") as file:
+            for record in self.records.values():
+                file.write(json.dumps(record) + "\n")
+        os.replace(temp_path, self.path)
+
+    def close(self):
+        self.file.close()
+        self.compact()
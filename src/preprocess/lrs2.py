@@ -1,5 +1,6 @@
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import ray
@@ -11,40 +12,96 @@ from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
 from tqdm import tqdm
 
+from src.data.crop_index import convert_crop_file
 from src.data.lrs2 import LRS2Dataset
-from src.data.transforms import Crop
+from src.data.shards import write_shards
+from src.data.transforms import Crop, grayscale_clip
+from src.data.video import read_video
 from src.preprocess.face_detection.facenet import FaceNet
-from src.preprocess.head_pose.hopenet import HeadPose
+from src.preprocess.face_detection.scheduler import DetectionScheduler
+from src.preprocess.head_pose.hopenet import HOPENET_CHECKPOINT, HeadPose
+from src.preprocess.journal import Journal
+from src.preprocess.tracking import KeyframeTracker
+from src.preprocess.work_queue import WorkQueue
+
+
+def extract_bb(landmarks):
+    left = int(landmarks[3])
+    upper = int(landmarks[8])
+    right = int(landmarks[4])
+    lower = int(landmarks[9])
+    return left, upper, right, lower
+
+
+def mouth_box(landmarks):
+    # 96x64 box around the mouth of the largest face, None when no face was found
+    if landmarks is None or len(landmarks) == 0 or landmarks.shape[1] == 0 or landmarks.shape[0] == 0:
+        return None
+
+    if landmarks.shape[1] >= 2:
+        # choose largest face
+        selected = 0
+        max_size = 0
+        for i in range(landmarks.shape[1]):
+            left, upper, right, lower = extract_bb(landmarks[:, i])
+            size = (right - left) * (lower - upper)
+            if size > max_size:
+                max_size = size
+                selected = i
+        landmarks = landmarks[:, selected]
+
+    width = 96
+    height = 64
+
+    left, upper, right, lower = extract_bb(landmarks)
+    horizontal_center = (left + right) / 2
+    vertical_center = (upper + lower) / 2
+
+    return [
+        horizontal_center - (width // 2),
+        vertical_center - (height // 2),
+        horizontal_center + (width // 2),
+        vertical_center + (height // 2),
+    ]
+
+
+def detect_mouth_boxes(detect_landmarks, video, keyframe_interval, file_name):
+    '''
+    Runs MTCNN on keyframes of a (T, H, W, C) uint8 video and tracks the mouth in between, see KeyframeTracker.
+    detect_landmarks takes (N, H, W, C) frames, either FaceNet.detect directly or a DetectionScheduler.
+    Returns one "left;upper;right;lower" mouth box per frame, or None when no face was found.
+    '''
+
+    def detect(indices):
+        try:
+            batch_landmarks = detect_landmarks(video[indices])
+        except Exception as e:
+            print(f"Could not process: {file_name}", e)
+            return [None for _ in indices]
+        if len(indices) != len(batch_landmarks):
+            print("Mismatch of detected landmarks")
+            return [None for _ in indices]
+        return [mouth_box(landmarks) for landmarks in batch_landmarks]
 
+    tracker = KeyframeTracker(detect, interval=keyframe_interval)
+    boxes = tracker.track(grayscale_clip(video)[..., 0].numpy())
+    if boxes is None:
+        print(f"No face found: {file_name}")
+        return None
+    return [";".join([str(f"{pos}") for pos in box]) for box in boxes.tolist()]
 
-def extract_angles(path, output_path, num_workers):
-    head_pose = HeadPose()
 
-    os.makedirs(output_path, exist_ok=True)
-    for mode in ['train', 'val', 'test']:
-        dataset = LRS2Dataset(path=path, mode=mode, in_channels=3, estimate_pose=True)
-        data_loader = DataLoader(dataset, batch_size=32, shuffle=False, num_workers=num_workers)
-        lines = []
-        with tqdm(total=len(dataset)) as progress:
-            for batch in data_loader:
-                frames, _, input_lengths, ids = batch
-                for i, video in enumerate(frames):
-                    video = video.transpose(1, 0)[:input_lengths[i]]  # T C H W
-                    yaws = head_pose.predict(video)['yaw']
-                    yaws = ";".join([f"{yaw:.2f}" for yaw in yaws.cpu().numpy()])
-                    line = f"{dataset.file_names[ids[i]]};{yaws}"
-                    lines.append(line)
-                    progress.update(1)
-        file = open(f"{output_path}/{mode}.txt", "w")
-        file.write('\n'.join(lines))
-        file.close()
+def predict_yaws(predict_yaw, video):
+    # per frame yaw of a (T, H, W, C) uint8 video, predict_yaw batches the frames of many videos, see LRS2Preprocess
+    return np.array(predict_yaw(video), dtype=np.float32)
 
 
 class LRS2DatasetMouth(Dataset):
-    def __init__(self, path, mode="train", skip_frames=1):
-        self.skip_frames = skip_frames
+    def __init__(self, path, mode="train", keyframe_interval=10):
+        self.keyframe_interval = keyframe_interval
         self.file_paths, self.file_names = self.build_file_list(path, mode)
         self.facenet = FaceNet()
+        self.detect_landmarks = lambda frames: self.facenet.detect(frames)[1]
         # torchvision.set_video_backend('video_reader')
 
     def build_file_list(self, directory, mode):
@@ -70,87 +127,20 @@ class LRS2DatasetMouth(Dataset):
     def __len__(self):
         return len(self.file_names)
 
-    def extract_bb(self, landmarks):
-        left = int(landmarks[3])
-        upper = int(landmarks[8])
-        right = int(landmarks[4])
-        lower = int(landmarks[9])
-        return left, upper, right, lower
-
     def __getitem__(self, idx):
         file_name = self.file_names[idx]
-        video_path = self.file_paths[idx] + ".mp4"
-        video, _, _ = torchvision.io.read_video(video_path, pts_unit='sec')
-        frames = video.permute(0, 3, 1, 2)  # T C H W
-        num_frames = len(video)
-
-        every_nth_frame = []
-        for i, frame in enumerate(frames):
-            if i % self.skip_frames == 0:
-                every_nth_frame.append(frame)
-
-        boxes = []
-        try:
-            _, batch_landmarks = self.facenet.detect(every_nth_frame)
-        except Exception as e:
-            print(f"Could not process: {file_name}", e)
+        video = read_video(self.file_paths[idx] + ".mp4")
+        boxes = detect_mouth_boxes(self.detect_landmarks, video, self.keyframe_interval, file_name)
+        if boxes is None:
             return {'bb': [], 'file': file_name, 'skip': True}
-
-        if len(every_nth_frame) != len(batch_landmarks):
-            print("Mismatch of detected landmarks")
-            return {'bb': [], 'file': file_name, 'skip': True}
-
-        for landmarks in batch_landmarks:
-            if len(landmarks) == 0 or landmarks.shape[1] == 0 or landmarks.shape[0] == 0:
-                print(f"No face found: {video_path}")
-                return {'bb': [], 'file': file_name, 'skip': True}
-
-            if landmarks.shape[1] >= 2:
-                # choose largest face
-                selected = 0
-                max_size = 0
-                for i in range(landmarks.shape[1]):
-                    left, upper, right, lower = self.extract_bb(landmarks[:, i])
-                    size = (right - left) * (lower - upper)
-                    if size > max_size:
-                        max_size = size
-                        selected = i
-                landmarks = landmarks[:, selected]
-
-            width = 96
-            height = 64
-
-            left, upper, right, lower = self.extract_bb(landmarks)
-            horizontal_center = (left + right) / 2
-            vertical_center = (upper + lower) / 2
-
-            box = [
-                horizontal_center - (width // 2),
-                vertical_center - (height // 2),
-                horizontal_center + (width // 2),
-                vertical_center + (height // 2),
-            ]
-
-            box = [str(f"{pos}") for pos in box]
-            boxes.append(";".join(box))
-
-        all_boxes = []
-        for box in boxes:
-            for i in range(self.skip_frames):
-                if len(all_boxes) == num_frames:
-                    break
-                else:
-                    all_boxes.append(box)
-
-        assert len(all_boxes) == num_frames
-        return {'bb': all_boxes, 'file': file_name, 'skip': False}
+        return {'bb': boxes, 'file': file_name, 'skip': False}
 
 
 def mouth_bounding_boxes(path, output_path):
     os.makedirs(output_path, exist_ok=True)
 
     for mode in ['val', 'test', 'train', 'pretrain']:
-        dataset = LRS2DatasetMouth(path=path, mode=mode, skip_frames=5)
+        dataset = LRS2DatasetMouth(path=path, mode=mode)
         lines = []
         with tqdm(total=len(dataset)) as progress:
             progress.set_description(mode)
@@ -168,6 +158,7 @@ def mouth_bounding_boxes(path, output_path):
         file = open(f"{output_path}/{mode}_crop.txt", "w")
         file.write('\n'.join(lines))
         file.close()
+        convert_crop_file(f"{output_path}/{mode}_crop.txt")
 
 
 def prepare_language_model(path, output_path):
@@ -221,109 +212,133 @@ def build_file_list(directory, mode):
 
 
 @ray.remote(num_gpus=0.1)
-class FaceLandmarksExtract(object):
-    def __init__(self):
-        self.skip_frames = 5
+class LRS2Preprocess(object):
+    '''
+    Decodes every video once and runs both the face detector for the mouth crop boxes and HopeNet for the yaw of every frame.
+    The videos of a process_batch call run in parallel threads and share one DetectionScheduler per model, so MTCNN and
+    HopeNet see the frames of many videos at once instead of the few frames of one short clip.
+    Without estimate_pose HopeNet is not loaded and only the crop boxes are computed.
+    '''
+
+    def __init__(self, keyframe_interval=10, detection_batch_size=64, max_wait=0.05, threads=8, head_pose_model=None,
+                 pose_batch_size=256, estimate_pose=True):
+        self.keyframe_interval = keyframe_interval
         self.facenet = FaceNet()
-        self.batch_boxes = []
+        self.scheduler = DetectionScheduler(lambda frames: self.facenet.detect(frames)[1], detection_batch_size, max_wait)
+        self.pose_scheduler = None
+        if estimate_pose:
+            self.head_pose = HeadPose(model_path=head_pose_model)
+            self.pose_scheduler = DetectionScheduler(self.predict_yaw, pose_batch_size, max_wait)
+        self.pool = ThreadPoolExecutor(threads)
 
-    def extract_bb(self, landmarks):
-        left = int(landmarks[3])
-        upper = int(landmarks[8])
-        right = int(landmarks[4])
-        lower = int(landmarks[9])
-        return left, upper, right, lower
+    def predict_yaw(self, frames):
+        return self.head_pose.predict(frames.permute(0, 3, 1, 2))['yaw'].cpu().numpy()
 
     def process(self, path, file_name):
-        video_path = path + ".mp4"
-        video, _, _ = torchvision.io.read_video(video_path, pts_unit='sec')
-        frames = video.permute(0, 3, 1, 2)  # T C H W
-        num_frames = len(video)
+        # returns the line of {mode}_crop.txt, None without a face, and the line of {mode}.txt, None without estimate_pose
+        video = read_video(path + ".mp4")
 
-        every_nth_frame = []
-        for i, frame in enumerate(frames):
-            if i % self.skip_frames == 0:
-                every_nth_frame.append(frame)
+        yaw_line = None
+        if self.pose_scheduler is not None:
+            yaws = predict_yaws(self.pose_scheduler, video)
+            yaws = ";".join([f"{yaw:.2f}" for yaw in yaws])
+            yaw_line = f"{file_name};{yaws}"
 
-        boxes = []
-        try:
-            _, batch_landmarks = self.facenet.detect(every_nth_frame)
-        except Exception as e:
-            print(f"Could not process: {file_name}", e)
-            return {'bb': [], 'file': file_name, 'skip': True}
-
-        if len(every_nth_frame) != len(batch_landmarks):
-            print("Mismatch of detected landmarks")
-            return {'bb': [], 'file': file_name, 'skip': True}
-
-        for landmarks in batch_landmarks:
-            if len(landmarks) == 0 or landmarks.shape[1] == 0 or landmarks.shape[0] == 0:
-                print(f"No face found: {video_path}")
-                return {'bb': [], 'file': file_name, 'skip': True}
-
-            if landmarks.shape[1] >= 2:
-                # choose largest face
-                selected = 0
-                max_size = 0
-                for i in range(landmarks.shape[1]):
-                    left, upper, right, lower = self.extract_bb(landmarks[:, i])
-                    size = (right - left) * (lower - upper)
-                    if size > max_size:
-                        max_size = size
-                        selected = i
-                landmarks = landmarks[:, selected]
-
-            width = 96
-            height = 64
-
-            left, upper, right, lower = self.extract_bb(landmarks)
-            horizontal_center = (left + right) / 2
-            vertical_center = (upper + lower) / 2
-
-            box = [
-                horizontal_center - (width // 2),
-                vertical_center - (height // 2),
-                horizontal_center + (width // 2),
-                vertical_center + (height // 2),
-            ]
+        boxes = detect_mouth_boxes(self.scheduler, video, self.keyframe_interval, file_name)
+        crop_line = None if boxes is None else f"{file_name}:{'|'.join(boxes)}"
+        return crop_line, yaw_line
 
-            box = [str(f"{pos}") for pos in box]
-            boxes.append(";".join(box))
+    def process_batch(self, items):
+        # (crop_line, yaw_line) per (path, file_name), or the error message when the video failed
+        def process(item):
+            try:
+                return self.process(*item)
+            except Exception as e:
+                print(f"Failed: {item[1]}", e)
+                return str(e)
 
-        all_boxes = []
-        for box in boxes:
-            for i in range(self.skip_frames):
-                if len(all_boxes) == num_frames:
-                    break
-                else:
-                    all_boxes.append(box)
+        return list(self.pool.map(process, items))
 
-        assert len(all_boxes) == num_frames
+    def mean_batch_size(self):
+        return self.scheduler.mean_batch_size()
 
-        boxes = "|".join(all_boxes)
-        self.batch_boxes.append(f"{file_name}:{boxes}")
 
-    def get_results(self):
-        return self.batch_boxes
+def write_lines(path, lines):
+    file = open(path, "w")
+    file.write('\n'.join(lines))
+    file.close()
 
 
-def preprocess(path, output_path, num_workers=4):
+def preprocess(path, output_path, num_workers=4, max_in_flight=2, resume=None, keyframe_interval=10, videos_per_task=16,
+               detection_batch_size=64, max_wait=0.05, head_pose_model=None, pretrain_yaws=False):
+    '''
+    Writes the mouth crop boxes to {mode}_crop.txt and the per frame yaws to {mode}.txt in a single pass over the videos.
+    Yaws are computed for train, val and test, pretrain_yaws also runs HopeNet over the long pretrain videos.
+    Finished videos are recorded in {mode}.journal.jsonl as soon as they are done, see Journal for resume.
+    Every task processes videos_per_task videos, whose keyframes are detected in batches of detection_batch_size.
+    head_pose_model is a HopeNet export for CPU inference, see src.preprocess.head_pose.hopenet.export_model.
+    '''
     ray.init(num_cpus=num_workers, num_gpus=1)
+    os.makedirs(output_path, exist_ok=True)
+    if head_pose_model is None and not os.path.exists(HOPENET_CHECKPOINT):
+        HeadPose.download_model(HOPENET_CHECKPOINT)  # once, not in every actor
 
     for mode in ['val', 'test', 'train', 'pretrain']:
         start_time = time.time()
+        estimate_pose = mode != 'pretrain' or pretrain_yaws
         paths, file_list = build_file_list(path, mode=mode)
-        actors = [FaceLandmarksExtract.remote() for _ in range(num_workers)]
-        for i in range(len(file_list)):
-            actors[i % num_workers].process.remote(paths[i], file_list[i])
-
-        results = ray.get([actor.get_results.remote() for actor in actors])
-        results = np.concatenate(results)
-
-        file = open(f"{output_path}/{mode}_crop.txt", "w")
-        file.write('\n'.join(results))
-        file.close()
+        journal = Journal(f"{output_path}/{mode}.journal.jsonl", resume)
+        pending = journal.pending(file_list)
+        print(f"{mode}: {len(file_list) - len(pending)} videos done, {len(pending)} to process")
+
+        if len(pending) > 0:
+            actors = [
+                LRS2Preprocess.remote(keyframe_interval, detection_batch_size, max_wait, videos_per_task, head_pose_model,
+                                      estimate_pose=estimate_pose)
+                for _ in range(num_workers)
+            ]
+            queue = WorkQueue(actors, max_in_flight=max_in_flight)
+
+            def write(batch, results):
+                for (_, file_name), result in zip(batch, results):
+                    if isinstance(result, str):
+                        journal.record(file_name, failed=True, error=result)
+                    else:
+                        crop_line, yaw_line = result
+                        journal.record(file_name, crop=crop_line, yaw=yaw_line)
+
+            def failure(batch, error):
+                for _, file_name in batch:
+                    journal.record(file_name, failed=True, error=str(error))
+
+            items = [(paths[i], file_list[i]) for i in pending]
+            batches = [items[i:i + videos_per_task] for i in range(0, len(items), videos_per_task)]
+            queue.run(batches, lambda actor, batch: actor.process_batch.remote(batch), write, description=mode, failure=failure)
+            batch_sizes = ray.get([actor.mean_batch_size.remote() for actor in actors])
+            print(f"Mean detection batch size: {np.mean(batch_sizes):.1f}")
+            for actor in actors:
+                ray.kill(actor)
+        journal.close()
+
+        records = journal.entries(file_list)
+        write_lines(f"{output_path}/{mode}_crop.txt", [record['crop'] for record in records if record['crop'] is not None])
+        if estimate_pose:
+            write_lines(f"{output_path}/{mode}.txt", [record['yaw'] for record in records])
+        convert_crop_file(f"{output_path}/{mode}_crop.txt")
 
         elapsed_time = time.time() - start_time
         duration = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
         print(f"Processed {mode} in {duration}")
+
+
+def preprocess_shards(path, output_path, workers=0, resume=None):
+    # long samples are kept, the datasets drop them while streaming according to their max_timesteps
+    for split in ['pretrain', 'train', 'val', 'test']:
+        print(f"Generating {split} shards")
+        if split == 'pretrain':
+            dataset = LRS2Dataset(path=path, mode='train', pretrain=True, pretrain_words=1)
+        else:
+            dataset = LRS2Dataset(path=path, mode=split, max_timesteps=10000)
+        journal = Journal(f"{output_path}/{split}.journal.jsonl", resume)
+        write_shards(dataset, f"{output_path}/{split}", workers=workers, journal=journal)
+        journal.close()
@@ -1,54 +1,168 @@
+import math
 import os
 import random
 
+import numpy as np
 import psutil
 import torch
 import torchvision
 import torchvision.transforms.functional as F
 from PIL import Image
-from tables import Float32Col, Int32Col, IsDescription, StringCol, open_file
-from torch.utils.data import DataLoader, Dataset
+from tables import Float32Col, Int32Col, IsDescription, StringCol, UInt8Col, open_file
+from torch.utils.data import DataLoader, Dataset, Subset
 from torchvision import transforms
 from tqdm import tqdm
 
+from src.data.hdf5 import append_batch, create_table
 from src.data.lrw import LRWDataset
+from src.data.shards import write_shards
+from src.data.transforms import center_crop_clip, grayscale_clip
+from src.data.video import read_frame
+from src.preprocess.journal import Journal
 
 
-def extract_angles(path, output_path, num_workers, seed):
+class LRWPoseFrames(LRWDataset):
+    '''
+    Only decodes the middle frame of every clip, which the head pose is estimated on, and returns it with the file name.
+    '''
+
+    def __init__(self, path, mode, seed=42):
+        super().__init__(path=path, num_words=500, in_channels=3, mode=mode, estimate_pose=True, seed=seed)
+
+    def __getitem__(self, idx):
+        frame = read_frame(self.video_paths[idx], index=14)  # (H, W, C) uint8
+        return {'frame': frame.permute(2, 0, 1), 'file': self.files[idx]}
+
+
+def extract_angles(path, output_path, num_workers, seed, resume=None, head_pose_model=None):
     from src.preprocess.head_pose.hopenet import HeadPose
-    head_pose = HeadPose()
+    head_pose = HeadPose(model_path=head_pose_model)
+    os.makedirs(output_path, exist_ok=True)
 
     words = None
     for mode in ['train', 'val', 'test']:
-        dataset = LRWDataset(path=path, num_words=500, mode=mode, estimate_pose=True, seed=seed)
+        dataset = LRWPoseFrames(path=path, mode=mode, seed=seed)
         if words != None:
             assert words == dataset.words
         words = dataset.words
-        data_loader = DataLoader(dataset, batch_size=256, shuffle=False, num_workers=num_workers)
-        lines = ""
-        with tqdm(total=len(dataset)) as progress:
+        journal = Journal(f"{output_path}/{mode}.journal.jsonl", resume)
+        pending = journal.pending(dataset.files)
+        data_loader = DataLoader(Subset(dataset, pending), batch_size=256, shuffle=False, num_workers=num_workers)
+        with tqdm(total=len(dataset), initial=len(dataset) - len(pending)) as progress:
             for batch in data_loader:
-                frames = batch['angle_frame']
+                frames = batch['frame']
                 files = batch['file']
                 yaws = head_pose.predict(frames)['yaw']
-                for i in range(len(batch['frames'])):
-                    line = f"{files[i]},{yaws[i].item():.2f}\n"
-                    lines += line
+                for i in range(len(files)):
+                    journal.record(files[i], yaw=round(yaws[i].item(), 2))
                     progress.update(1)
+        journal.close()
+
+        lines = [f"{record['key']},{record['yaw']:.2f}\n" for record in journal.entries(dataset.files)]
         file = open(f"{output_path}/{mode}.txt", "w")
-        file.write(lines)
+        file.write("".join(lines))
         file.close()
 
 
+def preprocess_shards(path, output, workers=None, seed=42, resume=None):
+    workers = psutil.cpu_count() if workers == None else workers
+    for mode in ['train', 'val', 'test']:
+        print("Generating %s shards" % mode)
+        estimate_pose = not os.path.exists(f"data/preprocess/lrw/{mode}.txt")
+        dataset = LRWDataset(path=path, num_words=500, mode=mode, estimate_pose=estimate_pose, seed=seed)
+        journal = Journal(f"{output}/{mode}.journal.jsonl", resume)
+        write_shards(dataset, f"{output}/{mode}", workers=workers, seed=seed, journal=journal)
+        journal.close()
+
+
+class LRWFrames(LRWDataset):
+    def build_tensor(self, frames):
+        volume = grayscale_clip(center_crop_clip(frames[:29], (112, 112)))
+        return volume.squeeze(-1)  # (D, H, W) uint8
+
+
+def preprocess_frames(path, output, workers=None, seed=42, shard_size=4096, resume=None):
+    workers = psutil.cpu_count() if workers == None else workers
+    os.makedirs(output, exist_ok=True)
+
+    words = None
+    for mode in ['train', 'val', 'test']:
+        print("Generating %s frames" % mode)
+        estimate_pose = not os.path.exists(f"data/preprocess/lrw/{mode}.txt")
+        dataset = LRWFrames(path=path, num_words=500, mode=mode, estimate_pose=estimate_pose, seed=seed)
+        if words != None:
+            assert words == dataset.words
+        words = dataset.words
+
+        num_samples = len(dataset)
+        num_shards = math.ceil(num_samples / shard_size)
+        shard_keys = [f"{mode}_{shard_id:03d}" for shard_id in range(num_shards)]
+        journal = Journal(f"{output}/{mode}.journal.jsonl", resume)
+        if any(record['num_samples'] != num_samples for record in journal.entries(shard_keys)):
+            raise ValueError(f"The number of {mode} samples changed, the shards have to be generated without --resume")
+
+        pending = journal.pending(shard_keys)
+        with tqdm(total=num_samples, initial=num_samples - sum(min(shard_size, num_samples - i * shard_size) for i in pending)) as progress:
+            for shard_id in pending:
+                indices = range(shard_id * shard_size, min((shard_id + 1) * shard_size, num_samples))
+                shard_path = f"{output}/{mode}_{shard_id:03d}.npy"
+                shard = np.lib.format.open_memmap(shard_path, mode='w+', dtype=np.uint8, shape=(len(indices), 29, 112, 112))
+                labels, yaws, files = [], [], []
+
+                data_loader = DataLoader(Subset(dataset, indices), batch_size=64, shuffle=False, num_workers=workers)
+                offset = 0
+                for batch in data_loader:
+                    batch_size = len(batch['file'])
+                    shard[offset:offset + batch_size] = batch['frames'].numpy()
+                    labels += batch['label'].view(-1).tolist()
+                    yaws += [float('nan')] * batch_size if estimate_pose else batch['yaw'].view(-1).tolist()
+                    files += list(batch['file'])
+                    offset += batch_size
+                    progress.update(batch_size)
+                shard.flush()
+                del shard
+                journal.record(shard_keys[shard_id], output=shard_path, labels=labels, yaws=yaws, files=files, num_samples=num_samples)
+        journal.close()
+
+        records = journal.entries(shard_keys)
+        np.savez(
+            f"{output}/{mode}.npz",
+            labels=np.array([label for record in records for label in record['labels']], dtype=np.int16),
+            yaws=np.array([yaw for record in records for yaw in record['yaws']], dtype=np.float32),
+            files=np.array([file for record in records for file in record['files']]),
+            words=np.array(words),
+            shard_size=shard_size,
+        )
+        print(f"Saved {num_samples} samples in {num_shards} shards")
+
+
+class LRWExport(LRWDataset):
+    '''
+    uint8 clips for the HDF5 export. ClipTransform leaves the flip of uint8 clips to the device_transform,
+    which HDF5Dataset does not apply, so augmented training clips are flipped here with probability 0.5 decided by the seed.
+    '''
+
+    def __init__(self, path, num_words, mode, augmentations=False, seed=42):
+        super().__init__(path=path, num_words=num_words, mode=mode, augmentations=augmentations, seed=seed, uint8=True)
+        self.flips = np.random.RandomState(seed).rand(len(self)) < self.transform.flip_probability
+
+    def __getitem__(self, idx):
+        sample = super().__getitem__(idx)
+        if self.flips[idx]:
+            sample['frames'] = sample['frames'].flip(-1)
+        return sample
+
+
 class Video(IsDescription):
     label = Int32Col()
-    frames = Float32Col(shape=(29, 112, 112))
+    frames = UInt8Col(shape=(29, 112, 112))
     yaw = Float32Col()
     file = StringCol(32)
     word = StringCol(32)
 
 
-def preprocess(path, output, num_words, augmentation=False, workers=None):
+def preprocess(path, output, num_words, augmentation=False, workers=None, resume=None, seed=42):
+    # needs the yaws of extract_angles (preprocess.py lrw), rows are written in a random order, see preprocess_hdf5
     workers = psutil.cpu_count() if workers == None else workers
     if os.path.exists(output) == False:
         os.makedirs(output)
@@ -57,13 +171,14 @@ def preprocess(path, output, num_words, augmentation=False, workers=None):
         output_path = "%s/lrw_aug_%d.h5" % (output, num_words)
     else:
         output_path = "%s/lrw_%d.h5" % (output, num_words)
-    if os.path.exists(output_path):
+    if os.path.exists(output_path) and resume is None:
         os.remove(output_path)
+    journal = Journal(f"{output_path}.journal.jsonl", resume)
 
     words = None
     for mode in ['train', 'val', 'test']:
         print("Generating %s data" % mode)
-        dataset = LRWDataset(path=path, num_words=num_words, mode=mode, augmentations=augmentation, estimate_pose=True)
+        dataset = LRWExport(path=path, num_words=num_words, mode=mode, augmentations=augmentation, seed=seed)
         if words != None:
             assert words == dataset.words
         words = dataset.words
@@ -72,26 +187,54 @@ def preprocess(path, output, num_words, augmentation=False, workers=None):
             output_path=output_path,
             table=mode,
             workers=workers,
+            journal=journal,
+            seed=seed,
         )
+    journal.close()
     print("Saved preprocessed file: %s" % output_path)
 
 
-def preprocess_hdf5(dataset, output_path, table, workers=0):
+def create_frames_table(file, name, dataset, description=Video):
+    # uint8 frames, HDF5Dataset normalizes them with the mean and std of the dataset when they are read
+    table = create_table(file, name, description, expectedrows=len(dataset), sample_chunks=True)
+    table.attrs.mean = dataset.transform.mean
+    table.attrs.std = dataset.transform.std
+    return table
+
+
+def open_table(file, name, dataset, num_rows=0, description=Video):
+    # keeps the first num_rows rows of an existing table, rows written after the last journal entry are dropped
+    if f"/{name}" not in file:
+        if num_rows > 0:
+            raise ValueError(f"{file.filename} has no table {name}, run with --only-missing to write it again")
+        return create_frames_table(file, name, dataset, description)
+    table = file.get_node("/", name)
+    if table.nrows < num_rows:
+        raise ValueError(f"{file.filename} has fewer {name} rows than the journal, run with --only-missing")
+    table.truncate(num_rows)
+    return table
+
+
+def preprocess_hdf5(dataset, output_path, table, workers=0, journal=None, seed=42, description=Video):
+    # LRWDataset is ordered by word, ContiguousBatchSampler reads consecutive rows, so they are written shuffled
+    # dataset returns dicts with the columns of description, frames as uint8
     file = open_file(output_path, mode="a")
-    table = file.create_table("/", table, Video, expectedrows=len(dataset))
-    row = table.row
-    data_loader = DataLoader(dataset, batch_size=128, shuffle=False, num_workers=workers)
+    order = np.random.RandomState(seed).permutation(len(dataset))
+    indices = order
+    if journal is None:
+        table = create_frames_table(file, table, dataset, description)
+    else:
+        keys = [f"{table}/{dataset.files[i]}" for i in order]
+        indices = order[journal.pending(keys)]
+        table = open_table(file, table, dataset, num_rows=len(dataset) - len(indices), description=description)
+    data_loader = DataLoader(Subset(dataset, indices), batch_size=128, shuffle=False, num_workers=workers)
 
-    with tqdm(total=len(dataset)) as progress:
+    with tqdm(total=len(dataset), initial=len(dataset) - len(indices)) as progress:
         for batch in data_loader:
-            for i in range(len(batch['yaw'])):
-                for column in batch:
-                    value = batch[column][i]
-                    if isinstance(value, str):
-                        row[column] = batch[column][i]
-                    else:
-                        row[column] = batch[column][i].numpy()
-                row.append()
-                progress.update(1)
+            progress.update(append_batch(table, batch))
+            if journal is not None:
+                table.flush()
+                for name in batch['file']:
+                    journal.record(f"{table.name}/{name}", output=output_path)
     table.flush()
     file.close()
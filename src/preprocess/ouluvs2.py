@@ -1,37 +1,25 @@
 import glob
 import os
 
-import cv2
 import numpy as np
 import psutil
 import torch
-import torchvision
 import torchvision.transforms.functional as F
 from PIL import Image
-from tables import Float32Col, Int32Col, IsDescription, StringCol, open_file
+from tables import Float32Col, Int32Col, IsDescription, StringCol, UInt8Col
 from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
 from tqdm import tqdm
 
 from src.data.ouluvs2 import OuluVS2Dataset
+from src.data.transforms import ClipTransform, grayscale_clip
+from src.data.video import read_frame, read_video
 from src.preprocess.face_detection.facenet import FaceNet
-from src.preprocess.head_pose.dlib_pose import HeadPose as DlibHeadPose
+from src.preprocess.head_pose.dlib_pose import PoseEngine
 from src.preprocess.head_pose.face_alignment_pose import HeadPose as FaHeadPose
 from src.preprocess.head_pose.hopenet import HeadPose as HopeNetHeadPose
-
-
-def first_frame_tensor(video_path):
-    video, _, _ = torchvision.io.read_video(video_path, pts_unit='sec')
-    frames = video.permute(0, 3, 1, 2)
-    return transforms.functional.to_pil_image(frames[0])
-
-def first_frame_cv2(video_path):
-    cap = cv2.VideoCapture(video_path)
-    ret, frame = cap.read()
-    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    cap.release()
-    cv2.destroyAllWindows()
-    return frame
+from src.preprocess.journal import Journal
+from src.preprocess.lrw import preprocess_hdf5
 
 
 def build_file_list(path):
@@ -43,37 +31,46 @@ def build_file_list(path):
     return videos
 
 
-def head_poses(path):
-    predictor = DlibHeadPose()
+def load_head_frame(file):
+    # first frame cropped to the head, runs in the PoseEngine workers
+    frame = grayscale_clip(read_frame(file))[..., 0].numpy()
+    crop = (
+        420,
+        0,
+        1500,
+        1080,
+    )
+    frame = Image.fromarray(frame)
+    frame = frame.crop(crop).resize((256, 256))
+    # frame = transforms.functional.to_tensor(frame)
+    return np.asarray(frame)
+
+
+def head_poses(path, output_path, resume=None, workers=None):
     file_paths = build_file_list(path)
     size = 786
     degree = 20
 
+    journal = Journal(f"{output_path}/head_poses.journal.jsonl", resume)
+    pending = [file_paths[i] for i in journal.pending(file_paths)]
+    with PoseEngine(processes=workers) as engine:
+        for file, euler in tqdm(zip(pending, engine.map(pending, load=load_head_frame)), total=len(pending)):
+            split = file.split("/")[-1][:-4].split("_")
+            speaker, view, utterance = [int(x[1:]) for x in split]
+            view = [0, 30, 45, 60, 90][view-1]
+            journal.record(file, view=view, yaw=float(euler['yaw']))
+    journal.close()
+
     total_samples = {0: 0, 30: 0, 45: 0, 60: 0, 90: 0}
     correct_samples = {0: 0, 30: 0, 45: 0, 60: 0, 90: 0}
-    for file in tqdm(file_paths):
-        frame = first_frame_cv2(file)
-        crop = (
-            420,
-            0,
-            1500,
-            1080,
-        )
-
-        split = file.split("/")[-1][:-4].split("_")
-        speaker, view, utterance = [int(x[1:]) for x in split]
-        view = [0, 30, 45, 60, 90][view-1]
-        frame = Image.fromarray(frame)
-        frame = frame.crop(crop).resize((256, 256))
-        # frame = transforms.functional.to_tensor(frame)
-        frame = np.asarray(frame)
+    for record in journal.entries(file_paths):
+        view = record['view']
+        yaw = abs(record['yaw'])
         total_samples[view] += 1
-        euler = predictor.predict(frame)
-        yaw = abs(euler['yaw'])
         if yaw - degree <= view and yaw + degree >= view:
             correct_samples[view] += 1
         else:
-            # print(f"Expected: {view:.2f}, Got: {yaw:.2f}, File: {file}")
+            # print(f"Expected: {view:.2f}, Got: {yaw:.2f}, File: {record['key']}")
             pass
     print(f"Correct samples: {correct_samples}")
     print(f"Samples per view: {total_samples}")
@@ -84,45 +81,63 @@ def head_poses(path):
 
 
 class Video(IsDescription):
-    yaw = Float32Col()
+    frames = UInt8Col(shape=(3, 38, 100, 120))
+    length = Int32Col()
+    label = Int32Col()
     view = Float32Col()
     speaker = Int32Col()
     utterance = Int32Col()
     file = StringCol(32)
 
 
-def preprocess(path, output, workers=None):
+class OuluVS2Export(OuluVS2Dataset):
+    '''
+    Returns the columns of Video: the uint8 clip resized like OuluVS2Dataset and zero padded to max_timesteps,
+    its length, the phrase label and the speaker, view and utterance from the file name.
+    '''
+
+    def __init__(self, path, mode):
+        super().__init__(path=path, mode=mode)
+        self.transform = ClipTransform((100, 120), self.transform.mean, self.transform.std, crop='resize', normalize=False)
+        self.files = [os.path.basename(file) for file in self.file_list]
+
+    def __getitem__(self, idx):
+        frames = read_video(self.file_list[idx])[:self.max_timesteps]
+        x = torch.zeros(3, self.max_timesteps, 100, 120, dtype=torch.uint8)
+        x[:, :frames.size(0)] = self.transform(frames).transpose(1, 0)
+
+        speaker, view, utterance = [int(x[1:]) for x in self.files[idx][:-4].split("_")]
+        return {
+            'frames': x,
+            'length': frames.size(0),
+            'label': (utterance - 31) // 3,  # index of the phrase in transcripts
+            'view': [0, 30, 45, 60, 90][view-1],
+            'speaker': speaker,
+            'utterance': utterance,
+            'file': self.files[idx],
+        }
+
+
+def preprocess(path, output, workers=None, resume=None, seed=42):
     workers = psutil.cpu_count() if workers == None else workers
     if os.path.exists(output) == False:
         os.makedirs(output)
 
     output_path = "%s/ouluvs2.h5" % (output)
-    if os.path.exists(output_path):
+    if os.path.exists(output_path) and resume is None:
         os.remove(output_path)
-
-    labels = None
-    dataset = OuluVS2Dataset(path=path)
-    preprocess_hdf5(
-        dataset=dataset,
-        output_path=output_path,
-        table='train',
-        workers=workers,
-    )
+    journal = Journal(f"{output_path}.journal.jsonl", resume)
+
+    for mode in ['train', 'val', 'test']:
+        dataset = OuluVS2Export(path=path, mode=mode)
+        preprocess_hdf5(
+            dataset=dataset,
+            output_path=output_path,
+            table=mode,
+            workers=workers,
+            journal=journal,
+            seed=seed,
+            description=Video,
+        )
+    journal.close()
     print("Saved preprocessed file: %s" % output_path)
-
-
-def preprocess_hdf5(dataset, output_path, table, workers):
-    file = open_file(output_path, mode="a")
-    table = file.create_table("/", table, Video, expectedrows=len(dataset))
-    row = table.row
-    data_loader = DataLoader(dataset, batch_size=32, shuffle=False, num_workers=workers)
-
-    with tqdm(total=len(dataset)) as progress:
-        for batch in data_loader:
-            for i in range(len(batch['yaw'])):
-                for column in batch:
-                    row[column] = batch[column][i]
-                row.append()
-                progress.update(1)
-    table.flush()
-    file.close()
@@ -0,0 +1,91 @@
+import numpy as np
+
+
+def box_geometry(box):
+    # (left, upper, right, lower) -> center (x, y), size (width, height)
+    left, upper, right, lower = box
+    return ((left + right) / 2, (upper + lower) / 2), (right - left, lower - upper)
+
+
+def crop_patch(frame, center, size, stride=2):
+    # grayscale patch of size around center, clipped at the frame border and subsampled by stride
+    height, width = frame.shape[:2]
+    rows = np.clip(np.round(center[1] - size[1] / 2 + np.arange(0, size[1], stride)).astype(int), 0, height - 1)
+    cols = np.clip(np.round(center[0] - size[0] / 2 + np.arange(0, size[0], stride)).astype(int), 0, width - 1)
+    return frame[rows[:, None], cols[None, :]].astype(np.float32)
+
+
+def ncc(a, b):
+    # normalized cross correlation of two patches of the same size, 1 for identical appearance
+    a = a - a.mean()
+    b = b - b.mean()
+    norm = np.sqrt((a * a).sum() * (b * b).sum())
+    if norm == 0:
+        return 1.0 if (a == b).all() else 0.0
+    return float((a * b).sum() / norm)
+
+
+def interpolate_boxes(keyframes, boxes, num_frames):
+    # linear motion between keyframes, the first and last box are held at the ends
+    boxes = np.asarray(boxes, dtype=np.float64)
+    frames = np.arange(num_frames)
+    return np.stack([np.interp(frames, keyframes, boxes[:, i]) for i in range(4)], axis=1)
+
+
+class KeyframeTracker():
+    '''
+    Detects boxes (left, upper, right, lower) only on keyframes every interval frames and interpolates them in between.
+    Each interpolated box is checked against the appearance of the box in the closest keyframe with normalized cross
+    correlation. When it drops below threshold, the frame in the middle of the segment is detected as well, until the
+    segment is at most min_interval frames long. Easy videos need about num_frames / interval detections.
+
+    detect(indices) returns a box or None (nothing found) for each of the frame indices, all of them in one batch.
+    '''
+
+    def __init__(self, detect, interval=10, min_interval=2, threshold=0.6):
+        self.detect = detect
+        self.interval = interval
+        self.min_interval = min_interval
+        self.threshold = threshold
+        self.num_detections = 0
+
+    def confidence(self, frames, boxes, start, end):
+        templates = {}
+        for keyframe in [start, end]:
+            center, size = box_geometry(boxes[keyframe])
+            templates[keyframe] = (crop_patch(frames[keyframe], center, size), size)
+
+        confidence = 1.0
+        for i in range(start + 1, end):
+            template, size = templates[start if i - start <= end - i else end]
+            center, _ = box_geometry(boxes[i])
+            confidence = min(confidence, ncc(template, crop_patch(frames[i], center, size)))
+        return confidence
+
+    def track(self, frames):
+        '''
+        frames: (T, H, W) uint8 grayscale frames used for the appearance checks
+        returns a (T, 4) array of boxes or None when no keyframe had a detection
+        '''
+        num_frames = len(frames)
+        keyframes = sorted(set(range(0, num_frames, self.interval)) | {num_frames - 1})
+        detections = dict(zip(keyframes, self.detect(keyframes)))
+        self.num_detections = len(keyframes)
+
+        while True:
+            found = sorted(i for i, box in detections.items() if box is not None)
+            if len(found) == 0:
+                return None
+            boxes = interpolate_boxes(found, [detections[i] for i in found], num_frames)
+
+            refine = []
+            for start, end in zip(found[:-1], found[1:]):
+                middle = (start + end) // 2
+                if end - start <= self.min_interval or middle in detections:
+                    continue
+                if self.confidence(frames, boxes, start, end) < self.threshold:
+                    refine.append(middle)
+            if len(refine) == 0:
+                return boxes
+            detections.update(zip(refine, self.detect(refine)))
+            self.num_detections += len(refine)
@@ -3,27 +3,20 @@ import glob
 import os
 
 import cv2
+import dlib
 import matplotlib.pyplot as plt
 import numpy as np
 
-from head_pose.dlib_pose import HeadPose
+from src.data.transforms import grayscale_clip
+from src.data.video import read_video
+from src.preprocess.head_pose.dlib_pose import PoseEngine
+from src.preprocess.tracking import KeyframeTracker
 
 
 def load_video(video_path):
-    cap = cv2.VideoCapture(video_path)
-    frames = []
-    while(True):
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        frames.append(frame)
-
-    cap.release()
-    cv2.destroyAllWindows()
-
-    return frames
+    # grayscale frames (H, W) as numpy arrays
+    video = grayscale_clip(read_video(video_path))
+    return list(video[..., 0].numpy())
 
 
 def save_frames(video_path, output_path):
@@ -34,24 +27,32 @@ def save_frames(video_path, output_path):
         cv2.imwrite(path, frame)
 
 
-def extract_angles(video_path):
-    head_pose = HeadPose()
+def extract_angles(video_path, engine):
+    # angles of every frame, the frames are distributed over the processes of the PoseEngine
     frames = load_video(video_path)
-    angles = []
-    for frame in frames:
-        euler_angle = head_pose.predict(frame)
-        angles.append(euler_angle)
+    return list(engine.map(frames))
 
-    return angles
 
-
-def load_mouth_images(predictor, video_path, skip_frames=3):
+def load_mouth_images(predictor, video_path, keyframe_interval=10):
+    # the face is detected on keyframes and tracked in between, the mouth landmarks are predicted on every frame
     frames = load_video(video_path)
-    face_rect = None
+
+    def detect(indices):
+        rects = []
+        for i in indices:
+            try:
+                rect = predictor.face_rect(frames[i], video_path)
+            except AssertionError:
+                rects.append(None)
+                continue
+            rects.append([rect.left(), rect.top(), rect.right(), rect.bottom()])
+        return rects
+
+    boxes = KeyframeTracker(detect, interval=keyframe_interval).track(np.stack(frames))
+    assert boxes is not None, "Expected a face in %s" % video_path
     mouth_frames = []
-    for i, frame in enumerate(frames):
-        if i % skip_frames == 0:
-            face_rect = predictor.face_rect(frame, video_path)
+    for frame, box in zip(frames, boxes):
+        face_rect = dlib.rectangle(*[int(round(pos)) for pos in box])
         mouth_image = predictor.mouth_image_rect(frame, face_rect)
         mouth_frames.append(mouth_image)
 
@@ -59,9 +60,9 @@ def load_mouth_images(predictor, video_path, skip_frames=3):
 
 
 def plot_histogram(video_path):
-    angles = extract_angles(args.path)
-    angles = np.array(angles)
-    yaw_values = angles[:, 1]
+    with PoseEngine() as engine:
+        angles = extract_angles(video_path, engine)
+    yaw_values = np.array([angle['yaw'] for angle in angles])
     plt.hist(yaw_values, bins=len(angles))
     plt.xlabel('Yaw')
     plt.show()
@@ -72,9 +73,10 @@ def process_directory(directory, file_type='mp4'):
     videos = glob.glob(pattern)
     print("Processing  %d videos" % len(videos))
 
-    for i, video in enumerate(videos):
-        angles = extract_angles(video)
-        print("[%d/%d]: %s" % (i, len(videos), video))
+    with PoseEngine() as engine:
+        for i, video in enumerate(videos):
+            angles = extract_angles(video, engine)
+            print("[%d/%d]: %s" % (i, len(videos), video))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+import time
+
+import ray
+from tqdm import tqdm
+
+
+class WorkQueue():
+    '''
+    Pull based distribution of work items onto ray actors.
+    Every actor has at most max_in_flight tasks at a time and receives the next item as soon as one of them finishes,
+    so a slow actor does not hold back the others. Results are handed to sink(item, result) in completion order,
+    which usually appends them to an output file, and are not kept in memory.
+    '''
+
+    def __init__(self, actors, max_in_flight=2):
+        self.actors = actors
+        self.max_in_flight = max_in_flight
+        self.completed = [0 for _ in actors]
+        self.failed = [0 for _ in actors]
+        self.busy_time = [0.0 for _ in actors]
+
+    def run(self, items, submit, sink, description=None, failure=None):
+        '''
+        submit(actor, item) starts the remote call and returns its ObjectRef, e.g. actor.process.remote(*item).
+        Failed tasks are counted and passed to failure(item, error), or printed without it, the queue keeps going.
+        '''
+        total = len(items) if hasattr(items, '__len__') else None
+        items = iter(items)
+        tasks = {}  # ObjectRef -> (actor index, item, start time)
+        start_time = time.time()
+
+        def schedule(actor_id):
+            item = next(items, None)
+            if item is not None:
+                tasks[submit(self.actors[actor_id], item)] = (actor_id, item, time.time())
+
+        for actor_id in range(len(self.actors)):
+            for _ in range(self.max_in_flight):
+                schedule(actor_id)
+
+        with tqdm(total=total, desc=description, unit='item') as progress:
+            while len(tasks) > 0:
+                done, _ = ray.wait(list(tasks.keys()), num_returns=1)
+                for ref in done:
+                    actor_id, item, submit_time = tasks.pop(ref)
+                    try:
+                        result = ray.get(ref)
+                    except Exception as e:
+                        self.failed[actor_id] += 1
+                        if failure is not None:
+                            failure(item, e)
+                        else:
+                            print(f"Failed: {item}", e)
+                    else:
+                        sink(item, result)
+                        self.completed[actor_id] += 1
+                    # queued tasks overlap, so this is the latency per item rather than pure compute time
+                    self.busy_time[actor_id] += time.time() - submit_time
+                    progress.update(1)
+                    schedule(actor_id)
+                progress.set_postfix(items_per_sec=f"{sum(self.completed) / (time.time() - start_time):.1f}")
+
+        self.print_stats(time.time() - start_time)
+
+    def throughput(self, elapsed_time):
+        # completed items per second of every actor
+        return [completed / max(elapsed_time, 1e-9) for completed in self.completed]
+
+    def print_stats(self, elapsed_time):
+        for actor_id, items_per_sec in enumerate(self.throughput(elapsed_time)):
+            latency = self.busy_time[actor_id] / max(self.completed[actor_id] + self.failed[actor_id], 1)
+            print(
+                f"actor {actor_id}: {self.completed[actor_id]} done, {self.failed[actor_id]} failed, "
+                f"{items_per_sec:.2f} items/s, {latency:.2f}s per item"
+            )
@@ -19,6 +19,8 @@ if __name__ == "__main__":
     parser.add_argument("--resnet", type=int, default=18)
     parser.add_argument("--pretrained", default=True, type=lambda x: (str(x).lower() == 'true'))
     parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--readahead", type=int, default=0, help='Read the files of this many upcoming samples ahead in a background thread pool')
+    parser.add_argument("--readahead_mb", type=int, default=1024, help='Maximum MB of files read ahead')
     args = parser.parse_args()
 
     checkpoint_callback = ModelCheckpoint(
@@ -14,9 +14,11 @@ if __name__ == "__main__":
     parser.add_argument('--data', default="data/datasets/lrs2")
     parser.add_argument('--model', default="resnet")
     parser.add_argument('--lm_path')
+    parser.add_argument('--shards', type=str, default=None, help='Directory with tar shards written with preprocess.py lrs2_shards')
     parser.add_argument("--checkpoint_dir", type=str, default='data/checkpoints/lrs2')
     parser.add_argument("--checkpoint", type=str)
     parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--frame_budget", type=int, default=None, help='Batch by length buckets with at most this many padded frames per batch')
     parser.add_argument("--epochs", type=int, default=20)
     parser.add_argument("--lr", type=float, default=1e-4)
     parser.add_argument("--weight_decay", type=float, default=1e-5)
@@ -25,6 +27,11 @@ if __name__ == "__main__":
     parser.add_argument("--pretrained", default=True, type=lambda x: (str(x).lower() == 'true'))
     parser.add_argument("--pretrain", default=False, action='store_true')
     parser.add_argument("--use_amp", default=False, action='store_true')
+    parser.add_argument("--video_cache", type=float, default=None, help='GB of encoded videos to keep in shared memory')
+    parser.add_argument("--uint8", default=False, action='store_true', help='Load uint8 clips and normalize them on the GPU')
+    parser.add_argument("--gray8", default=False, action='store_true', help='Decode the luma plane of grayscale clips, not the pixels of existing checkpoints')
+    parser.add_argument("--readahead", type=int, default=0, help='Read the files of this many upcoming samples ahead in a background thread pool')
+    parser.add_argument("--readahead_mb", type=int, default=1024, help='Maximum MB of files read ahead')
     parser.add_argument("--seed", type=int, default=42)
     args = parser.parse_args()
 
@@ -11,6 +11,9 @@ from src.models.lrw_model import LRWModel
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--data', default="data/datasets/lrw")
+    parser.add_argument('--frames', type=str, default=None, help='Directory with pre-decoded frame shards')
+    parser.add_argument('--hdf5', type=str, default=None, help='HDF5 file created with preprocess.py --data lrw')
+    parser.add_argument('--shards', type=str, default=None, help='Directory with tar shards written with preprocess.py lrw_shards')
     parser.add_argument("--checkpoint_dir", type=str, default='data/checkpoints/lrw')
     parser.add_argument("--checkpoint", type=str)
     parser.add_argument("--batch_size", type=int, default=24)
@@ -24,6 +27,11 @@ if __name__ == "__main__":
     parser.add_argument("--pretrained", default=True, type=lambda x: (str(x).lower() == 'true'))
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--use_amp", default=False, action='store_true')
+    parser.add_argument("--video_cache", type=float, default=None, help='GB of encoded videos to keep in shared memory')
+    parser.add_argument("--uint8", default=False, action='store_true', help='Load uint8 clips and normalize them on the GPU')
+    parser.add_argument("--gray8", default=False, action='store_true', help='Decode the luma plane of grayscale clips, not the pixels of existing checkpoints')
+    parser.add_argument("--readahead", type=int, default=0, help='Read the files of this many upcoming samples ahead in a background thread pool')
+    parser.add_argument("--readahead_mb", type=int, default=1024, help='Maximum MB of files read ahead')
     args = parser.parse_args()
 
     checkpoint_callback = ModelCheckpoint(